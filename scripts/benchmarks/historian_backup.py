@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#}}}
+
+'''Measure BaseHistorianAgent backup cache throughput in rows per second.
+
+Readings shaped like a device scrape are written with
+_backup_new_to_publish() and read back and cleaned up in batches of
+submit_size_limit, the same way the historian process loop does.
+'''
+
+from __future__ import print_function
+
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import time
+
+from volttron.platform.agent.base_historian import BaseHistorianAgent
+
+
+class BenchmarkHistorian(BaseHistorianAgent):
+    def __init__(self, submit_size_limit):
+        # Skip agent and processing thread setup; only the cache is used.
+        self._submit_size_limit = submit_size_limit
+        self._successful_published = set()
+        self._meta_data = defaultdict(dict)
+        self._backup_cache = {}
+
+    def publish_to_historian(self, to_publish_list):
+        self.report_all_handled()
+
+
+def make_scrapes(devices, points, scrapes):
+    start = datetime.utcnow()
+    meta = {'units': 'F', 'type': 'float', 'tz': 'US/Pacific'}
+    for scrape in xrange(scrapes):
+        timestamp = start + timedelta(minutes=scrape)
+        batch = []
+        for device in xrange(devices):
+            for point in xrange(points):
+                batch.append({'source': 'scrape',
+                              'topic': 'campus/building/device{}/point{}'.format(
+                                  device, point),
+                              'readings': [(timestamp, 70.0 + point)],
+                              'meta': meta})
+        yield batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--points', type=int, default=200)
+    parser.add_argument('--scrapes', type=int, default=5)
+    parser.add_argument('--submit-size-limit', type=int, default=1000)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    os.chdir(tmpdir)
+    try:
+        historian = BenchmarkHistorian(args.submit_size_limit)
+        historian._setup_backup_db()
+        scrapes = list(make_scrapes(args.devices, args.points, args.scrapes))
+        total = sum(len(batch) for batch in scrapes)
+
+        start = time.time()
+        for batch in scrapes:
+            historian._backup_new_to_publish(batch)
+        elapsed = time.time() - start
+        print('in:  {:10.0f} rows/sec ({} rows in {:.2f} s)'.format(
+            total / elapsed, total, elapsed))
+
+        start = time.time()
+        count = 0
+        while True:
+            to_publish_list = historian._get_outstanding_to_publish()
+            if not to_publish_list:
+                break
+            count += len(to_publish_list)
+            historian.publish_to_historian(to_publish_list)
+            historian._cleanup_successful_publishes()
+        elapsed = time.time() - start
+        print('out: {:10.0f} rows/sec ({} rows in {:.2f} s)'.format(
+            count / elapsed, count, elapsed))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#}}}
+
+'''Compare pubsub subscriber matching using TopicTrie and a linear scan.
+
+Subscriptions are generated in the shape used by drivers and historians
+(devices/<campus>/<building>/<device>/<point>) and random topics from the
+same space are matched against them.
+'''
+
+from __future__ import print_function
+
+import argparse
+import random
+import timeit
+
+from volttron.platform.vip.agent.subsystems.pubsub import TopicTrie
+
+
+def make_prefixes(count):
+    prefixes = []
+    for i in xrange(count):
+        prefixes.append('devices/campus{}/building{}/device{}/point{}'.format(
+            i % 5, i % 50, i % 1000, i))
+    # A handful of broad subscribers, like historians and listeners.
+    prefixes.extend(['', 'devices', 'devices/campus1/', 'analysis/'])
+    return prefixes
+
+
+def make_topics(prefixes, count):
+    topics = []
+    for _ in xrange(count):
+        prefix = random.choice(prefixes) or 'devices'
+        topics.append(prefix + random.choice(['', '/all', 'x']))
+    return topics
+
+
+def linear_match(subscriptions, topic):
+    subscribers = set()
+    for prefix, subscription in subscriptions.iteritems():
+        if subscription and topic.startswith(prefix):
+            subscribers |= subscription
+    return subscribers
+
+
+def run(count, lookups):
+    prefixes = make_prefixes(count)
+    topics = make_topics(prefixes, lookups)
+    trie = TopicTrie()
+    subscriptions = {}
+    for i, prefix in enumerate(prefixes):
+        peer = 'agent{}'.format(i % 50)
+        trie.add(prefix, peer)
+        subscriptions.setdefault(prefix, set()).add(peer)
+    for topic in topics[:100]:
+        assert trie.match(topic) == linear_match(subscriptions, topic)
+
+    trie.cache_limit = 0
+    cold = timeit.timeit(lambda: [trie.match(t) for t in topics], number=1)
+    trie.cache_limit = TopicTrie.cache_limit
+    for topic in topics:
+        trie.match(topic)
+    warm = timeit.timeit(lambda: [trie.match(t) for t in topics], number=1)
+    sample = topics[:max(1, lookups // 100)]
+    linear = timeit.timeit(
+        lambda: [linear_match(subscriptions, t) for t in sample], number=1)
+    print('{:>8} subscriptions: trie {:8.2f} us  cached {:6.2f} us  '
+          'linear {:10.2f} us  (per match)'.format(
+              len(prefixes), cold / lookups * 1e6, warm / lookups * 1e6,
+              linear / len(sample) * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('counts', type=int, nargs='*',
+                        default=[10000, 100000])
+    args = parser.parse_args()
+    random.seed(0)
+    for count in args.counts:
+        run(count, args.lookups)
+
+
+if __name__ == '__main__':
+    main()
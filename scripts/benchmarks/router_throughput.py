@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#}}}
+
+'''Measure VIP router throughput with varying numbers of peers.
+
+A router runs in a thread on an inproc socket. Each peer is a DEALER
+socket sending messages to the next peer in a ring, so every message
+takes the routed (peer to peer) path. Messages are sent in windows small
+enough to never hit the high water mark, and the rate is reported in
+routed messages per second for both route() and route_batch().
+'''
+
+from __future__ import print_function
+
+import argparse
+import threading
+import time
+
+import zmq
+
+from volttron.platform.vip.router import BaseRouter
+
+
+ADDRESS = 'inproc://router-benchmark'
+
+
+class BenchmarkRouter(BaseRouter):
+    def setup(self):
+        self.socket.identity = b'router'
+        self.socket.bind(ADDRESS)
+
+
+def serve(router, batched, stop):
+    route = router.route_batch if batched else router.route
+    poll = router.socket.poll
+    while not stop.is_set():
+        if poll(100):
+            route()
+    router.stop()
+
+
+def run(context, peer_count, messages, window, batched):
+    router = BenchmarkRouter(context=context)
+    router.start()
+    stop = threading.Event()
+    thread = threading.Thread(target=serve, args=(router, batched, stop))
+    thread.start()
+    peers = []
+    try:
+        for i in xrange(peer_count):
+            sock = context.socket(zmq.DEALER)
+            sock.identity = 'peer{}'.format(i).encode('ascii')
+            sock.connect(ADDRESS)
+            peers.append(sock)
+        # Introduce every peer to the router before timing.
+        for sock in peers:
+            sock.send_multipart([b'', b'VIP1', b'', b'', b'ping'])
+            sock.recv_multipart()
+        payload = b'x' * 100
+        rounds = max(1, messages // (window * peer_count))
+        start = time.time()
+        for _ in xrange(rounds):
+            for i, sock in enumerate(peers):
+                recipient = peers[(i + 1) % peer_count].identity
+                for _ in xrange(window):
+                    sock.send_multipart(
+                        [recipient, b'VIP1', b'', b'', b'bench', payload])
+            for sock in peers:
+                for _ in xrange(window):
+                    sock.recv_multipart(copy=False)
+        elapsed = time.time() - start
+    finally:
+        stop.set()
+        thread.join()
+        for sock in peers:
+            sock.close(0)
+    return rounds * window * peer_count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--window', type=int, default=100)
+    parser.add_argument('peers', type=int, nargs='*', default=[1, 10, 100])
+    args = parser.parse_args()
+    context = zmq.Context()
+    for peer_count in args.peers:
+        single = run(context, peer_count, args.messages, args.window, False)
+        batched = run(context, peer_count, args.messages, args.window, True)
+        print('{:>5} peers: route {:10.0f} msg/s  route_batch {:10.0f} msg/s'
+              .format(peer_count, single, batched))
+    context.term()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#}}}
+
+'''Compare VIP payload serializers on a device scrape.
+
+The payload mirrors the message a driver publishes on devices/.../all: a
+dictionary of point values followed by a dictionary of point metadata.
+Encode and decode times and the encoded size are reported for every
+available serializer (msgpack is only included if it is installed).
+'''
+
+from __future__ import print_function
+
+import argparse
+import random
+import timeit
+
+from volttron.platform.vip.serializers import SERIALIZERS
+
+
+def make_payload(points):
+    values = {}
+    meta = {}
+    for i in xrange(points):
+        name = 'Point{}'.format(i)
+        values[name] = random.uniform(-1000, 1000)
+        meta[name] = {'units': 'degreesFahrenheit', 'tz': 'US/Pacific',
+                      'type': 'float'}
+    return [values, meta]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', type=int, default=500)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+    random.seed(0)
+    payload = make_payload(args.points)
+    for name, serializer in sorted(SERIALIZERS.iteritems()):
+        data = serializer.dumps(payload)
+        assert serializer.loads(data) == payload
+        encode = timeit.timeit(lambda: serializer.dumps(payload),
+                               number=args.number) / args.number
+        decode = timeit.timeit(lambda: serializer.loads(data),
+                               number=args.number) / args.number
+        print('{:>8}: encode {:8.1f} us  decode {:8.1f} us  size {:7} bytes'
+              .format(name, encode * 1e6, decode * 1e6, len(data)))
+
+
+if __name__ == '__main__':
+    main()
@@ -56,6 +56,7 @@
 import logging
 import sys
 import sqlite3
+import time
 
 from volttron.platform.vip.agent import Agent, Core, RPC
 from volttron.platform.async import AsyncCall
@@ -63,7 +64,7 @@ from volttron.platform.agent import utils
 import os.path
 import errno
 from zmq.utils import jsonapi
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from Queue import Queue, Empty
 
@@ -93,12 +94,15 @@ from bacpypes.apdu import (ReadPropertyRequest,
                            ReadPropertyMultipleACK,
                            PropertyReference,
                            ReadAccessSpecification,
+                           SubscribeCOVRequest,
                            encode_max_apdu_response)
 from bacpypes.primitivedata import Null, Atomic, Enumerated, Integer, Unsigned, Real
 from bacpypes.constructeddata import Array, Any
 from bacpypes.basetypes import ServicesSupported
 from bacpypes.task import TaskManager
+import gevent
 from gevent.event import AsyncResult
+from gevent.pool import Pool
 
 path = os.path.dirname(os.path.abspath(__file__))
 configFile = os.path.join(path, "bacnet_example_config.csv")
@@ -106,6 +110,26 @@ configFile = os.path.join(path, "bacnet_example_config.csv")
 #Make sure the TaskManager singleton exists...
 task_manager = TaskManager()
 
+class AbortError(RuntimeError):
+    """A device aborted a request, typically because it was too large."""
+
+
+def cast_value(datatype, array_index, value):
+    """Convert an Any holding a property of datatype to a Python value."""
+    # special case for array parts, others are managed by cast_out
+    if issubclass(datatype, Array) and (array_index is not None):
+        if array_index == 0:
+            return value.cast_out(Unsigned)
+        return value.cast_out(datatype.subtype)
+    result = value.cast_out(datatype)
+    if issubclass(datatype, Enumerated):
+        result = datatype(result).get_long()
+    return result
+
+
+#Seconds past a request's deadline to wait for the application to fail it.
+REQUEST_TIMEOUT_GRACE = 2
+
 #IO callback
 class IOCB:
 
@@ -114,6 +138,29 @@ class IOCB:
         self.ioRequest = request
         self.ioResult = AsyncResult()
         self.ioCall = asynccall
+        # set by the application when a confirmed request is sent
+        self.deadline = None
+        
+    def get(self):
+        """Wait for and return the result of a confirmed request.
+        
+        The application fails requests not answered by their deadline,
+        which is only set once they are sent, so time spent queued
+        behind other requests to the device is not counted against
+        them. gevent.Timeout is raised if the application fails to do
+        so soon after the deadline.
+        """
+        while True:
+            deadline = self.deadline
+            if deadline is None:
+                timeout = REQUEST_TIMEOUT_GRACE
+            else:
+                timeout = max(deadline - time.time(), 0) + REQUEST_TIMEOUT_GRACE
+            try:
+                return self.ioResult.get(timeout=timeout)
+            except gevent.Timeout:
+                if deadline is not None:
+                    raise
         
     def set(self, value):
         self.ioCall.send(None, self.ioResult.set, value)
@@ -123,65 +170,174 @@ class IOCB:
 
 @class_debugging
 class BACnet_application(BIPSimpleApplication, RecurringTask):
-    def __init__(self, *args):
-        BIPSimpleApplication.__init__(self, *args)
-        RecurringTask.__init__(self, 250)
+    """Application sending requests for the proxy agent.
+    
+    Requests are submitted from the agent's thread and sent from the
+    bacpypes thread, which is woken up for each submission. Confirmed
+    requests are queued per device and sent round robin, at most
+    max_in_flight per device at a time, so a busy device cannot starve
+    the others. Those unanswered after request_timeout seconds fail.
+    """
+    def __init__(self, device, address, max_in_flight=4, request_timeout=10):
+        BIPSimpleApplication.__init__(self, device, address)
+        # The recurring task only times out requests and is a backstop
+        # for wake ups; requests are sent as they are submitted.
+        RecurringTask.__init__(self, 1000)
         self.request_queue = Queue()
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
 
-        # assigning invoke identifiers
-        self.nextInvokeID = 1
+        # next invoke identifier by destination
+        self.next_invoke_id = defaultdict(int)
 
         # keep track of requests to line up responses
         self.iocb = {}
         
+        # deadlines of requests in self.iocb
+        self.deadlines = {}
+        
+        # confirmed requests waiting to be sent, by destination, and
+        # the destinations with waiting requests in the order served
+        self.waiting = defaultdict(deque)
+        self.ready = deque()
+        self.in_flight = defaultdict(int)
+        
+        # maxAPDULengthAccepted and segmentationSupported of devices
+        # that answered a WhoIs, by address
+        self.device_info = {}
+        
+        # property values from COV notifications by
+        # (address, object type, instance number)
+        self.cov_values = {}
+        
         self.install_task()
         
     def process_task(self):
+        self.expire_requests()
+        self.dispatch()
+        
+    def submit_request(self, iocb):
+        """Queue a request to be sent; safe to call from any thread."""
+        self.request_queue.put(iocb)
+        bacpypes.core.deferred(self.dispatch)
+        # Interrupt the bacpypes loop's wait for socket activity.
+        if task_manager.trigger:
+            task_manager.trigger.set()
+
+    def dispatch(self):
+        """Send queued requests that devices have room for."""
         while True:
             try: 
                 iocb = self.request_queue.get(False)
             except Empty:
                 break
-            
-            self.request(iocb)
-            
-    def submit_request(self, iocb):
-        self.request_queue.put(iocb)
+            apdu = iocb.ioRequest
+            if not isinstance(apdu, ConfirmedRequestSequence):
+                self.request(iocb)
+                continue
+            destination = apdu.pduDestination
+            waiting = self.waiting[destination]
+            if not waiting:
+                self.ready.append(destination)
+            waiting.append(iocb)
+        
+        # Take one request from each destination in turn until none
+        # of them have room for more.
+        full = 0
+        while full < len(self.ready):
+            destination = self.ready.popleft()
+            if self.in_flight[destination] >= self.max_in_flight:
+                self.ready.append(destination)
+                full += 1
+                continue
+            full = 0
+            waiting = self.waiting[destination]
+            self.request(waiting.popleft())
+            if waiting:
+                self.ready.append(destination)
+            else:
+                del self.waiting[destination]
+                
+    def expire_requests(self):
+        now = time.time()
+        for invoke_key, deadline in self.deadlines.items():
+            if deadline <= now:
+                iocb = self.finish(invoke_key)
+                iocb.set_exception(RuntimeError("Request timed out"))
+
+    def finish(self, invoke_key):
+        """Stop tracking a request, making room for another to the device."""
+        iocb = self.iocb.pop(invoke_key)
+        del self.deadlines[invoke_key]
+        destination = invoke_key[0]
+        self.in_flight[destination] -= 1
+        if not self.in_flight[destination]:
+            del self.in_flight[destination]
+        bacpypes.core.deferred(self.dispatch)
+        return iocb
+
+    def do_IAmRequest(self, apdu):
+        """Remember the communication limits a device announces."""
+        self.device_info[str(apdu.pduSource)] = {
+            'max_apdu': apdu.maxAPDULengthAccepted,
+            'segmentation': apdu.segmentationSupported}
+
+    def do_ConfirmedCOVNotificationRequest(self, apdu):
+        self.cov_notification(apdu)
+        self.response(SimpleAckPDU(context=apdu))
+
+    def do_UnconfirmedCOVNotificationRequest(self, apdu):
+        self.cov_notification(apdu)
+
+    def cov_notification(self, apdu):
+        """Store the values of a COV notification."""
+        object_type, instance_number = apdu.monitoredObjectIdentifier
+        values = {}
+        for element in apdu.listOfValues:
+            datatype = get_datatype(object_type, element.propertyIdentifier)
+            if not datatype:
+                continue
+            values[element.propertyIdentifier] = cast_value(
+                datatype, element.propertyArrayIndex, element.value)
+        key = (str(apdu.pduSource), object_type, instance_number)
+        self.cov_values.setdefault(key, {}).update(values)
 
     def get_next_invoke_id(self, addr):
-        """Called to get an unused invoke ID."""
-
-        initialID = self.nextInvokeID
-        while 1:
-            invokeID = self.nextInvokeID
-            self.nextInvokeID = (self.nextInvokeID + 1) % 256
-
-            # see if we've checked for them all
-            if initialID == self.nextInvokeID:
+        """Called to get an unused invoke ID for a destination."""
+        initialID = invokeID = self.next_invoke_id[addr]
+        while (addr, invokeID) in self.iocb:
+            invokeID = (invokeID + 1) % 256
+            if invokeID == initialID:
                 raise RuntimeError("no available invoke ID")
-
-            # see if this one is used
-            if (addr, invokeID) not in self.iocb:
-                break
-
+        self.next_invoke_id[addr] = (invokeID + 1) % 256
         return invokeID
 
     def request(self, iocb):
         apdu = iocb.ioRequest
+        invoke_key = None
         
         if isinstance(apdu, ConfirmedRequestSequence):
-            # assign an invoke identifier
-            apdu.apduInvokeID = self.get_next_invoke_id(apdu.pduDestination)
+            try:
+                # assign an invoke identifier
+                apdu.apduInvokeID = self.get_next_invoke_id(apdu.pduDestination)
+            except RuntimeError as e:
+                iocb.set_exception(e)
+                return
     
             # build a key to reference the IOCB when the response comes back
             invoke_key = (apdu.pduDestination, apdu.apduInvokeID)
     
             # keep track of the request
             self.iocb[invoke_key] = iocb
+            iocb.deadline = time.time() + self.request_timeout
+            self.deadlines[invoke_key] = iocb.deadline
+            self.in_flight[apdu.pduDestination] += 1
         
         try:    
             BIPSimpleApplication.request(self, apdu)
         except StandardError as e:
+            if invoke_key is not None:
+                self.finish(invoke_key)
             iocb.set_exception(e)
 
     def confirmation(self, apdu):
@@ -189,14 +345,13 @@ class BACnet_application(BIPSimpleApplication, RecurringTask):
         invoke_key = (apdu.pduSource, apdu.apduInvokeID)
 
         # find the request
-        iocb = self.iocb.get(invoke_key, None)
-        if iocb is None:
-            iocb.set_exception(RuntimeError("no matching request for confirmation"))
+        if invoke_key not in self.iocb:
+            _log.warning("no matching request for confirmation from {}".format(apdu.pduSource))
             return
-        del self.iocb[invoke_key]
+        iocb = self.finish(invoke_key)
 
         if isinstance(apdu, AbortPDU):
-            iocb.set_exception(RuntimeError("Device communication aborted: " + str(apdu)))
+            iocb.set_exception(AbortError("Device communication aborted: " + str(apdu)))
             return
         
         if isinstance(apdu, Error):
@@ -211,23 +366,18 @@ class BACnet_application(BIPSimpleApplication, RecurringTask):
                 iocb.set_exception(TypeError("unknown datatype"))
                 return
 
-            # special case for array parts, others are managed by cast_out
-            if issubclass(datatype, Array) and (apdu.propertyArrayIndex is not None):
-                if apdu.propertyArrayIndex == 0:
-                    value = apdu.propertyValue.cast_out(Unsigned)
-                else:
-                    value = apdu.propertyValue.cast_out(datatype.subtype)
-            else:
-                value = apdu.propertyValue.cast_out(datatype)
-                if issubclass(datatype, Enumerated):
-                    value = datatype(value).get_long()
-            iocb.set(value)
+            iocb.set(cast_value(datatype, apdu.propertyArrayIndex, apdu.propertyValue))
             
         elif (isinstance(iocb.ioRequest, WritePropertyRequest) and 
               isinstance(apdu, SimpleAckPDU)):
             iocb.set(apdu)
             return
             
+        elif (isinstance(iocb.ioRequest, SubscribeCOVRequest) and 
+              isinstance(apdu, SimpleAckPDU)):
+            iocb.set(apdu)
+            return
+            
         elif (isinstance(iocb.ioRequest, ReadPropertyMultipleRequest) and 
               isinstance(apdu, ReadPropertyMultipleACK)):
             
@@ -262,16 +412,7 @@ class BACnet_application(BIPSimpleApplication, RecurringTask):
                             iocb.set_exception(TypeError("unknown datatype"))
                             return
 
-                        # special case for array parts, others are managed by cast_out
-                        if issubclass(datatype, Array) and (propertyArrayIndex is not None):
-                            if propertyArrayIndex == 0:
-                                value = propertyValue.cast_out(Unsigned)
-                            else:
-                                value = propertyValue.cast_out(datatype.subtype)
-                        else:
-                            value = propertyValue.cast_out(datatype)
-                            if issubclass(datatype, Enumerated):
-                                value = datatype(value).get_long()
+                        value = cast_value(datatype, propertyArrayIndex, propertyValue)
                         
                         result_dict[objectIdentifier[0], objectIdentifier[1], propertyIdentifier] = value
             
@@ -286,9 +427,51 @@ utils.setup_logging()
 _log = logging.getLogger(__name__)
 
 
+#Estimated encoded sizes, in bytes, used to fit ReadPropertyMultiple
+# responses into a device's APDU: the fixed part of the ACK and one
+# property result, including its share of the object header.
+RPM_ACK_OVERHEAD = 16
+RPM_RESULT_SIZE = 20
+#Limits assumed for devices that have not answered a WhoIs.
+DEFAULT_DEVICE_INFO = {'max_apdu': 480, 'segmentation': 'noSegmentation'}
+
+#Properties reported in COV notifications; others are always polled.
+COV_PROPERTIES = ('presentValue', 'statusFlags')
+#Subscriber process identifier used for all COV subscriptions.
+COV_PROCESS_ID = 1
+
+
+class COVSubscription(object):
+    """State of a COV subscription to one object."""
+    def __init__(self, target_address, object_type, instance_number, lifetime, confirmed):
+        self.target_address = target_address
+        self.object_type = object_type
+        self.instance_number = instance_number
+        self.lifetime = lifetime
+        self.confirmed = confirmed
+        #Time the subscription lapses; values are only used before it.
+        self.expires = 0
+        self.last_used = time.time()
+        self.failed_at = None
+        self.pending = False
+
+
 def bacnet_proxy_agent(config_path, **kwargs):
     config = utils.load_config(config_path)
     vip_identity = config.get("vip_identity", "platform.bacnet_proxy")
+    #Number of ReadPropertyMultiple requests a single read_properties
+    # call may have outstanding at once.
+    max_read_window = config.get("max_read_window", 4)
+    #Segments of a response to allow for devices that segment them.
+    max_segments = config.get("max_segments", 8)
+    #Confirmed requests each device may have outstanding at once.
+    max_in_flight = config.get("max_in_flight_per_device", 4)
+    #Seconds to wait for a device to answer a request.
+    request_timeout = config.get("request_timeout", 10)
+    #Seconds between checks for COV subscriptions to renew or cancel.
+    cov_check_interval = config.get("cov_check_interval", 30)
+    max_apdu_length = config.get("max_apdu_length", 1024)
+    segmentation_supported = config.get("segmentation_supported", "segmentedBoth")
     #pop off the uuid based identity
     kwargs.pop('identity', None)
 
@@ -300,9 +483,14 @@ def bacnet_proxy_agent(config_path, **kwargs):
             super(BACnetProxyAgent, self).__init__(identity=vip_identity, **kwargs)
             
             self.async_call = AsyncCall()
+            #Properties per ReadPropertyMultiple by device address,
+            # learned when a device aborts a request as too large.
+            self.read_limits = {}
+            #COVSubscriptions by (address, object type, instance number)
+            self.cov_subscriptions = {}
             self.setup_device(config["device_address"], 
-                              max_apdu_len=config.get("max_apdu_length",1024), 
-                              seg_supported=config.get("segmentation_supported","segmentedBoth"), 
+                              max_apdu_len=max_apdu_length, 
+                              seg_supported=segmentation_supported, 
                               obj_id=config.get("object_id",599), 
                               obj_name=config.get("object_name","Volttron BACnet driver"), 
                               ven_id=config.get("vendor_id",15))
@@ -340,7 +528,9 @@ def bacnet_proxy_agent(config_path, **kwargs):
             # set the property value to be just the bits
             this_device.protocolServicesSupported = pss.value
             
-            self.this_application = BACnet_application(this_device, address)
+            self.this_application = BACnet_application(this_device, address,
+                                                       max_in_flight=max_in_flight,
+                                                       request_timeout=request_timeout)
           
             server_thread = threading.Thread(target=bacpypes.core.run)
         
@@ -398,9 +588,34 @@ def bacnet_proxy_agent(config_path, **kwargs):
             raise RuntimeError("Failed to set value: " + str(result))
             
         
+        def properties_per_request(self, target_address, max_per_request=None):
+            """Return how many properties to read in one request.
+            
+            The count is derived from the limits the device announced in
+            its I-Am and lowered if the device rejects requests.
+            """
+            address = str(Address(target_address))
+            info = self.this_application.device_info.get(address, DEFAULT_DEVICE_INFO)
+            #Responses are limited by the APDU size of both ends.
+            size = min(info['max_apdu'], max_apdu_length)
+            if (info['segmentation'] in ('segmentedBoth', 'segmentedTransmit') and 
+                    segmentation_supported in ('segmentedBoth', 'segmentedReceive')):
+                size *= max_segments
+            count = max(1, (size - RPM_ACK_OVERHEAD) // RPM_RESULT_SIZE)
+            count = min(count, self.read_limits.get(address, count))
+            if max_per_request:
+                count = min(count, max_per_request)
+            return count
+        
         @RPC.export
         def read_properties(self, target_address, point_map, max_per_request=None):
-            """Read a set of points and return the results"""
+            """Read a set of points and return the results.
+            
+            The points are read in as many ReadPropertyMultiple requests
+            as the device's limits require, up to max_read_window at a
+            time. Points in requests that fail are left out of the
+            result; an error is raised only if every request fails.
+            """
             #This will be used to get the results mapped
             # back on the the names
             reverse_point_map = {}
@@ -416,12 +631,54 @@ def bacnet_proxy_agent(config_path, **kwargs):
                                   
                 object_property_map[object_type,
                                     instance_number].append(property_name)
-                                    
+            
+            #Properties of an object stay together in the list so chunks
+            # share object headers.
+            properties = [(obj_type, obj_inst, prop) 
+                          for (obj_type, obj_inst), props in object_property_map.iteritems()
+                          for prop in props]
+            count = self.properties_per_request(target_address, max_per_request)
+            chunks = [properties[i:i + count] for i in xrange(0, len(properties), count)]
+            
+            bacnet_results = {}
+            errors = []
+            def read(chunk):
+                try:
+                    bacnet_results.update(self.read_chunk(target_address, chunk))
+                except (Exception, gevent.Timeout) as e:
+                    errors.append(e)
+            Pool(max_read_window).map(read, chunks)
+            
+            if errors:
+                if not bacnet_results:
+                    raise errors[0]
+                _log.warning("{} of {} requests to read {} failed: {}".format(
+                    len(errors), len(chunks), target_address, errors[0]))
+            
+            result_dict={}
+        
+            for prop_tuple, value in bacnet_results.iteritems():
+                name = reverse_point_map[prop_tuple]
+                result_dict[name] = value        
+            
+            return result_dict
+        
+        def read_chunk(self, target_address, properties):
+            """Read properties with a ReadPropertyMultiple request.
+            
+            If the device aborts the request, which most do when the
+            response would not fit, it is retried in halves and later
+            requests to the device are made no larger.
+            """
+            object_property_map = defaultdict(list)
+            for obj_type, obj_inst, prop in properties:
+                object_property_map[obj_type, obj_inst].append(prop)
+                
             read_access_spec_list = []
-            for obj_data, properties in object_property_map.iteritems():
+            for obj_data, props in object_property_map.iteritems():
                 obj_type, obj_inst = obj_data
                 prop_ref_list = []
-                for prop in properties:
+                for prop in props:
                     prop_ref = PropertyReference(propertyIdentifier=prop)
                     prop_ref_list.append(prop_ref)
                 read_access_spec = ReadAccessSpecification(objectIdentifier=(obj_type, obj_inst),
@@ -433,15 +690,109 @@ def bacnet_proxy_agent(config_path, **kwargs):
             
             iocb = IOCB(request, self.async_call)
             self.this_application.submit_request(iocb)   
-            bacnet_results = iocb.ioResult.get(10)
+            try:
+                return iocb.get()
+            except AbortError:
+                if len(properties) < 2:
+                    raise
+            half = len(properties) // 2
+            address = str(request.pduDestination)
+            self.read_limits[address] = min(self.read_limits.get(address, half), half)
+            _log.info("reading at most {} properties at a time from {}".format(
+                self.read_limits[address], target_address))
+            result = self.read_chunk(target_address, properties[:half])
+            result.update(self.read_chunk(target_address, properties[half:]))
+            return result
+        
+        @RPC.export
+        def read_cov_properties(self, target_address, point_map, lifetime=300, confirmed=False):
+            """Read a set of points, using COV notifications where possible.
             
-            result_dict={}
+            Objects of points for COV reported properties are subscribed
+            to with the given lifetime, in seconds, and subscriptions are
+            renewed while the points keep being read. Points are served
+            from the latest notification while the subscription is
+            current and read from the device otherwise, such as before
+            the first notification or when the device does not support
+            COV.
+            """
+            address = str(Address(target_address))
+            now = time.time()
+            cov_values = self.this_application.cov_values
+            result = {}
+            poll_map = {}
+            for name, properties in point_map.iteritems():
+                object_type, instance_number, property_name = properties
+                if property_name in COV_PROPERTIES:
+                    key = (address, object_type, instance_number)
+                    subscription = self.cov_subscriptions.get(key)
+                    if subscription is None:
+                        subscription = COVSubscription(target_address, object_type, instance_number,
+                                                       lifetime, confirmed)
+                        self.cov_subscriptions[key] = subscription
+                        gevent.spawn(self.subscribe_cov, key, subscription)
+                    subscription.last_used = now
+                    values = cov_values.get(key)
+                    if subscription.expires > now and values and property_name in values:
+                        result[name] = values[property_name]
+                        continue
+                poll_map[name] = properties
+            if poll_map:
+                result.update(self.read_properties(target_address, poll_map))
+            return result
         
-            for prop_tuple, value in bacnet_results.iteritems():
-                name = reverse_point_map[prop_tuple]
-                result_dict[name] = value        
+        def subscribe_cov(self, key, subscription, cancel=False):
+            """Subscribe, renew or, if cancel is True, cancel a subscription."""
+            if subscription.pending:
+                return
+            subscription.pending = True
+            request = SubscribeCOVRequest(
+                subscriberProcessIdentifier=COV_PROCESS_ID,
+                monitoredObjectIdentifier=(subscription.object_type, subscription.instance_number))
+            if not cancel:
+                #A request without these cancels the subscription.
+                request.issueConfirmedNotifications = subscription.confirmed
+                request.lifetime = subscription.lifetime
+            request.pduDestination = Address(subscription.target_address)
+            iocb = IOCB(request, self.async_call)
+            self.this_application.submit_request(iocb)
+            try:
+                iocb.get()
+            except (Exception, gevent.Timeout) as e:
+                if not cancel:
+                    _log.warning("COV subscription to {} {} at {} failed, polling instead: {}".format(
+                        subscription.object_type, subscription.instance_number,
+                        subscription.target_address, e))
+                    subscription.failed_at = time.time()
+                    subscription.expires = 0
+                    self.this_application.cov_values.pop(key, None)
+            else:
+                subscription.failed_at = None
+                subscription.expires = time.time() + subscription.lifetime
+            finally:
+                subscription.pending = False
+        
+        @Core.periodic(cov_check_interval)
+        def check_cov_subscriptions(self):
+            """Renew subscriptions in use and cancel those no longer read.
             
-            return result_dict
+            Subscriptions are renewed halfway through their lifetime.
+            Those not read for two lifetimes are cancelled, and failed
+            ones are retried after a lifetime.
+            """
+            now = time.time()
+            for key, subscription in self.cov_subscriptions.items():
+                lifetime = subscription.lifetime
+                if now - subscription.last_used > 2 * lifetime:
+                    del self.cov_subscriptions[key]
+                    self.this_application.cov_values.pop(key, None)
+                    if subscription.expires > now:
+                        gevent.spawn(self.subscribe_cov, key, subscription, cancel=True)
+                elif subscription.failed_at is not None:
+                    if now - subscription.failed_at > lifetime:
+                        gevent.spawn(self.subscribe_cov, key, subscription)
+                elif subscription.expires - now < lifetime / 2.0:
+                    gevent.spawn(self.subscribe_cov, key, subscription)
         
                     
     return BACnetProxyAgent(**kwargs)
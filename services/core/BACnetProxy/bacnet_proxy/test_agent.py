@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# r favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+
+#}}}
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from bacnet_proxy.agent import AbortError, bacnet_proxy_agent
+
+
+def free_udp_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+_agent = None
+
+def get_agent():
+    """Return a proxy agent whose BACnet device is bound to loopback.
+
+    BACpypes runs a single application per process, so the agent is
+    shared by the tests, which replace how it submits requests.
+    """
+    global _agent
+    if _agent is None:
+        directory = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(directory, 'bacnet-proxy.agent')
+            with open(config_path, 'w') as config_file:
+                json.dump({'device_address':
+                           '127.0.0.1/8:{}'.format(free_udp_port())},
+                          config_file)
+            _agent = bacnet_proxy_agent(config_path)
+        finally:
+            shutil.rmtree(directory)
+    return _agent
+
+
+class FakeDevice(object):
+    """Answer ReadPropertyMultiple requests like a device would.
+
+    Requests for more than max_properties properties are aborted, as
+    devices do when a response will not fit, and every property reads
+    as its object's instance number.
+    """
+    def __init__(self, max_properties, failing_instances=()):
+        self.max_properties = max_properties
+        self.failing_instances = failing_instances
+        self.requests = []
+
+    def submit_request(self, iocb):
+        properties = [(spec.objectIdentifier[0], spec.objectIdentifier[1],
+                       ref.propertyIdentifier)
+                      for spec in iocb.ioRequest.listOfReadAccessSpecs
+                      for ref in spec.listOfPropertyReferences]
+        self.requests.append(len(properties))
+        if len(properties) > self.max_properties:
+            iocb.ioResult.set_exception(AbortError('segmentation not supported'))
+        elif any(instance in self.failing_instances
+                 for _, instance, _ in properties):
+            iocb.ioResult.set_exception(RuntimeError('no response'))
+        else:
+            iocb.ioResult.set(dict((prop, prop[1]) for prop in properties))
+
+
+def make_properties(count):
+    return [('analogInput', instance, 'presentValue')
+            for instance in xrange(count)]
+
+
+class ProxyTestCase(unittest.TestCase):
+    address = '10.0.0.1'
+
+    def setUp(self):
+        self.agent = get_agent()
+        self.agent.read_limits.clear()
+        self.application = self.agent.this_application
+        self.submit_request = self.application.submit_request
+
+    def tearDown(self):
+        self.application.submit_request = self.submit_request
+        self.agent.read_limits.clear()
+
+    def use_device(self, device):
+        self.application.submit_request = device.submit_request
+        return device
+
+
+class ReadChunkTests(ProxyTestCase):
+    def test_no_abort(self):
+        device = self.use_device(FakeDevice(10))
+        properties = make_properties(10)
+        result = self.agent.read_chunk(self.address, properties)
+        self.assertEqual(result, dict((prop, prop[1]) for prop in properties))
+        self.assertEqual(device.requests, [10])
+        self.assertEqual(self.agent.read_limits, {})
+
+    def test_halves_on_abort(self):
+        device = self.use_device(FakeDevice(3))
+        properties = make_properties(10)
+        result = self.agent.read_chunk(self.address, properties)
+        self.assertEqual(result, dict((prop, prop[1]) for prop in properties))
+        self.assertEqual(device.requests, [10, 5, 2, 3, 5, 2, 3])
+        self.assertEqual(self.agent.read_limits, {self.address: 2})
+        self.assertEqual(self.agent.properties_per_request(self.address), 2)
+
+    def test_halves_down_to_one(self):
+        device = self.use_device(FakeDevice(1))
+        properties = make_properties(4)
+        result = self.agent.read_chunk(self.address, properties)
+        self.assertEqual(result, dict((prop, prop[1]) for prop in properties))
+        self.assertEqual(device.requests, [4, 2, 1, 1, 2, 1, 1])
+        self.assertEqual(self.agent.read_limits, {self.address: 1})
+
+    def test_single_property_abort_raised(self):
+        self.use_device(FakeDevice(0))
+        self.assertRaises(AbortError, self.agent.read_chunk,
+                          self.address, make_properties(2))
+        self.assertEqual(self.agent.read_limits, {self.address: 1})
+
+
+class ReadPropertiesTests(ProxyTestCase):
+    def point_map(self, count):
+        return dict(('point{}'.format(instance), list(prop))
+                    for prop in make_properties(count)
+                    for instance in [prop[1]])
+
+    def test_chunks_merged(self):
+        device = self.use_device(FakeDevice(3))
+        result = self.agent.read_properties(self.address, self.point_map(8),
+                                            max_per_request=3)
+        self.assertEqual(result, dict(('point{}'.format(instance), instance)
+                                      for instance in xrange(8)))
+        self.assertEqual(sorted(device.requests), [2, 3, 3])
+
+    def test_chunks_halved(self):
+        device = self.use_device(FakeDevice(2))
+        result = self.agent.read_properties(self.address, self.point_map(8),
+                                            max_per_request=4)
+        self.assertEqual(len(result), 8)
+        self.assertEqual(sorted(device.requests), [2, 2, 2, 2, 4, 4])
+        self.assertEqual(self.agent.read_limits, {self.address: 2})
+
+    def test_failed_chunks_left_out(self):
+        self.use_device(FakeDevice(3, failing_instances=[4]))
+        result = self.agent.read_properties(self.address, self.point_map(9),
+                                            max_per_request=3)
+        # Only the chunk holding point4 is missing.
+        self.assertEqual(len(result), 6)
+        self.assertNotIn('point4', result)
+        for name, value in result.iteritems():
+            self.assertEqual(name, 'point{}'.format(value))
+
+    def test_all_chunks_failed(self):
+        self.use_device(FakeDevice(3, failing_instances=range(8)))
+        self.assertRaises(RuntimeError, self.agent.read_properties,
+                          self.address, self.point_map(8), max_per_request=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
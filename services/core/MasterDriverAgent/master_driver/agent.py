@@ -63,6 +63,7 @@ from driver import DriverAgent
 import resource
 
 from driver_locks import configure_socket_lock, configure_publish_lock
+from scheduler import ScrapeScheduler
 
 utils.setup_logging()
 _log = logging.getLogger(__name__)
@@ -121,6 +122,11 @@ def master_driver_agent(config_path, **kwargs):
         _log.info("maximum concurrent driver publishes limited to " + str(max_concurrent_publishes))
     configure_publish_lock(max_concurrent_publishes)
 
+    # Either 'stagger' to spread scrapes of devices with the same interval
+    # evenly across it or 'clock' to scrape at wall clock multiples of
+    # the interval plus each device's scrape_offset.
+    scrape_alignment = get_config('scrape_alignment', 'stagger')
+
     vip_identity = get_config('vip_identity', 'platform.driver')
     #pop the uuid based id
     kwargs.pop('identity', None)
@@ -130,9 +136,12 @@ def master_driver_agent(config_path, **kwargs):
         def __init__(self, **kwargs):
             super(MasterDriverAgent, self).__init__(**kwargs)
             self.instances = {}
+            self.scheduler = ScrapeScheduler(scrape_alignment)
+            self.vip.rpc.add_stats('scrapes', self.scheduler.stats)
             
         @Core.receiver('onstart')
         def starting(self, sender, **kwargs):
+            self.core.spawn(self.scheduler.run)
             env = os.environ.copy()
             env.pop('AGENT_UUID', None)
             for config_name in driver_config_list:
@@ -155,6 +164,11 @@ def master_driver_agent(config_path, **kwargs):
         def set_point(self, path, point_name, value):
             return self.instances[path].set_point(point_name, value)
         
+        @RPC.export
+        def get_scrape_stats(self):
+            '''Return scrape counts, overruns and durations by device.'''
+            return self.scheduler.stats()
+        
         @RPC.export
         def heart_beat(self):
             _log.debug("sending heartbeat")
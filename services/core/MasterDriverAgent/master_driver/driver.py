@@ -54,6 +54,8 @@
 #}}}
 
 import datetime
+import numbers
+import time
 from volttron.platform.vip.agent import BasicAgent, Core
 from volttron.platform.agent import utils
 from zmq.utils import jsonapi
@@ -105,10 +107,11 @@ class DriverAgent(BasicAgent):
         self.registry_config_name = None
         self.setup_device()
         
-        interval = self.config.get("interval", 60)
-        self.core.periodic(interval, self.periodic_read, wait=None)
-            
         self.all_path_depth, self.all_path_breadth = self.get_paths_for_point(DRIVER_TOPIC_ALL)
+        
+        interval = self.config.get("interval", 60)
+        self.parent.scheduler.add(self.device_name.strip('/'), self, interval,
+                                  self.config.get("scrape_offset"))
 
 
     def setup_device(self):
@@ -125,12 +128,22 @@ class DriverAgent(BasicAgent):
         registry_config = self.get_config(config["registry_config"]) 
         
         self.heart_beat_point = config.get("heart_beat_point") 
+        #Seconds between publishes of the whole device when points
+        #report by exception, 0 to publish it every scrape.
+        self.all_publish_interval = config.get("all_publish_interval", 0)
                            
         self.interface = self.get_interface(driver_type, driver_config, registry_config)
         self.meta_data = {}
+        #Registers of points reporting by exception and the value and
+        #time each was last published.
+        self.exception_registers = {}
+        self.last_published = {}
+        self.next_all_publish = 0
         
         for point in self.interface.get_register_names():
             register = self.interface.get_register_by_name(point)
+            if register.reports_by_exception():
+                self.exception_registers[point] = register
             if register.register_type == 'bit':
                 ts_type = 'boolean'
             else:
@@ -181,42 +194,85 @@ class DriverAgent(BasicAgent):
             headers_mod.DATE: now,
         }
             
+        scrape_time = time.time()
 
+        messages = []
+        published = {}
         for point, value in results.iteritems():
-            topics = self.get_paths_for_point(point)
-            for topic in topics:
-                message = [value, self.meta_data[point]] 
-                self._publish_wrapper(topic, 
-                                      headers=headers, 
-                                      message=message)
-         
-        message = [results, self.meta_data] 
-        self._publish_wrapper(self.all_path_depth, 
-                              headers=headers, 
-                              message=message)
-         
-        self._publish_wrapper(self.all_path_breadth, 
-                              headers=headers, 
-                              message=message)
+            if not self.should_publish(point, value, scrape_time):
+                continue
+            if point in self.exception_registers:
+                published[point] = (value, scrape_time)
+            message = [value, self.meta_data[point]]
+            for topic in self.get_paths_for_point(point):
+                messages.append((topic, headers, message))
+
+        publish_all = scrape_time >= self.next_all_publish
+        if publish_all:
+            message = [results, self.meta_data]
+            messages.append((self.all_path_depth, headers, message))
+            messages.append((self.all_path_breadth, headers, message))
+
+        #Only values that reached the message bus count as published so
+        #points are sent again on the next scrape after a failure.
+        if messages and self._publish_wrapper(messages):
+            self.last_published.update(published)
+            if publish_all:
+                self.next_all_publish = scrape_time + self.all_publish_interval
+        
+    def should_publish(self, point, value, now):
+        """Return True if a point's value should be published.
+        
+        Points without report by exception settings are published on every
+        scrape. The others only when their value leaves the deadband around
+        the last value published or max silence has passed since then.
+        """
+        register = self.exception_registers.get(point)
+        if register is None:
+            return True
+        
+        last = self.last_published.get(point)
+        return (last is None or self._changed(register, last[0], value) or
+                (register.max_silence is not None and 
+                 now - last[1] >= register.max_silence))
+    
+    @staticmethod
+    def _changed(register, last_value, value):
+        numeric = (isinstance(value, numbers.Real) and 
+                   isinstance(last_value, numbers.Real))
+        if not numeric:
+            return value != last_value
+        change = abs(value - last_value)
+        if register.deadband is None and register.percent_deadband is None:
+            return change > 0
+        if register.deadband is not None and change > register.deadband:
+            return True
+        return (register.percent_deadband is not None and 
+                change > abs(last_value) * register.percent_deadband / 100.0)
         
         
-    def _publish_wrapper(self, topic, headers, message):
+    def _publish_wrapper(self, messages):
+        """Publish messages, returning True if the platform accepted them."""
+        # Stamp trace headers once so retries count toward the delay.
+        trace_headers = self.vip.pubsub.trace_headers
+        messages = [(topic, trace_headers(headers), message)
+                    for topic, headers, message in messages]
         while True:
             try:
                 with publish_lock():
-                    self.vip.pubsub.publish('pubsub', 
-                                        topic, 
-                                        headers=headers, 
-                                        message=message).get(timeout=10.0)
+                    self.vip.pubsub.publish_many('pubsub', 
+                                                 messages).get(timeout=10.0)
                                         
             except Again:
-                _log.warn("publish delayed: " + topic + " pubsub is busy")
+                _log.warn("publish delayed: " + self.device_name + 
+                          " pubsub is busy")
                 gevent.sleep(random.random())
             except VIPError as ex:
-                _log.warn("driver failed to publish " + topic + ": " + str(ex))
-                break
+                _log.warn("driver failed to publish " + self.device_name + 
+                          ": " + str(ex))
+                return False
             else:
-                break
+                return True
             
     
     def heart_beat(self):
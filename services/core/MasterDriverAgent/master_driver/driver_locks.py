@@ -99,4 +99,21 @@ def publish_lock():
         yield 
     finally:
         _publish_lock.release()
-    
\ No newline at end of file
+    
+def acquire_socket(blocking=True):
+    '''Take a socket_lock slot to hold across several uses of a socket.
+
+    Returns False if blocking is False and no slot is free. Every slot
+    taken must be given back with release_socket().
+    '''
+    global _socket_lock
+    if _socket_lock is None:
+        raise RuntimeError("socket_lock not configured!")
+    # DummySemaphore.acquire() returns None rather than True.
+    return _socket_lock.acquire(blocking) is not False
+
+def release_socket():
+    global _socket_lock
+    if _socket_lock is None:
+        raise RuntimeError("socket_lock not configured!")
+    _socket_lock.release()
@@ -64,6 +64,31 @@ class BaseRegister(object):
         self.units = units
         self.description = description
         self.python_type = int
+        # Report by exception settings, None when not configured.
+        self.deadband = None
+        self.percent_deadband = None
+        self.max_silence = None
+        
+    def configure_reporting(self, reg_def):
+        """Read the optional report by exception columns of a registry row.
+        
+        A point with any of Deadband, Percent Deadband or Max Silence set is
+        only published when its value moves by more than a deadband from the
+        last published value, or when it has not been published for Max
+        Silence seconds.
+        """
+        def column(name):
+            value = (reg_def.get(name) or '').strip()
+            return float(value) if value else None
+        
+        self.deadband = column('Deadband')
+        self.percent_deadband = column('Percent Deadband')
+        self.max_silence = column('Max Silence')
+        
+    def reports_by_exception(self):
+        return (self.deadband is not None or 
+                self.percent_deadband is not None or
+                self.max_silence is not None)
         
     def get_register_python_type(self):
         return self.python_type
@@ -71,6 +71,11 @@ class Interface(BaseInterface):
         self.parse_config(registry_config_str)         
         self.target_address = config_dict["device_address"]
         self.proxy_address = config_dict.get("proxy_address", "platform.bacnet_proxy")
+        #Serve presentValue and statusFlags from COV notifications
+        # received by the proxy, polling only the points it has none for.
+        self.use_cov = config_dict.get("use_cov", False)
+        self.cov_lifetime = config_dict.get("cov_lifetime", 300)
+        self.cov_confirmed = config_dict.get("cov_confirmed", False)
         self.ping_target(self.target_address)
                                          
     def ping_target(self, address):    
@@ -108,7 +113,12 @@ class Interface(BaseInterface):
                                               register.instance_number, 
                                               register.property]
         
-        result = self.vip.rpc.call(self.proxy_address, 'read_properties', 
+        if self.use_cov:
+            result = self.vip.rpc.call(self.proxy_address, 'read_cov_properties', 
+                                       self.target_address, point_map, 
+                                       self.cov_lifetime, self.cov_confirmed).get(timeout=10.0)
+        else:
+            result = self.vip.rpc.call(self.proxy_address, 'read_properties', 
                                        self.target_address, point_map).get(timeout=10.0)
         return result
     
@@ -140,5 +150,6 @@ class Interface(BaseInterface):
                                 point_name,
                                 units, 
                                 description = description)
+            register.configure_reporting(regDef)
                 
             self.insert_register(register)
@@ -67,15 +67,238 @@ import logging
 from csv import DictReader
 from StringIO import StringIO
 import os.path
+from collections import deque
+from itertools import izip
+from operator import itemgetter
+import select
+import socket
+import time
 
-from contextlib import contextmanager, closing
-from master_driver.driver_locks import socket_lock
+import gevent
+import gevent.event
+from contextlib import contextmanager
+from master_driver.driver_locks import acquire_socket, release_socket
+
+
+class ModbusEndpoint(object):
+    '''Request queue for one Modbus TCP endpoint, such as a gateway.
+    
+    At most concurrency devices at the endpoint are worked with at a
+    time; others wait their turn in order. Requests are spaced by at
+    least delay seconds from the end of the previous one, which serial
+    gateways often need. Different endpoints are independent, so they
+    are scraped in parallel.
+    '''
+    def __init__(self, address, port, concurrency=1, delay=0):
+        self.address = address
+        self.port = port
+        self.concurrency = concurrency
+        self.delay = delay
+        self._configured = False
+        self._active = 0
+        self._waiters = deque()
+        self._next_request = 0
+        
+    def configure(self, concurrency, delay):
+        '''Apply a device's settings; the strictest of all devices win.'''
+        if concurrency < 1:
+            raise ValueError("endpoint concurrency must be at least 1")
+        if not self._configured:
+            self._configured = True
+            self.concurrency, self.delay = concurrency, delay
+            return
+        if (concurrency, delay) != (self.concurrency, self.delay):
+            _log.info("devices at " + self.address + ":" + str(self.port) +
+                      " have differing request settings; using the strictest")
+        self.concurrency = min(self.concurrency, concurrency)
+        self.delay = max(self.delay, delay)
+        
+    @contextmanager
+    def turn(self):
+        '''Wait for, then hold, one of the endpoint's concurrency slots.'''
+        self._acquire()
+        try:
+            yield
+        finally:
+            self._release()
+            
+    def _acquire(self):
+        if self._active < self.concurrency:
+            self._active += 1
+            return
+        waiter = gevent.event.Event()
+        self._waiters.append(waiter)
+        try:
+            waiter.wait()
+        except:
+            # The slot may have been handed over just before we died.
+            if waiter.is_set():
+                self._release()
+            else:
+                self._waiters.remove(waiter)
+            raise
+            
+    def _release(self):
+        if self._waiters:
+            # Hand the slot straight to the next in line.
+            self._waiters.popleft().set()
+        else:
+            self._active -= 1
+            
+    def pace(self):
+        '''Sleep until the endpoint is ready for another request.'''
+        now = time.time()
+        start = max(now, self._next_request)
+        self._next_request = start + self.delay
+        if start > now:
+            gevent.sleep(start - now)
+            
+    def paced(self):
+        '''Note the end of a request, from which delay is counted.'''
+        self._next_request = max(self._next_request, time.time() + self.delay)
+        
+        
+_endpoints = {}
+
+def get_endpoint(address, port):
+    try:
+        return _endpoints[address, port]
+    except KeyError:
+        endpoint = _endpoints[address, port] = ModbusEndpoint(address, port)
+        return endpoint
+        
+        
+class ModbusClient(SyncModbusClient):
+    '''Client pacing its requests as set for its endpoint.'''
+    def __init__(self, address, port, **kwargs):
+        super(ModbusClient, self).__init__(address, port, **kwargs)
+        self.endpoint = get_endpoint(address, port)
+        
+    def execute(self, request=None):
+        self.endpoint.pace()
+        try:
+            return super(ModbusClient, self).execute(request)
+        finally:
+            self.endpoint.paced()
+
+
+class ModbusClientPool(object):
+    '''Idle Modbus TCP connections kept open for reuse.
+
+    Connections are keyed by (address, port) only, so devices with
+    different slave IDs behind the same gateway share them. Every open
+    connection, idle or not, holds a socket_lock slot; when none is free
+    the least recently used idle connection is closed to make room, and
+    while anyone waits for a slot connections are closed rather than
+    kept idle. Idle connections are closed after idle_timeout seconds and checked
+    for a hangup by the device before being reused.
+    '''
+
+    idle_timeout = 60
+
+    def __init__(self):
+        self._idle = {}
+        self._last_sweep = time.time()
+        # Callers blocked waiting for a socket_lock slot.
+        self._waiting = 0
+
+    def get(self, address, port):
+        '''Return a client connected, or about to connect, to the device.
+
+        The client's pool_reused attribute is True if it was open before.
+        '''
+        idle = self._idle.get((address, port))
+        while idle:
+            client, last_used = idle.pop()
+            if (time.time() - last_used < self.idle_timeout and
+                    self._healthy(client)):
+                client.pool_reused = True
+                return client
+            self._close(client)
+        while not acquire_socket(blocking=False):
+            if not self._close_oldest():
+                # Every slot is in use; the next put() frees one.
+                self._waiting += 1
+                try:
+                    acquire_socket()
+                finally:
+                    self._waiting -= 1
+                break
+        client = ModbusClient(address, port)
+        client.pool_reused = False
+        return client
+
+    def put(self, client):
+        '''Return a client that completed its requests to the pool.'''
+        if self._waiting:
+            # Give its slot to a connection that is waiting for one.
+            self._close(client)
+            self._sweep()
+            return
+        key = (client.host, client.port)
+        self._idle.setdefault(key, []).append((client, time.time()))
+        self._sweep()
+
+    def discard(self, client):
+        '''Close a client that failed rather than returning it.'''
+        self._close(client)
+        self._sweep()
+
+    def _close(self, client):
+        try:
+            client.close()
+        finally:
+            release_socket()
+
+    def _close_oldest(self):
+        oldest = None
+        for key, idle in self._idle.iteritems():
+            if idle and (oldest is None or idle[0][1] < oldest[1]):
+                oldest = key, idle[0][1]
+        if oldest is None:
+            return False
+        client, _ = self._idle[oldest[0]].pop(0)
+        self._close(client)
+        return True
+
+    def _sweep(self):
+        now = time.time()
+        if now - self._last_sweep < self.idle_timeout / 2.0:
+            return
+        self._last_sweep = now
+        for key, idle in self._idle.items():
+            while idle and now - idle[0][1] >= self.idle_timeout:
+                client, _ = idle.pop(0)
+                self._close(client)
+            if not idle:
+                del self._idle[key]
+
+    @staticmethod
+    def _healthy(client):
+        # An idle connection should have nothing to read; if it does,
+        # the device either hung up or sent data nobody asked for.
+        sock = client.socket
+        if sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+
+_client_pool = ModbusClientPool()
 
 @contextmanager
 def modbus_client(address, port):
-    with socket_lock():
-        with closing(SyncModbusClient(address, port)) as client:
-            yield client
+    client = _client_pool.get(address, port)
+    try:
+        yield client
+    except:
+        _client_pool.discard(client)
+        raise
+    else:
+        _client_pool.put(client)
 
 modbus_logger = logging.getLogger("pymodbus")
 modbus_logger.setLevel(logging.WARNING)
@@ -85,6 +308,8 @@ _log = logging.getLogger(__name__)
 
 MODBUS_REGISTER_SIZE = 2
 MODBUS_READ_MAX = 100
+# Unused registers or bits worth reading to save a request.
+MODBUS_READ_GAP = 16
 PYMODBUS_REGISTER_STRUCT = struct.Struct('>H')
 
 path = os.path.dirname(os.path.abspath(__file__))
@@ -107,11 +332,6 @@ class ModbusBitRegister(ModbusRegisterBase):
         
         self.python_type = bool
     
-    def parse_value(self, starting_address, bit_stream):
-        #find the bytes we care about
-        index = (self.address - starting_address)        
-        return bit_stream[index]
-    
     def get_register_count(self):
         return 1
     
@@ -151,17 +371,6 @@ class ModbusByteRegister(ModbusRegisterBase):
     def get_register_count(self):        
         return self.parse_struct.size // MODBUS_REGISTER_SIZE
     
-    def parse_value(self, starting_address, byte_stream):
-        #find the bytes we care about
-        index = (self.address - starting_address) * 2
-        width = self.parse_struct.size
-        
-        target_bytes = byte_stream[index:index+width]
-        if len(target_bytes) < width:
-            raise ValueError('Not enough data to parse')
-        
-        return self.parse_struct.unpack(target_bytes)[0]
-    
    
     def get_state(self, client):
         if self.read_only:
@@ -184,126 +393,206 @@ class ModbusByteRegister(ModbusRegisterBase):
             return self.get_state(client)
         return None
     
+
+class ModbusReadBlock(object):
+    '''A single read request covering the registers of a block.
+    
+    compile() prepares the block to decode every register of a response
+    in one call: a single struct.Struct with pad bytes over the gaps for
+    registers, or an itemgetter of the wanted indexes for bits.
+    '''
+    def __init__(self, start, count, registers):
+        self.start = start
+        self.count = count
+        self.registers = registers
+        self.point_names = None
+        self.layout = None
+        self.getter = None
+        
+    def compile(self):
+        self.point_names = [register.point_name for register in self.registers]
+        if self.registers[0].register_type == 'bit':
+            indexes = [register.address - self.start for register in self.registers]
+            getter = itemgetter(*indexes)
+            # itemgetter returns a bare item, not a tuple, for one index.
+            self.getter = getter if len(indexes) > 1 else lambda bits: (getter(bits),)
+        else:
+            self.layout = self.compile_layout()
+            
+    def compile_layout(self):
+        '''Return a struct.Struct for all registers, or None if there is none.
+        
+        Registers must share an explicit byte order, as native order
+        adds alignment padding, and must not overlap.
+        '''
+        byte_order = None
+        fields = []
+        position = self.start
+        for register in self.registers:
+            fmt = register.parse_struct.format
+            if fmt[:1] not in '<>!=':
+                return None
+            if byte_order is None:
+                byte_order = fmt[0]
+            elif fmt[0] != byte_order:
+                return None
+            if register.address < position:
+                return None
+            gap = (register.address - position) * MODBUS_REGISTER_SIZE
+            if gap:
+                fields.append('{}x'.format(gap))
+            fields.append(fmt[1:])
+            position = register.address + register.get_register_count()
+        return struct.Struct(byte_order + ''.join(fields))
+        
+    def decode(self, data, offset=0):
+        '''Return (point name, value) pairs from a block's response data.'''
+        if self.getter is not None:
+            return izip(self.point_names, self.getter(data))
+        try:
+            if self.layout is not None:
+                return izip(self.point_names, self.layout.unpack_from(data, offset))
+            return [(register.point_name,
+                     register.parse_struct.unpack_from(
+                         data, offset + (register.address - self.start) * MODBUS_REGISTER_SIZE)[0])
+                    for register in self.registers]
+        except struct.error:
+            raise ModbusInterfaceException("Not enough data to parse")
+        
+        
+def plan_reads(registers, max_count=MODBUS_READ_MAX, max_gap=MODBUS_READ_GAP):
+    '''Group registers of one type into as few reads as possible.
+    
+    Registers are read together while the unused addresses between them
+    number at most max_gap and the read spans at most max_count
+    addresses. A register wider than max_count is read on its own.
+    '''
+    blocks = []
+    block = None
+    for register in sorted(registers, key=lambda r: r.address):
+        start = register.address
+        end = start + register.get_register_count()
+        if (block is not None and start - (block.start + block.count) <= max_gap and
+                end - block.start <= max_count):
+            block.count = max(block.count, end - block.start)
+            block.registers.append(register)
+        else:
+            block = ModbusReadBlock(start, end - start, [register])
+            blocks.append(block)
+    return blocks
+        
         
 class Interface(BaseInterface):
     def __init__(self, **kwargs):
         super(Interface, self).__init__(**kwargs)
-        self.build_ranges_map()
+        self.read_plan = {}
         
     def configure(self, config_dict, registry_config_str):
         self.slave_id=config_dict.get("slave_id", 0)
         self.ip_address = config_dict["device_address"]
         self.port = config_dict.get("port", Defaults.Port)
+        #Devices sharing an address and port, such as meters behind a
+        #serial gateway, share these request limits.
+        self.endpoint = get_endpoint(self.ip_address, self.port)
+        self.endpoint.configure(config_dict.get("endpoint_concurrency", 1),
+                                config_dict.get("request_delay", 0))
+        #Device limits on a single read, for registers and for coils and inputs.
+        self.read_limits = {
+            'byte': (config_dict.get("max_registers_per_read", MODBUS_READ_MAX),
+                     config_dict.get("max_register_gap", MODBUS_READ_GAP)),
+            'bit': (config_dict.get("max_bits_per_read", MODBUS_READ_MAX),
+                    config_dict.get("max_bit_gap", MODBUS_READ_GAP)),
+        }
         self.parse_config(registry_config_str) 
+        self.build_read_plan()
         
-    def build_ranges_map(self):
-        self.register_ranges = {('byte',True):[None,None],
-                                ('byte',False):[None,None],
-                                ('bit',True):[None,None],
-                                ('bit',False):[None,None]}
-        
-    def insert_register(self, register):
-        super(Interface, self).insert_register(register)
-        
-        register_type = register.get_register_type()
-        
-        register_range = self.register_ranges[register_type]    
-        register_count = register.get_register_count()
-        
-        start, end = register.address, register.address + register_count - 1
-        
-        if register_range[0] is None:
-            register_range[:] = start, end            
-        else:
-            if register_range[0] > start:
-                register_range[0] = start
-            if register_range[1] < end:
-                register_range[1] = end        
+    def build_read_plan(self):
+        '''Plan the reads of each function code used by scrape_all.'''
+        self.read_plan = {}
+        for (register_type, read_only), registers in self.registers.iteritems():
+            max_count, max_gap = self.read_limits[register_type]
+            blocks = plan_reads(registers, max_count, max_gap)
+            for block in blocks:
+                block.compile()
+            self.read_plan[register_type, read_only] = blocks
+            
+    def execute(self, func, args=(), retry=False):
+        '''Call func(client, *args) with a pooled client for the device.
+
+        The call waits its turn at the device's endpoint. A connection
+        taken from the pool may have been dropped by the device since it
+        was last used; if retry is True the call is then made once more
+        on a new connection. Only reads may be retried, as a failed write
+        may still have reached the device.
+        '''
+        with self.endpoint.turn():
+            while True:
+                client = None
+                try:
+                    with modbus_client(self.ip_address, self.port) as client:
+                        return func(client, *args)
+                except (ConnectionException, ModbusIOException, socket.error):
+                    if not retry or client is None or not client.pool_reused:
+                        raise
+                    _log.debug("reconnecting to " + self.ip_address + ":" +
+                               str(self.port))
         
     def get_point(self, point_name):    
         register = self.get_register_by_name(point_name)
-        with modbus_client(self.ip_address, self.port) as client:
-            try:
-                result = register.get_state(client)
-            except (ConnectionException, ModbusIOException, ModbusInterfaceException):
-                result = None
+        try:
+            result = self.execute(register.get_state, retry=True)
+        except (ConnectionException, ModbusIOException, ModbusInterfaceException, socket.error):
+            result = None
         return result
     
     def set_point(self, point_name, value):    
         register = self.get_register_by_name(point_name)
-        with modbus_client(self.ip_address, self.port) as client:
-            try:
-                result = register.set_state(client, value)
-            except (ConnectionException, ModbusIOException, ModbusInterfaceException):
-                result = None
+        try:
+            result = self.execute(register.set_state, (value,))
+        except (ConnectionException, ModbusIOException, ModbusInterfaceException, socket.error):
+            result = None
         return result
     
     def scrape_byte_registers(self, client, read_only):
         result_dict = {}
-        start, end = self.register_ranges[('byte',read_only)]
-        registers = self.registers[('byte',read_only)]
-        
-        if not registers:
-            return result_dict
         
-        result = ''
-        
-        for group in xrange(start, end + 1, MODBUS_READ_MAX):
-            count = min(end - group + 1, MODBUS_READ_MAX)            
-            response = client.read_input_registers(group, count, unit=self.slave_id) if read_only else client.read_holding_registers(group, count, unit=self.slave_id)
+        for block in self.read_plan[('byte',read_only)]:
+            response = client.read_input_registers(block.start, block.count, unit=self.slave_id) if read_only else client.read_holding_registers(block.start, block.count, unit=self.slave_id)
             if response is None:
                 raise ModbusInterfaceException("pymodbus returned None")
-            response_bytes = response.encode()
-            result += response_bytes[1:]
-            
-        for register in registers:
-            point = register.point_name
-            value = register.parse_value(start, result)
-            result_dict[point] = value
+            #skip the result count
+            result_dict.update(block.decode(response.encode(), 1))
             
         return result_dict
     
     def scrape_bit_registers(self, client, read_only):
         result_dict = {}
-        start, end = self.register_ranges[('bit',read_only)]
-        registers = self.registers[('bit',read_only)]
         
-        if not registers:
-            return result_dict
-        
-        result = []
-        
-        for group in xrange(start, end + 1, MODBUS_READ_MAX):
-            count = min(end - group + 1, MODBUS_READ_MAX)            
-            response = client.read_discrete_inputs(group, count, unit=self.slave_id) if read_only else client.read_coils(group, count, unit=self.slave_id)
+        for block in self.read_plan[('bit',read_only)]:
+            response = client.read_discrete_inputs(block.start, block.count, unit=self.slave_id) if read_only else client.read_coils(block.start, block.count, unit=self.slave_id)
             if response is None:
                 raise ModbusInterfaceException("pymodbus returned None")
-            result += response.bits
-            
-        for register in registers:
-            point = register.point_name
-            value = register.parse_value(start, result)
-            result_dict[point] = value
+            result_dict.update(block.decode(response.bits))
             
         return result_dict
         
-    def scrape_all(self):
+    def scrape_registers(self, client):
         result_dict={}
-        with modbus_client(self.ip_address, self.port) as client:
-            try:
-                
-                result_dict.update(self.scrape_byte_registers(client, True))
-                result_dict.update(self.scrape_byte_registers(client, False))
-                
-                result_dict.update(self.scrape_bit_registers(client, True))
-                result_dict.update(self.scrape_bit_registers(client, False))
-            except (ConnectionException, ModbusIOException, ModbusInterfaceException) as e:
-                _log.error ("Failed to scrape device at " + 
-                           self.ip_address + ":" + str(self.port) + " " + 
-                           "ID: " + str(self.slave_id) + str(e))
-                return None
+        result_dict.update(self.scrape_byte_registers(client, True))
+        result_dict.update(self.scrape_byte_registers(client, False))
         
+        result_dict.update(self.scrape_bit_registers(client, True))
+        result_dict.update(self.scrape_bit_registers(client, False))
         return result_dict
+        
+    def scrape_all(self):
+        try:
+            return self.execute(self.scrape_registers, retry=True)
+        except (ConnectionException, ModbusIOException, ModbusInterfaceException, socket.error) as e:
+            _log.error ("Failed to scrape device at " + 
+                       self.ip_address + ":" + str(self.port) + " " + 
+                       "ID: " + str(self.slave_id) + str(e))
+            return None
     
     def parse_config(self, config_string):
         f = StringIO(config_string)
@@ -324,5 +613,6 @@ class Interface(BaseInterface):
                         
             klass = ModbusBitRegister if bit_register else ModbusByteRegister
             register = klass(address, io_type, point_path, units, read_only, description = description, slave_id=self.slave_id)
+            register.configure_reporting(regDef)
                 
             self.insert_register(register)
@@ -0,0 +1,447 @@
+'''
+Copyright (c) 2015, Battelle Memorial Institute
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met: 
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer. 
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution. 
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies, 
+either expressed or implied, of the FreeBSD Project.
+'''
+
+'''
+This material was prepared as an account of work sponsored by an 
+agency of the United States Government.  Neither the United States 
+Government nor the United States Department of Energy, nor Battelle,
+nor any of their employees, nor any jurisdiction or organization 
+that has cooperated in the development of these materials, makes 
+any warranty, express or implied, or assumes any legal liability 
+or responsibility for the accuracy, completeness, or usefulness or 
+any information, apparatus, product, software, or process disclosed,
+or represents that its use would not infringe privately owned rights.
+
+Reference herein to any specific commercial product, process, or 
+service by trade name, trademark, manufacturer, or otherwise does 
+not necessarily constitute or imply its endorsement, recommendation, 
+r favoring by the United States Government or any agency thereof, 
+or Battelle Memorial Institute. The views and opinions of authors 
+expressed herein do not necessarily state or reflect those of the 
+United States Government or any agency thereof.
+
+PACIFIC NORTHWEST NATIONAL LABORATORY
+operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+under Contract DE-AC05-76RL01830
+'''
+
+import socket
+import struct
+import unittest
+
+import gevent
+from gevent.lock import BoundedSemaphore
+from pymodbus.exceptions import ConnectionException
+
+from master_driver import driver_locks
+from master_driver.interfaces import modbus
+from master_driver.interfaces.modbus import (Interface, ModbusBitRegister,
+                                             ModbusByteRegister,
+                                             ModbusClientPool,
+                                             ModbusEndpoint,
+                                             ModbusInterfaceException,
+                                             get_endpoint, plan_reads)
+
+
+def byte_register(address, type_string='>H', name=None):
+    return ModbusByteRegister(address, type_string, name or str(address),
+                              '', False)
+
+def bit_register(address, name=None):
+    return ModbusBitRegister(address, 'BOOL', name or str(address), '', False)
+
+
+class PlanReadsTests(unittest.TestCase):
+    # (description, registers as (address, type), max_count, max_gap,
+    #  expected reads as (start, count, addresses))
+    cases = [
+        ('single register',
+         [(10, '>H')], 100, 16,
+         [(10, 1, [10])]),
+        ('adjacent registers',
+         [(0, '>H'), (1, '>f'), (3, '>H')], 100, 16,
+         [(0, 4, [0, 1, 3])]),
+        ('unsorted input',
+         [(3, '>H'), (0, '>H'), (1, '>f')], 100, 16,
+         [(0, 4, [0, 1, 3])]),
+        ('gap at the limit is merged',
+         [(0, '>H'), (17, '>H')], 100, 16,
+         [(0, 18, [0, 17])]),
+        ('gap past the limit splits',
+         [(0, '>H'), (18, '>H')], 100, 16,
+         [(0, 1, [0]), (18, 1, [18])]),
+        ('no gaps allowed',
+         [(0, '>H'), (2, '>H'), (3, '>H')], 100, 0,
+         [(0, 1, [0]), (2, 2, [2, 3])]),
+        ('count limit splits',
+         [(0, '>H'), (5, '>H'), (9, '>f')], 10, 16,
+         [(0, 6, [0, 5]), (9, 2, [9])]),
+        ('read ends exactly at the count limit',
+         [(0, '>H'), (8, '>f')], 10, 16,
+         [(0, 10, [0, 8])]),
+        ('wide register overflowing a read starts a new one',
+         [(0, '>H'), (1, '>d')], 4, 16,
+         [(0, 1, [0]), (1, 4, [1])]),
+        ('overlapping registers',
+         [(0, '>f'), (1, '>H')], 100, 16,
+         [(0, 2, [0, 1])]),
+    ]
+
+    def test_plan_reads(self):
+        for description, specs, max_count, max_gap, expected in self.cases:
+            registers = [byte_register(address, type_string)
+                         for address, type_string in specs]
+            blocks = plan_reads(registers, max_count, max_gap)
+            actual = [(block.start, block.count,
+                       [register.address for register in block.registers])
+                      for block in blocks]
+            self.assertEqual(actual, expected, description)
+
+    def test_plan_bits(self):
+        registers = [bit_register(address) for address in (0, 3, 40, 41)]
+        actual = [(block.start, block.count)
+                  for block in plan_reads(registers, 2000, 16)]
+        self.assertEqual(actual, [(0, 4), (40, 2)])
+
+
+class DecodeTests(unittest.TestCase):
+    # (description, registers as (address, type, value), whether the
+    #  block decodes with a single struct)
+    cases = [
+        ('mixed big endian types',
+         [(0, '>H', 513), (1, '>f', 1.5), (3, '>i', -70000), (5, '>h', -2)],
+         True),
+        ('gaps between registers',
+         [(2, '>H', 7), (10, '>f', -0.25), (30, '>Q', 2 ** 40)],
+         True),
+        ('little endian',
+         [(0, '<H', 1), (1, '<d', 2.5)],
+         True),
+        ('network order',
+         [(0, '!H', 1), (4, '!I', 123456)],
+         True),
+        ('mixed byte orders fall back',
+         [(0, '>H', 1), (1, '<H', 2)],
+         False),
+        ('native order falls back',
+         [(0, 'H', 3), (1, 'f', 0.5)],
+         False),
+        ('overlapping registers fall back',
+         [(0, '>I', 65536 * 5 + 6), (1, '>H', 6)],
+         False),
+    ]
+
+    def encode(self, start, count, specs):
+        data = bytearray(count * 2)
+        for address, type_string, value in specs:
+            packed = struct.pack(type_string, value)
+            offset = (address - start) * 2
+            data[offset:offset + len(packed)] = packed
+        return bytes(data)
+
+    def test_decode(self):
+        for description, specs, compiled in self.cases:
+            registers = [byte_register(address, type_string)
+                         for address, type_string, _ in specs]
+            block, = plan_reads(registers, 100, 100)
+            block.compile()
+            self.assertEqual(block.layout is not None, compiled, description)
+            data = self.encode(block.start, block.count, specs)
+            expected = dict((str(address), value)
+                            for address, _, value in specs)
+            self.assertEqual(dict(block.decode(data)), expected, description)
+            # Data may follow a header, such as the byte count of a
+            # pymodbus response.
+            self.assertEqual(dict(block.decode(b'\x07' + data, 1)), expected,
+                             description)
+
+    def test_decode_short_data(self):
+        for compiled in (True, False):
+            type_string = '>f' if compiled else 'f'
+            block, = plan_reads([byte_register(0, type_string)], 100, 16)
+            block.compile()
+            self.assertRaises(ModbusInterfaceException, block.decode, b'\x00')
+
+    def test_decode_bits(self):
+        for addresses in ([5], [0, 2, 3], [1, 20]):
+            registers = [bit_register(address) for address in addresses]
+            block, = plan_reads(registers, 2000, 100)
+            block.compile()
+            bits = [False] * (block.count + 8)
+            for address in addresses[::2]:
+                bits[address - block.start] = True
+            expected = dict((str(address), i % 2 == 0)
+                            for i, address in enumerate(addresses))
+            self.assertEqual(dict(block.decode(bits)), expected)
+
+
+class SocketLockTestCase(unittest.TestCase):
+    max_connections = 2
+
+    def setUp(self):
+        self.saved_lock = driver_locks._socket_lock
+        self.lock = driver_locks._socket_lock = BoundedSemaphore(
+            self.max_connections)
+
+    def tearDown(self):
+        driver_locks._socket_lock = self.saved_lock
+
+    def slots_in_use(self):
+        return self.max_connections - self.lock.counter
+
+
+class ClientPoolTests(SocketLockTestCase):
+    def setUp(self):
+        super(ClientPoolTests, self).setUp()
+        self.pool = ModbusClientPool()
+        self.peers = []
+
+    def tearDown(self):
+        for peer in self.peers:
+            peer.close()
+        super(ClientPoolTests, self).tearDown()
+
+    def connect(self, client):
+        # Stand in for a device with one end of a socket pair.
+        client.socket, peer = socket.socketpair()
+        self.peers.append(peer)
+        return peer
+
+    def test_checkout_checkin(self):
+        client = self.pool.get('10.0.0.1', 502)
+        self.assertFalse(client.pool_reused)
+        self.assertEqual(self.slots_in_use(), 1)
+        self.connect(client)
+        self.pool.put(client)
+        # Idle connections keep their slot.
+        self.assertEqual(self.slots_in_use(), 1)
+        reused = self.pool.get('10.0.0.1', 502)
+        self.assertIs(reused, client)
+        self.assertTrue(reused.pool_reused)
+        other = self.pool.get('10.0.0.1', 503)
+        self.assertIsNot(other, client)
+        self.assertEqual(self.slots_in_use(), 2)
+        self.pool.discard(other)
+        self.pool.discard(client)
+        self.assertEqual(self.slots_in_use(), 0)
+        self.assertIsNone(client.socket)
+
+    def test_hangup_not_reused(self):
+        client = self.pool.get('10.0.0.1', 502)
+        peer = self.connect(client)
+        self.pool.put(client)
+        peer.close()
+        replacement = self.pool.get('10.0.0.1', 502)
+        self.assertIsNot(replacement, client)
+        self.assertFalse(replacement.pool_reused)
+        self.assertIsNone(client.socket)
+        self.assertEqual(self.slots_in_use(), 1)
+
+    def test_idle_timeout(self):
+        client = self.pool.get('10.0.0.1', 502)
+        self.connect(client)
+        self.pool.put(client)
+        self.pool._idle['10.0.0.1', 502][0] = (client, 0)
+        self.assertIsNot(self.pool.get('10.0.0.1', 502), client)
+        self.assertEqual(self.slots_in_use(), 1)
+
+    def test_oldest_idle_closed_for_slot(self):
+        first = self.pool.get('10.0.0.1', 502)
+        second = self.pool.get('10.0.0.2', 502)
+        self.connect(first)
+        self.connect(second)
+        self.pool.put(first)
+        self.pool.put(second)
+        third = self.pool.get('10.0.0.3', 502)
+        self.assertFalse(third.pool_reused)
+        self.assertIsNone(first.socket)
+        self.assertIsNotNone(second.socket)
+        self.assertEqual(self.slots_in_use(), 2)
+
+    def test_put_hands_slot_to_waiter(self):
+        clients = [self.pool.get('10.0.0.1', 502),
+                   self.pool.get('10.0.0.2', 502)]
+        for client in clients:
+            self.connect(client)
+        waiter = gevent.spawn(self.pool.get, '10.0.0.3', 502)
+        gevent.sleep(0)
+        self.assertFalse(waiter.ready())
+        self.assertEqual(self.pool._waiting, 1)
+        # The returned connection is closed rather than kept idle.
+        self.pool.put(clients[0])
+        client = waiter.get(timeout=1)
+        self.assertEqual((client.host, client.port), ('10.0.0.3', 502))
+        self.assertIsNone(clients[0].socket)
+        self.assertEqual(self.pool._waiting, 0)
+        self.assertEqual(self.pool._idle, {})
+        # With nobody waiting connections are kept again.
+        self.pool.put(clients[1])
+        self.assertEqual(len(self.pool._idle['10.0.0.2', 502]), 1)
+        self.assertEqual(self.slots_in_use(), 2)
+
+
+class FakeClient(object):
+    def __init__(self, pool_reused):
+        self.pool_reused = pool_reused
+
+
+class FakePool(object):
+    def __init__(self):
+        self.given = []
+        self.discarded = []
+
+    def get(self, address, port):
+        client = FakeClient(not self.given)
+        self.given.append(client)
+        return client
+
+    def put(self, client):
+        pass
+
+    def discard(self, client):
+        self.discarded.append(client)
+
+
+class ExecuteTests(unittest.TestCase):
+    def setUp(self):
+        self.saved_pool = modbus._client_pool
+        self.pool = modbus._client_pool = FakePool()
+        self.interface = Interface()
+        self.interface.ip_address, self.interface.port = '10.0.0.1', 502
+        self.interface.endpoint = ModbusEndpoint('10.0.0.1', 502)
+        self.calls = []
+
+    def tearDown(self):
+        modbus._client_pool = self.saved_pool
+
+    def stale_once(self, client, value):
+        self.calls.append((client, value))
+        if client.pool_reused:
+            raise ConnectionException('connection reset')
+        return value
+
+    def test_read_retried_on_new_connection(self):
+        result = self.interface.execute(self.stale_once, (5,), retry=True)
+        self.assertEqual(result, 5)
+        self.assertEqual([client.pool_reused for client, _ in self.calls],
+                         [True, False])
+        self.assertEqual(self.pool.discarded, [self.pool.given[0]])
+
+    def test_write_not_retried(self):
+        self.assertRaises(ConnectionException, self.interface.execute,
+                          self.stale_once, (5,))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_new_connection_not_retried(self):
+        def fail(client):
+            self.calls.append(client)
+            raise ConnectionException('refused')
+        # Make the next client a new connection.
+        self.pool.given.append(None)
+        self.assertRaises(ConnectionException, self.interface.execute, fail,
+                          retry=True)
+        self.assertEqual(len(self.calls), 1)
+
+
+class EndpointTests(unittest.TestCase):
+    def setUp(self):
+        self.saved_pool = modbus._client_pool
+        modbus._client_pool = FakePool()
+        self.active = {}
+        self.overlaps = {}
+        self.order = []
+        self.most_active = 0
+
+    def tearDown(self):
+        modbus._client_pool = self.saved_pool
+        modbus._endpoints.pop(('endpoint-test-1', 502), None)
+        modbus._endpoints.pop(('endpoint-test-2', 502), None)
+
+    def interface(self, address, concurrency=1):
+        interface = Interface()
+        interface.ip_address, interface.port = address, 502
+        interface.endpoint = get_endpoint(address, 502)
+        interface.endpoint.configure(concurrency, 0)
+        return interface
+
+    def request(self, client, interface, name):
+        address = interface.ip_address
+        self.active[address] = self.active.get(address, 0) + 1
+        self.overlaps[address] = max(self.overlaps.get(address, 0),
+                                     self.active[address])
+        self.most_active = max(self.most_active, sum(self.active.values()))
+        self.order.append(name)
+        gevent.sleep(0.01)
+        self.active[address] -= 1
+
+    def run_requests(self, requests):
+        greenlets = [gevent.spawn(interface.execute, self.request,
+                                  (interface, name))
+                     for interface, name in requests]
+        gevent.joinall(greenlets, timeout=5, raise_error=True)
+
+    def test_shared_endpoint_serialized(self):
+        first = self.interface('endpoint-test-1')
+        second = self.interface('endpoint-test-1')
+        self.assertIs(first.endpoint, second.endpoint)
+        self.run_requests([(first, 'a'), (second, 'b'),
+                           (first, 'c'), (second, 'd')])
+        self.assertEqual(self.overlaps, {'endpoint-test-1': 1})
+        # Waiting requests take their turns in order.
+        self.assertEqual(self.order, ['a', 'b', 'c', 'd'])
+
+    def test_endpoint_concurrency(self):
+        first = self.interface('endpoint-test-1', 2)
+        second = self.interface('endpoint-test-1', 3)
+        # The strictest setting of the devices sharing it wins.
+        self.assertEqual(first.endpoint.concurrency, 2)
+        self.run_requests([(first, 'a'), (second, 'b'), (first, 'c')])
+        self.assertEqual(self.overlaps, {'endpoint-test-1': 2})
+
+    def test_endpoints_independent(self):
+        first = self.interface('endpoint-test-1')
+        second = self.interface('endpoint-test-2')
+        self.run_requests([(first, 'a'), (second, 'b')])
+        self.assertEqual(self.overlaps, {'endpoint-test-1': 1,
+                                         'endpoint-test-2': 1})
+        # Both requests ran at once rather than one after the other.
+        self.assertEqual(self.most_active, 2)
+
+    def test_killed_waiter_gives_up_turn(self):
+        endpoint = ModbusEndpoint('endpoint-test-1', 502)
+        with endpoint.turn():
+            waiter = gevent.spawn(endpoint._acquire)
+            gevent.sleep(0)
+            waiter.kill()
+        self.assertEqual(endpoint._active, 0)
+        self.assertEqual(len(endpoint._waiters), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
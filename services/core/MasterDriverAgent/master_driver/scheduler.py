@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# r favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+
+#}}}
+
+'''Central scheduler spreading device scrapes over their intervals.
+
+Devices sharing an interval are either staggered evenly across it or,
+when aligned to the clock, scraped at wall clock multiples of the
+interval plus a per-device offset. A single greenlet waits for the next
+due scrape and runs each in its own greenlet, so a slow device delays
+no other. A scrape that comes due while the previous scrape of the same
+device is still running is skipped and counted as an overrun.
+'''
+
+import heapq
+import logging
+import time
+
+import gevent
+import gevent.event
+
+from volttron.platform.vip.metrics import Histogram
+
+_log = logging.getLogger(__name__)
+
+STAGGER = 'stagger'
+CLOCK = 'clock'
+
+
+class _Device(object):
+    def __init__(self, driver, interval, offset):
+        self.driver = driver
+        self.interval = interval
+        self.offset = offset
+        self.due = None
+        self.greenlet = None
+        self.scrapes = 0
+        self.overruns = 0
+        self.last_scrape = None
+        self.last_duration = None
+        self.durations = Histogram()
+        self.lateness = Histogram()
+
+    def stats(self):
+        return {'interval': self.interval, 'offset': self.offset,
+                'scrapes': self.scrapes, 'overruns': self.overruns,
+                'last_scrape': self.last_scrape,
+                'last_duration': self.last_duration,
+                'duration': self.durations.snapshot(),
+                'lateness': self.lateness.snapshot()}
+
+
+class ScrapeScheduler(object):
+    def __init__(self, alignment=STAGGER):
+        if alignment not in (STAGGER, CLOCK):
+            raise ValueError('invalid scrape alignment: {!r}'.format(alignment))
+        self.alignment = alignment
+        self._devices = {}
+        self._queue = []
+        self._wakeup = gevent.event.Event()
+        # The stagger anchor; all intervals start together from here.
+        self._anchor = time.time()
+
+    def add(self, name, driver, interval, offset=None):
+        '''Scrape driver every interval seconds.
+
+        offset is the number of seconds past each interval boundary the
+        device is scraped when scrapes are aligned to the clock. When
+        staggering, it is None to spread the device among others with
+        the same interval, or a fixed offset from the scheduler start.
+        '''
+        if interval <= 0:
+            raise ValueError('invalid scrape interval: {!r}'.format(interval))
+        device = _Device(driver, interval, offset)
+        self._devices[name] = device
+        if self.alignment == STAGGER:
+            self._stagger(interval)
+        else:
+            self._schedule(device, 0, offset or 0)
+        self._rebuild()
+
+    def remove(self, name):
+        device = self._devices.pop(name)
+        if self.alignment == STAGGER:
+            self._stagger(device.interval)
+        self._rebuild()
+
+    def _stagger(self, interval):
+        '''Evenly space the unfixed devices with the given interval.'''
+        devices = [device for name, device in sorted(self._devices.items())
+                   if device.interval == interval and device.offset is None]
+        for i, device in enumerate(devices):
+            self._schedule(device, self._anchor,
+                           interval * i / float(len(devices)))
+        for device in self._devices.itervalues():
+            if device.interval == interval and device.offset is not None:
+                self._schedule(device, self._anchor, device.offset)
+
+    def _schedule(self, device, anchor, offset):
+        '''Set the device due at the next anchor + offset + k * interval.'''
+        now = time.time()
+        interval = device.interval
+        phase = (anchor + offset) % interval
+        due = now - (now - phase) % interval
+        if device.due is not None and device.due < now:
+            # Keep a pending scrape which is already due.
+            return
+        if due < now:
+            due += interval
+        device.due = due
+
+    def _rebuild(self):
+        self._queue = [(device.due, name)
+                       for name, device in self._devices.iteritems()]
+        heapq.heapify(self._queue)
+        self._wakeup.set()
+
+    def run(self):
+        '''Run the scheduler; it is meant to be spawned in a greenlet.'''
+        while True:
+            self._wakeup.clear()
+            queue = self._queue
+            if not queue:
+                self._wakeup.wait()
+                continue
+            due, name = queue[0]
+            timeout = due - time.time()
+            if timeout > 0:
+                if self._wakeup.wait(timeout):
+                    continue
+            heapq.heappop(queue)
+            device = self._devices[name]
+            device.due = due + device.interval
+            heapq.heappush(queue, (device.due, name))
+            self._start(name, device, due)
+
+    def _start(self, name, device, due):
+        if device.greenlet is not None:
+            device.overruns += 1
+            _log.warning('scrape of %s overran its %gs interval; skipping',
+                         name, device.interval)
+            return
+        device.greenlet = gevent.spawn(self._scrape, name, device, due)
+
+    def _scrape(self, name, device, due):
+        start = time.time()
+        device.lateness.add(max(start - due, 0))
+        try:
+            device.driver.periodic_read()
+        except Exception:
+            _log.exception('unhandled exception scraping %s', name)
+        finally:
+            device.last_duration = duration = time.time() - start
+            device.durations.add(duration)
+            device.last_scrape = start
+            device.scrapes += 1
+            device.greenlet = None
+
+    def stats(self):
+        return {name: device.stats()
+                for name, device in self._devices.iteritems()}
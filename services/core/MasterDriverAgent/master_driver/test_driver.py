@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# r favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+
+#}}}
+
+import unittest
+
+from driver import DriverAgent
+from interfaces import BaseRegister
+
+
+def make_register(deadband=None, percent_deadband=None, max_silence=None):
+    register = BaseRegister('byte', True, 'point', 'units')
+    register.deadband = deadband
+    register.percent_deadband = percent_deadband
+    register.max_silence = max_silence
+    return register
+
+
+def make_driver(register=None):
+    driver = DriverAgent.__new__(DriverAgent)
+    driver.device_name = 'campus/building/unit/'
+    driver.exception_registers = {}
+    if register is not None:
+        driver.exception_registers['point'] = register
+    driver.last_published = {}
+    driver.meta_data = {'point': {}, 'other': {}}
+    driver.all_publish_interval = 0
+    driver.next_all_publish = 0
+    driver.all_path_depth = 'devices/campus/building/unit/all'
+    driver.all_path_breadth = 'devices/all/unit/building/campus'
+    driver.get_paths_for_point = lambda point: (point,)
+    return driver
+
+
+# (deadband, percent deadband, max silence, last value, value, seconds since
+#  last publish, expected)
+SHOULD_PUBLISH_CASES = [
+    # First sample is always published.
+    (1, None, None, None, 10, 0, True),
+    # Absolute deadband.
+    (1, None, None, 10, 10.5, 1, False),
+    (1, None, None, 10, 11, 1, False),
+    (1, None, None, 10, 11.5, 1, True),
+    (1, None, None, 10, 8.5, 1, True),
+    # Percent deadband.
+    (None, 10, None, 100, 105, 1, False),
+    (None, 10, None, 100, 111, 1, True),
+    (None, 10, None, -100, -89, 1, True),
+    # A zero last value leaves no percent deadband.
+    (None, 10, None, 0, 0, 1, False),
+    (None, 10, None, 0, 0.001, 1, True),
+    # Either deadband being exceeded is enough.
+    (5, 10, None, 100, 106, 1, True),
+    (50, 1, None, 100, 102, 1, True),
+    # Max silence alone publishes unchanged values after the silence.
+    (None, None, 60, 10, 10, 59, False),
+    (None, None, 60, 10, 10, 60, True),
+    (None, None, 60, 10, 11, 1, True),
+    (1, None, 60, 10, 10.5, 61, True),
+    # Non-numeric values are compared for equality.
+    (1, None, None, 'on', 'on', 1, False),
+    (1, None, None, 'on', 'off', 1, True),
+    (1, None, None, 'on', 1, 1, True),
+    (1, None, None, True, True, 1, False),
+]
+
+
+class ShouldPublishTests(unittest.TestCase):
+    def test_cases(self):
+        for case in SHOULD_PUBLISH_CASES:
+            (deadband, percent, silence, last, value,
+             elapsed, expected) = case
+            driver = make_driver(make_register(deadband, percent, silence))
+            if last is not None:
+                driver.last_published['point'] = (last, 1000)
+            self.assertEqual(
+                driver.should_publish('point', value, 1000 + elapsed),
+                expected, case)
+
+    def test_without_reporting(self):
+        driver = make_driver()
+        self.assertTrue(driver.should_publish('point', 10, 1000))
+        self.assertTrue(driver.should_publish('point', 10, 1000))
+        self.assertEqual(driver.last_published, {})
+
+    def test_does_not_record(self):
+        driver = make_driver(make_register(deadband=1))
+        self.assertTrue(driver.should_publish('point', 10, 1000))
+        self.assertTrue(driver.should_publish('point', 10, 1001))
+        self.assertEqual(driver.last_published, {})
+
+
+class FakeInterface(object):
+    def __init__(self, results):
+        self.results = results
+
+    def scrape_all(self):
+        return dict(self.results)
+
+
+class PeriodicReadTests(unittest.TestCase):
+    def setUp(self):
+        self.driver = make_driver(make_register(deadband=1))
+        self.driver.all_publish_interval = 300
+        self.driver.interface = FakeInterface({'point': 10, 'other': 5})
+        self.published = []
+        self.accept = True
+        self.driver._publish_wrapper = self.publish
+
+    def publish(self, messages):
+        self.published.append(sorted(topic for topic, _, _ in messages))
+        return self.accept
+
+    def test_records_published_values(self):
+        self.driver.periodic_read()
+        self.assertEqual(self.published[-1], [
+            'devices/all/unit/building/campus',
+            'devices/campus/building/unit/all', 'other', 'point'])
+        self.assertEqual(self.driver.last_published['point'][0], 10)
+        self.assertNotIn('other', self.driver.last_published)
+        self.assertGreater(self.driver.next_all_publish, 0)
+        self.driver.periodic_read()
+        self.assertEqual(self.published[-1], ['other'])
+
+    def test_failed_publish_is_retried(self):
+        self.accept = False
+        self.driver.periodic_read()
+        self.assertEqual(self.driver.last_published, {})
+        self.assertEqual(self.driver.next_all_publish, 0)
+        self.accept = True
+        self.driver.periodic_read()
+        self.assertEqual(self.published[-1], self.published[0])
+        self.assertEqual(self.driver.last_published['point'][0], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
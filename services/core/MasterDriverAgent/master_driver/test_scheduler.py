@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# r favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+
+#}}}
+
+import time
+import unittest
+
+import gevent
+
+from scheduler import ScrapeScheduler, STAGGER, CLOCK
+
+
+class FakeDriver(object):
+    def __init__(self, duration=0):
+        self.duration = duration
+        self.reads = []
+
+    def periodic_read(self):
+        self.reads.append(time.time())
+        gevent.sleep(self.duration)
+
+
+class ScrapeSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.greenlet = None
+
+    def tearDown(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+
+    def run_scheduler(self, scheduler, seconds):
+        self.greenlet = gevent.spawn(scheduler.run)
+        gevent.sleep(seconds)
+        self.greenlet.kill()
+        self.greenlet = None
+
+    def phases(self, scheduler, interval):
+        return sorted(round((device.due - scheduler._anchor) % interval, 6)
+                      for device in scheduler._devices.itervalues())
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, ScrapeScheduler, 'sometimes')
+        scheduler = ScrapeScheduler()
+        self.assertRaises(ValueError, scheduler.add, 'a', FakeDriver(), 0)
+
+    def test_stagger(self):
+        scheduler = ScrapeScheduler(STAGGER)
+        for name in 'abcd':
+            scheduler.add(name, FakeDriver(), 60)
+        self.assertEqual(self.phases(scheduler, 60), [0, 15, 30, 45])
+        scheduler.remove('d')
+        self.assertEqual(self.phases(scheduler, 60), [0, 20, 40])
+
+    def test_stagger_fixed_offset(self):
+        scheduler = ScrapeScheduler(STAGGER)
+        scheduler.add('a', FakeDriver(), 60)
+        scheduler.add('b', FakeDriver(), 60)
+        scheduler.add('fixed', FakeDriver(), 60, offset=10)
+        self.assertEqual(self.phases(scheduler, 60), [0, 10, 30])
+
+    def test_clock_alignment(self):
+        scheduler = ScrapeScheduler(CLOCK)
+        scheduler.add('a', FakeDriver(), 60)
+        scheduler.add('b', FakeDriver(), 60, offset=5)
+        scheduler.add('c', FakeDriver(), 900, offset=30)
+        now = time.time()
+        due = dict((name, device.due)
+                   for name, device in scheduler._devices.iteritems())
+        self.assertAlmostEqual(due['a'] % 60, 0, places=3)
+        self.assertAlmostEqual(due['b'] % 60, 5, places=3)
+        self.assertAlmostEqual(due['c'] % 900, 30, places=3)
+        for name, interval in (('a', 60), ('b', 60), ('c', 900)):
+            self.assertTrue(now <= due[name] < now + interval)
+
+    def test_scrapes_each_interval(self):
+        scheduler = ScrapeScheduler(STAGGER)
+        driver = FakeDriver()
+        scheduler.add('a', driver, 0.1)
+        self.run_scheduler(scheduler, 0.55)
+        self.assertIn(len(driver.reads), (5, 6))
+        stats = scheduler.stats()['a']
+        self.assertEqual(stats['scrapes'], len(driver.reads))
+        self.assertEqual(stats['overruns'], 0)
+        self.assertEqual(stats['interval'], 0.1)
+        self.assertEqual(stats['duration']['count'], len(driver.reads))
+        self.assertEqual(stats['lateness']['count'], len(driver.reads))
+        self.assertAlmostEqual(stats['last_scrape'], driver.reads[-1], places=2)
+
+    def test_overrun_skipped(self):
+        scheduler = ScrapeScheduler(STAGGER)
+        slow = FakeDriver(duration=0.25)
+        fast = FakeDriver()
+        scheduler.add('slow', slow, 0.1)
+        scheduler.add('fast', fast, 0.1)
+        self.run_scheduler(scheduler, 0.58)
+        stats = scheduler.stats()
+        # Scrapes of slow due while one runs are skipped without
+        # delaying fast.
+        self.assertTrue(len(slow.reads) <= 3)
+        self.assertTrue(stats['slow']['overruns'] >= 2)
+        self.assertTrue(stats['slow']['scrapes'] <= len(slow.reads))
+        self.assertIn(len(fast.reads), (5, 6))
+        self.assertEqual(stats['fast']['overruns'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,7 @@
 CREATE TABLE data (ts timestamp NOT NULL,
                                  topic_id INTEGER NOT NULL, 
                                  value_string TEXT NOT NULL, 
-                                 UNIQUE(ts, topic_id));
+                                 PRIMARY KEY (topic_id, ts));
             
 CREATE INDEX data_idx ON data (ts ASC);
 
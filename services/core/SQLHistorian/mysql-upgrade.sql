@@ -0,0 +1,5 @@
+-- Cluster existing data tables by topic so single topic queries over a
+-- time range read contiguous rows. InnoDB rebuilds the table online,
+-- allowing concurrent inserts, but the rebuild needs free space equal
+-- to the size of the table.
+ALTER TABLE data ADD PRIMARY KEY (topic_id, ts), DROP INDEX ts, ALGORITHM=INPLACE, LOCK=NONE;
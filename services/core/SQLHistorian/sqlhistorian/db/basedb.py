@@ -1,7 +1,10 @@
 from __future__ import absolute_import, print_function
 from abc import abstractmethod
+from contextlib import contextmanager
 import importlib
 import logging
+import threading
+import time
 
 from zmq.utils import jsonapi
 
@@ -10,15 +13,155 @@ from volttron.platform.agent import utils
 utils.setup_logging()
 _log = logging.getLogger(__name__)
 
+class ConnectionPool(object):
+    '''A bounded pool of DB-API connections.
+
+    At most size connections are checked out at once; callers beyond
+    that block until one is released. Connections idle for longer than
+    idle_timeout seconds are closed instead of reused, and connections
+    idle for more than check_after seconds are tested with a trivial
+    query before being handed out. The time callers spend waiting for
+    a connection is recorded in the pool statistics.
+    '''
+
+    def __init__(self, connect, size=5, idle_timeout=300, check_after=30):
+        self._connect = connect
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._check_after = check_after
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._stats = {'size': size,
+                       'in_use': 0,
+                       'checkouts': 0,
+                       'connects': 0,
+                       'evictions': 0,
+                       'failed_checks': 0,
+                       'wait_time': 0.0,
+                       'max_wait_time': 0.0}
+
+    def acquire(self):
+        '''Check out a connection, creating one if none are idle.'''
+        start = time.time()
+        self._slots.acquire()
+        waited = time.time() - start
+        try:
+            conn = self._checkout()
+        except:
+            self._slots.release()
+            raise
+        with self._lock:
+            stats = self._stats
+            stats['in_use'] += 1
+            stats['checkouts'] += 1
+            stats['wait_time'] += waited
+            stats['max_wait_time'] = max(stats['max_wait_time'], waited)
+        return conn
+
+    def release(self, conn, discard=False):
+        '''Return a connection to the pool or close it if discard is set.
+
+        Any open transaction is rolled back so that readers do not keep
+        seeing a stale snapshot.
+        '''
+        if not discard:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        if discard:
+            self._close(conn)
+        with self._lock:
+            if not discard:
+                self._idle.append((conn, time.time()))
+            self._stats['in_use'] -= 1
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        '''Context manager to check out and release a connection.'''
+        conn = self.acquire()
+        try:
+            yield conn
+        except:
+            self.release(conn, discard=True)
+            raise
+        self.release(conn)
+
+    def close(self):
+        '''Close all idle connections.'''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        return stats
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, released = self._idle.pop()
+            idle_time = time.time() - released
+            if idle_time > self._idle_timeout:
+                reason = 'evictions'
+            elif idle_time > self._check_after and not self._check(conn):
+                reason = 'failed_checks'
+            else:
+                return conn
+            self._close(conn)
+            with self._lock:
+                self._stats[reason] += 1
+        conn = self._connect()
+        with self._lock:
+            self._stats['connects'] += 1
+        return conn
+
+    def _check(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            cursor.close()
+        except Exception:
+            return False
+        return True
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
 class DbDriver(object):
+
+    # Maximum number of rows written by a single bulk insert statement.
+    bulk_insert_size = 1000
     
-    def __init__(self, dbapimodule, **kwargs):
+    def __init__(self, dbapimodule, pool=None, **kwargs):
         _log.debug("Constructing Driver for "+ dbapimodule)
         
         self.__dbmodule = importlib.import_module(dbapimodule)
         self.__connection = None
         self.__cursor = None  
         self.__connect_params = kwargs
+
+        # Queries are served from the read pool while inserts hold a
+        # connection from the write pool until commit or rollback.
+        pool = pool or {}
+        connect = lambda: self.__dbmodule.connect(**self.__connect_params)
+        idle_timeout = pool.get('idle_timeout', 300)
+        self.__read_pool = ConnectionPool(
+            connect, size=pool.get('read_size', 5), idle_timeout=idle_timeout)
+        self.__write_pool = ConnectionPool(
+            connect, size=pool.get('write_size', 1), idle_timeout=idle_timeout)
                 
         try:
             if not self.__check_connection():
@@ -45,13 +188,10 @@ class DbDriver(object):
         
         return can_connect
 
-    def __connect(self, return_val=False):
-        
-        if return_val:
-            return self.__dbmodule.connect(**self.__connect_params)
+    def __connect(self):
         
         if self.__connection == None:
-            self.__connection = self.__dbmodule.connect(**self.__connect_params)        
+            self.__connection = self.__write_pool.acquire()
             
     @abstractmethod
     def get_topic_map(self):
@@ -67,6 +207,14 @@ class DbDriver(object):
     @abstractmethod
     def insert_topic_query(self):
         pass
+
+    def bulk_insert_data_query(self, count):
+        '''Return a statement inserting count rows at once or None.
+
+        When None is returned, bulk_insert_data() falls back to
+        executemany() with insert_data_query().
+        '''
+        return None
     
     def insert_data(self, ts, topic_id, data):
         
@@ -81,6 +229,34 @@ class DbDriver(object):
         self.__cursor.execute(self.insert_data_query(), (ts,topic_id,jsonapi.dumps(data)))
         return True
 
+    def bulk_insert_data(self, rows):
+        '''Insert a sequence of (ts, topic_id, data) rows.
+
+        Rows are written in chunks of bulk_insert_size within the
+        current transaction, which must be completed with commit().
+        '''
+        
+        self.__connect()
+
+        if self.__connection is None:
+            return False
+        
+        if self.__cursor == None:
+            self.__cursor = self.__connection.cursor()
+
+        dumps = jsonapi.dumps
+        values = [(ts, topic_id, dumps(data)) for ts, topic_id, data in rows]
+        size = self.bulk_insert_size
+        for start in xrange(0, len(values), size):
+            chunk = values[start:start + size]
+            query = self.bulk_insert_data_query(len(chunk))
+            if query is None:
+                self.__cursor.executemany(self.insert_data_query(), chunk)
+            else:
+                self.__cursor.execute(
+                    query, [arg for row in chunk for arg in row])
+        return True
+
     def insert_topic(self, topic):
         
         self.__connect()
@@ -98,22 +274,22 @@ class DbDriver(object):
         return row
     
     def commit(self):
-        try:
-            retValue = False
-            if self.__connection is not None:
+        '''Commit the current transaction.
+
+        The connection is returned to the write pool for the next batch
+        of inserts and is only closed if the commit fails.
+        '''
+        retValue = False
+        if self.__connection is not None:
+            try:
                 self.__connection.commit()
-                retValue = True
-            else:
-                _log.warn('connection was null during commit phase.')
-        finally:
-            if self.__connection is not None:
-                try:
-                    self.__connection.close()
-                except:
-                    pass
-                                                            
-            self.__cursor = None
-            self.__connection = None
+            except:
+                self.__release(discard=True)
+                raise
+            self.__release()
+            retValue = True
+        else:
+            _log.warn('connection was null during commit phase.')
         return retValue
     def rollback(self):
         try:
@@ -124,35 +300,50 @@ class DbDriver(object):
             else:
                 _log.warn('connection was null during rollback phase.')
         finally:
-            if self.__connection is not None:
-                try:
-                    self.__connection.close()
-                except:
-                    pass
-                                                            
-            self.__cursor = None
-            self.__connection = None
+            # A failed batch may have left the connection unusable, so
+            # reconnect on the next insert.
+            self.__release(discard=True)
         return retValue
+
+    def __release(self, discard=False):
+        if self.__connection is not None:
+            self.__write_pool.release(self.__connection, discard=discard)
+                                                        
+        self.__cursor = None
+        self.__connection = None
     
     def select(self, query, args):
-        conn = self.__connect(True)
-        cursor = conn.cursor()
-        if args is not None:
-            cursor.execute(query, args)
-        else:
-            cursor.execute(query)
-        rows = cursor.fetchall()
-        conn.close()
+        with self.__read_pool.connection() as conn:
+            cursor = conn.cursor()
+            if args is not None:
+                cursor.execute(query, args)
+            else:
+                cursor.execute(query)
+            rows = cursor.fetchall()
+            cursor.close()
         return rows
+
+    def pool_stats(self):
+        '''Return statistics for the read and write connection pools.'''
+        return {'read': self.__read_pool.get_stats(),
+                'write': self.__write_pool.get_stats()}
     
     
     @abstractmethod                        
-    def query(self, topic, start=None, end=None, skip=0,
-                            count=None, order="FIRST_TO_LAST"):
+    def query(self, topic_id, start=None, end=None, skip=0,
+                            count=None, order="FIRST_TO_LAST",
+                            agg_type=None, agg_period=None):
         """This function should return the results of a query in the form:
         {"values": [(timestamp1, value1), (timestamp2, value2), ...],
          "metadata": {"key1": value1, "key2": value2, ...}}
 
          metadata is not required (The caller will normalize this to {} for you)
+
+         topic_id is the id of the topic in the topics table, which
+         callers resolve with get_topic_map().
+
+         If agg_type is given, values are aggregated in the database over
+         buckets of agg_period seconds and timestamped with the start of
+         each bucket.
         """
         pass
\ No newline at end of file
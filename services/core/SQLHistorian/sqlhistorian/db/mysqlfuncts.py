@@ -55,11 +55,13 @@
 # under Contract DE-AC05-76RL01830
 #}}}
 
+from datetime import datetime
 import errno
 import logging
 import os
 
 #from mysql import connector
+import pytz
 from zmq.utils import jsonapi
 
 from basedb import DbDriver
@@ -68,14 +70,25 @@ from volttron.platform.agent import utils
 utils.setup_logging()
 _log = logging.getLogger(__name__)
 
+# Aggregates computed by MySQL for the query RPC. first and last are
+# handled separately as they select a stored value rather than compute one.
+AGGREGATES = {
+    'avg': 'AVG(data.value_string + 0)',
+    'min': 'MIN(data.value_string + 0)',
+    'max': 'MAX(data.value_string + 0)',
+    'sum': 'SUM(data.value_string + 0)',
+    'count': 'COUNT(*)',
+}
+
 class MySqlFuncts(DbDriver):
 
     def __init__(self, **kwargs):
         #kwargs['dbapimodule'] = 'mysql.connector'
         super(MySqlFuncts, self).__init__('mysql.connector', **kwargs)
         
-    def query(self, topic, start=None, end=None, skip=0,
-                            count=None, order="FIRST_TO_LAST"):
+    def query(self, topic_id, start=None, end=None, skip=0,
+                            count=None, order="FIRST_TO_LAST",
+                            agg_type=None, agg_period=None):
         """This function should return the results of a query in the form:
         {"values": [(timestamp1, value1), (timestamp2, value2), ...],
          "metadata": {"key1": value1, "key2": value2, ...}}
@@ -83,14 +96,46 @@ class MySqlFuncts(DbDriver):
          metadata is not required (The caller will normalize this to {} for you)
         """
         query = '''SELECT data.ts, data.value_string
-                   FROM data, topics
+                   FROM data
                    {where}
                    {order_by}
                    {limit}
                    {offset}'''
 
-        where_clauses = ["WHERE topics.topic_name = %s", "topics.topic_id = data.topic_id"]
-        args = [topic]
+        order_column = 'data.ts'
+        if agg_type is not None:
+            bucket = 'FLOOR(UNIX_TIMESTAMP(data.ts) / {0}) * {0}'.format(
+                int(agg_period))
+            if agg_type in ('first', 'last'):
+                # Find the first or last timestamp in each bucket and join
+                # back to data to fetch the value stored with it.
+                query = '''SELECT buckets.bucket, data.value_string
+                           FROM (SELECT {bucket} AS bucket,
+                                        {func}(data.ts) AS ts,
+                                        MIN(data.topic_id) AS topic_id
+                                 FROM data
+                                 {{where}}
+                                 GROUP BY bucket) AS buckets, data
+                           WHERE data.topic_id = buckets.topic_id
+                             AND data.ts = buckets.ts
+                           {{order_by}}
+                           {{limit}}
+                           {{offset}}'''.format(
+                    bucket=bucket, func='MIN' if agg_type == 'first' else 'MAX')
+                order_column = 'buckets.bucket'
+            else:
+                query = '''SELECT {bucket} AS bucket, {func}
+                           FROM data
+                           {{where}}
+                           GROUP BY bucket
+                           {{order_by}}
+                           {{limit}}
+                           {{offset}}'''.format(
+                    bucket=bucket, func=AGGREGATES[agg_type])
+                order_column = 'bucket'
+
+        where_clauses = ["WHERE data.topic_id = %s"]
+        args = [topic_id]
 
         if start is not None:
             where_clauses.append("data.ts > %s")
@@ -102,9 +147,9 @@ class MySqlFuncts(DbDriver):
 
         where_statement = ' AND '.join(where_clauses)
 
-        order_by = 'ORDER BY data.ts ASC'
+        order_by = 'ORDER BY {} ASC'.format(order_column)
         if order == 'LAST_TO_FIRST':
-            order_by = ' ORDER BY data.ts DESC'
+            order_by = ' ORDER BY {} DESC'.format(order_column)
 
         #can't have an offset without a limit
         # -1 = no limit and allows the user to
@@ -130,17 +175,30 @@ class MySqlFuncts(DbDriver):
         _log.debug("Real Query: " + real_query)
         _log.debug("args: "+str(args))
 
-        rows = self.select(real_query)
+        rows = self.select(real_query, args)
         
-        if rows:
-            values = [(ts.isoformat(), jsonapi.loads(value)) for ts, value in rows]
-        else:
+        if not rows:
             values = {}
+        elif agg_type is None:
+            # Timestamps are stored in UTC; label them as such, like the
+            # aggregated buckets.
+            values = [(ts.replace(tzinfo=pytz.UTC).isoformat(),
+                       jsonapi.loads(value)) for ts, value in rows]
+        elif agg_type in ('first', 'last'):
+            values = [(datetime.fromtimestamp(float(bucket), pytz.UTC).isoformat(),
+                       jsonapi.loads(value)) for bucket, value in rows]
+        else:
+            values = [(datetime.fromtimestamp(float(bucket), pytz.UTC).isoformat(),
+                       value) for bucket, value in rows]
         
         return {'values':values}
     
     def insert_data_query(self):
         return '''REPLACE INTO data values(%s, %s, %s)'''
+
+    def bulk_insert_data_query(self, count):
+        return '''REPLACE INTO data values''' + \
+            ', '.join(['(%s, %s, %s)'] * count)
         
     def insert_topic_query(self):
         return '''REPLACE INTO topics (topic_name) values (%s)'''
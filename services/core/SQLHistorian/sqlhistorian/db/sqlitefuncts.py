@@ -55,11 +55,13 @@
 # under Contract DE-AC05-76RL01830
 #}}}
 
+from datetime import datetime
 import errno
 import logging
 import os
 import sqlite3
 
+import pytz
 from zmq.utils import jsonapi
 
 from basedb import DbDriver
@@ -68,6 +70,16 @@ from volttron.platform.agent import utils
 utils.setup_logging()
 _log = logging.getLogger(__name__)
 
+# Aggregates computed by SQLite for the query RPC. first and last are
+# handled separately as they select a stored value rather than compute one.
+AGGREGATES = {
+    'avg': 'AVG(CAST(data.value_string AS REAL))',
+    'min': 'MIN(CAST(data.value_string AS REAL))',
+    'max': 'MAX(CAST(data.value_string AS REAL))',
+    'sum': 'SUM(CAST(data.value_string AS REAL))',
+    'count': 'COUNT(*)',
+}
+
 class SqlLiteFuncts(DbDriver):
 
     def __init__(self, database, **kwargs):
@@ -101,6 +113,20 @@ class SqlLiteFuncts(DbDriver):
         cursor.execute('''CREATE INDEX IF NOT EXISTS data_idx
                                 ON data (ts ASC)''')
 
+        # Queries select a single topic over a time range, which the
+        # UNIQUE(ts, topic_id) and ts indexes cannot serve without
+        # scanning every topic in the range. Databases created before
+        # this index existed get it built here on first start.
+        cursor.execute('''SELECT name FROM sqlite_master
+                          WHERE type = 'index'
+                          AND name = 'data_topic_ts_idx' ''')
+        if cursor.fetchone() is None:
+            _log.info('Creating data_topic_ts_idx index; this may take a '
+                      'while on large databases.')
+            cursor.execute('''CREATE INDEX data_topic_ts_idx
+                                    ON data (topic_id, ts)''')
+            cursor.execute('''ANALYZE data''')
+
         cursor.execute('''CREATE TABLE IF NOT EXISTS topics
                                 (topic_id INTEGER PRIMARY KEY,
                                  topic_name TEXT NOT NULL,
@@ -118,28 +144,51 @@ class SqlLiteFuncts(DbDriver):
         if 'detect_types' not in kwargs.keys():
             kwargs['detect_types'] = sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES
         
+        # Pooled connections are used by one caller at a time but from
+        # either the agent's thread or the historian's publishing thread.
+        if 'check_same_thread' not in kwargs.keys():
+            kwargs['check_same_thread'] = False
+        
         print (kwargs)    
         super(SqlLiteFuncts, self).__init__('sqlite3', **kwargs)
         
 
 
-    def query(self, topic, start=None, end=None, skip=0,
-                            count=None, order="FIRST_TO_LAST"):
+    def query(self, topic_id, start=None, end=None, skip=0,
+                            count=None, order="FIRST_TO_LAST",
+                            agg_type=None, agg_period=None):
         """This function should return the results of a query in the form:
         {"values": [(timestamp1, value1), (timestamp2, value2), ...],
          "metadata": {"key1": value1, "key2": value2, ...}}
 
          metadata is not required (The caller will normalize this to {} for you)
         """
-        query = '''SELECT data.ts, data.value_string
-                   FROM data, topics
+        query = '''SELECT {select}
+                   FROM data
                    {where}
+                   {group_by}
                    {order_by}
                    {limit}
                    {offset}'''
 
-        where_clauses = ["WHERE topics.topic_name = ?", "topics.topic_id = data.topic_id"]
-        args = [topic]
+        select = 'data.ts, data.value_string'
+        group_by = ''
+        order_column = 'data.ts'
+        if agg_type is not None:
+            bucket = "CAST(strftime('%s', data.ts) AS INTEGER) / {0} * {0}" \
+                .format(int(agg_period))
+            if agg_type in ('first', 'last'):
+                # SQLite takes bare columns from the row holding the
+                # MIN()/MAX() value, i.e. the first or last in the bucket.
+                select = '{} AS bucket, data.value_string, {}(data.ts)'.format(
+                    bucket, 'MIN' if agg_type == 'first' else 'MAX')
+            else:
+                select = '{} AS bucket, {}'.format(bucket, AGGREGATES[agg_type])
+            group_by = 'GROUP BY bucket'
+            order_column = 'bucket'
+
+        where_clauses = ["WHERE data.topic_id = ?"]
+        args = [topic_id]
 
         if start is not None:
             where_clauses.append("data.ts > ?")
@@ -151,9 +200,9 @@ class SqlLiteFuncts(DbDriver):
 
         where_statement = ' AND '.join(where_clauses)
 
-        order_by = 'ORDER BY data.ts ASC'
+        order_by = 'ORDER BY {} ASC'.format(order_column)
         if order == 'LAST_TO_FIRST':
-            order_by = ' ORDER BY data.ts DESC'
+            order_by = ' ORDER BY {} DESC'.format(order_column)
 
         #can't have an offset without a limit
         # -1 = no limit and allows the user to
@@ -171,17 +220,28 @@ class SqlLiteFuncts(DbDriver):
 
         _log.debug("About to do real_query")
 
-        real_query = query.format(where=where_statement,
+        real_query = query.format(select=select,
+                                  where=where_statement,
+                                  group_by=group_by,
                                   limit=limit_statement,
                                   offset=offset_statement,
                                   order_by=order_by)
         _log.debug("Real Query: " + real_query)
         _log.debug("args: "+str(args))
 
-        c = sqlite3.connect(self.__database, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-        rows = c.execute(real_query,args)
+        rows = self.select(real_query, args)
 
-        values = [(ts.isoformat(), jsonapi.loads(value)) for ts, value in rows]
+        if agg_type is None:
+            # Timestamps are stored in UTC; label them as such, like the
+            # aggregated buckets.
+            values = [(ts.replace(tzinfo=pytz.UTC).isoformat(),
+                       jsonapi.loads(value)) for ts, value in rows]
+        elif agg_type in ('first', 'last'):
+            values = [(datetime.fromtimestamp(bucket, pytz.UTC).isoformat(),
+                       jsonapi.loads(value)) for bucket, value, _ in rows]
+        else:
+            values = [(datetime.fromtimestamp(bucket, pytz.UTC).isoformat(),
+                       value) for bucket, value in rows]
         _log.debug("QueryResults: " + str(values))
         return {'values':values}
 
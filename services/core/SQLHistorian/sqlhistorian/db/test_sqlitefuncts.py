@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import pytz
+
+from sqlitefuncts import SqlLiteFuncts
+from volttron.platform.agent.base_historian import BaseQueryHistorianAgent
+
+
+START = datetime(2015, 1, 1, tzinfo=pytz.UTC) + timedelta(microseconds=1)
+
+
+class QueryHistorian(BaseQueryHistorianAgent):
+    def __init__(self, db, **kwargs):
+        super(QueryHistorian, self).__init__(**kwargs)
+        self.db = db
+
+    def query_historian(self, topic, start=None, end=None, skip=0,
+                        count=None, order="FIRST_TO_LAST", **kwargs):
+        return self.db.query(1, start=start, end=end, skip=skip,
+                             count=count, order=order, **kwargs)
+
+    def query_topic_list(self):
+        return ['topic']
+
+
+class SqlLiteFunctsTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = SqlLiteFuncts(
+            database=os.path.join(self.directory, 'historian.sqlite'))
+        self.db.bulk_insert_data([(START + timedelta(minutes=i), 1, i)
+                                  for i in range(10)])
+        self.db.commit()
+        self.historian = QueryHistorian(self.db)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def page_through(self, **kwargs):
+        results = self.historian.query('topic', **kwargs)
+        values = [value for _, value in results['values']]
+        pages = 1
+        while 'cursor' in results:
+            # More pages than rows means the cursor stopped moving.
+            self.assertLessEqual(pages, 10)
+            results = self.historian.query_next(results['cursor'])
+            values.extend(value for _, value in results['values'])
+            pages += 1
+        return values
+
+    def test_paging(self):
+        for page_size in (1, 4):
+            self.assertEqual(self.page_through(page_size=page_size),
+                             range(10))
+
+    def test_paging_last_to_first(self):
+        for page_size in (1, 4):
+            self.assertEqual(self.page_through(page_size=page_size,
+                                               order='LAST_TO_FIRST'),
+                             range(9, -1, -1))
+
+    def test_paging_count(self):
+        self.assertEqual(self.page_through(page_size=4, count=6), range(6))
+
+    def test_aggregation(self):
+        cases = [('avg', [2.0, 7.0]), ('min', [0.0, 5.0]),
+                 ('max', [4.0, 9.0]), ('sum', [10.0, 35.0]),
+                 ('count', [5, 5]), ('first', [0, 5]), ('last', [4, 9])]
+        for agg_type, expected in cases:
+            results = self.historian.query('topic', agg_type=agg_type,
+                                           agg_period='5m')
+            self.assertEqual([value for _, value in results['values']],
+                             expected, agg_type)
+            self.assertEqual([ts for ts, _ in results['values']],
+                             ['2015-01-01T00:00:00+00:00',
+                              '2015-01-01T00:05:00+00:00'], agg_type)
+
+    def test_timestamp_format(self):
+        # Raw and aggregated values are both timestamped in UTC.
+        raw = self.historian.query('topic', count=1)['values'][0][0]
+        aggregated = self.historian.query('topic', count=1, agg_type='avg',
+                                          agg_period=60)['values'][0][0]
+        self.assertEqual(raw, '2015-01-01T00:00:00.000001+00:00')
+        self.assertEqual(aggregated, '2015-01-01T00:00:00+00:00')
+
+    def test_pooled_connection_shared_across_threads(self):
+        # The historian reads the topic map from its publishing thread
+        # with connections pooled by queries on the agent's thread.
+        self.db.insert_topic('topic')
+        self.db.commit()
+        self.db.get_topic_map()
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(self.db.get_topic_map()))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [{'topic': 1}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -91,6 +91,7 @@ def historian(config_path, **kwargs):
     assert databaseType is not None
     params = connection.get('params', None)
     assert params is not None
+    pool = connection.get('pool', None)
     identity = config.get('identity', kwargs.pop('identity', None))
 
     
@@ -120,7 +121,7 @@ def historian(config_path, **kwargs):
             
             print('Starting address: {} identity: {}'.format(self.core.address, self.core.identity))
             try:
-                self.reader = DbFuncts(**connection['params'])
+                self.reader = DbFuncts(pool=pool, **connection['params'])
             except AttributeError:
                 _log.exception('bad connection parameters')
                 self.core.stop()
@@ -164,7 +165,7 @@ def historian(config_path, **kwargs):
                 self.topic_map = self.reader.get_topic_map()
 
             try:
-                real_published = []
+                rows = []
                 for x in to_publish_list:
                     ts = x['timestamp']
                     topic = x['topic']
@@ -180,10 +181,8 @@ def historian(config_path, **kwargs):
                         self.topic_map[topic] = topic_id
                         _log.debug('TopicId: {} => {}'.format(topic_id, topic))
                     
-                    if self.writer.insert_data(ts,topic_id, value):
-                        #_log.debug('item was inserted')
-                        real_published.append(x)
-                if len(real_published) > 0:            
+                    rows.append((ts, topic_id, value))
+                if rows and self.writer.bulk_insert_data(rows):
                     if self.writer.commit():
                         _log.debug('published {} data values'.format(len(to_publish_list)))
                         self.report_all_handled()
@@ -205,20 +204,36 @@ def historian(config_path, **kwargs):
                 # No topics present.
                 return []
 
+        @RPC.export
+        def get_pool_stats(self):
+            '''Return database connection pool statistics.'''
+            return {'read': self.reader.pool_stats()['read'],
+                    'write': self.writer.pool_stats()['write']}
+
         def query_historian(self, topic, start=None, end=None, skip=0,
-                            count=None, order="FIRST_TO_LAST"):
+                            count=None, order="FIRST_TO_LAST",
+                            agg_type=None, agg_period=None):
             """This function should return the results of a query in the form:
             {"values": [(timestamp1, value1), (timestamp2, value2), ...],
              "metadata": {"key1": value1, "key2": value2, ...}}
 
              metadata is not required (The caller will normalize this to {} for you)
             """
-            return self.reader.query(topic, start=start, end=end, skip=skip,
-                                     count=count, order=order)
+            topic_id = self.topic_map.get(topic)
+            if topic_id is None:
+                # The topic may have been added by another historian
+                # writing to the same database.
+                self.topic_map = self.reader.get_topic_map()
+                topic_id = self.topic_map.get(topic)
+                if topic_id is None:
+                    return {'values': []}
+            return self.reader.query(topic_id, start=start, end=end, skip=skip,
+                                     count=count, order=order,
+                                     agg_type=agg_type, agg_period=agg_period)
 
         def historian_setup(self):
             try:
-                self.writer = DbFuncts(**connection['params'])
+                self.writer = DbFuncts(pool=pool, **connection['params'])
             except AttributeError as exc:
                 print(exc)
                 self.core.stop()
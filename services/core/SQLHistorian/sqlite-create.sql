@@ -6,6 +6,8 @@ CREATE TABLE IF NOT EXISTS data (ts timestamp NOT NULL,
             
 CREATE INDEX IF NOT EXISTS data_idx ON data (ts ASC);
 
+CREATE INDEX IF NOT EXISTS data_topic_ts_idx ON data (topic_id, ts);
+
 CREATE TABLE IF NOT EXISTS topics (topic_id INTEGER PRIMARY KEY, 
                                  topic_name TEXT NOT NULL,
                                  UNIQUE(topic_name));
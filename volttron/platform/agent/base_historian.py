@@ -66,6 +66,8 @@ from Queue import Queue, Empty
 import re
 import sqlite3
 from threading import Thread
+import time
+import uuid
 
 import gevent
 import pytz
@@ -81,6 +83,34 @@ _log = logging.getLogger(__name__)
 ACTUATOR_TOPIC_PREFIX_PARTS = len(topics.ACTUATOR_VALUE.split('/'))
 ALL_REX = re.compile('.*/all$')
 
+# Aggregations supported by the query RPC. first and last downsample by
+# returning one stored value per period.
+AGGREGATION_TYPES = ('avg', 'min', 'max', 'sum', 'count', 'first', 'last')
+PERIOD_REX = re.compile(r'^\s*(\d+)\s*([smhdw]?)\s*$')
+PERIOD_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+# Cached value of metadata that has not been written to the backup
+# database, which unlike None never equals a received value.
+_NOT_WRITTEN = object()
+
+
+def parse_period(period):
+    '''Return an aggregation period in whole seconds.
+
+    period may be a number of seconds or a string such as '900', '15m',
+    '1h' or '1d'.
+    '''
+    if isinstance(period, basestring):
+        match = PERIOD_REX.match(period.lower())
+        if match is None:
+            raise ValueError('invalid aggregation period: {!r}'.format(period))
+        seconds = int(match.group(1)) * PERIOD_UNITS[match.group(2)]
+    else:
+        seconds = int(period)
+    if seconds < 1:
+        raise ValueError('aggregation period must be at least one second')
+    return seconds
+
 class BaseHistorianAgent(Agent):
     '''This is the base agent for historian Agents.
     It automatically subscribes to all device publish topics.
@@ -372,7 +402,7 @@ class BaseHistorianAgent(Agent):
         #we may or may not want to wait on the event queue for more input
         #before proceeding with the rest of the loop.
         #wait_for_input = not bool(self._get_outstanding_to_publish())
-        wait_for_input = not bool(self._get_outstanding_to_publish())
+        wait_for_input = not self._any_outstanding_to_publish()
 
         while True:
             try:
@@ -423,6 +453,9 @@ class BaseHistorianAgent(Agent):
         _log.debug("Setting up backup DB.")
         self._connection = sqlite3.connect('backup.sqlite',
                                            detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+        # Write-ahead logging lets each batch commit with a single
+        # sequential write instead of rewriting the rollback journal.
+        self._connection.execute('''PRAGMA journal_mode = WAL''')
 
         c = self._connection.cursor()
         c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='outstanding';")
@@ -469,29 +502,37 @@ class BaseHistorianAgent(Agent):
 
         self._connection.commit()
 
+    def _any_outstanding_to_publish(self):
+        c = self._connection.cursor()
+        c.execute('select 1 from outstanding limit 1')
+        row = c.fetchone()
+        c.close()
+        return row is not None
+
     def _get_outstanding_to_publish(self):
         _log.debug("Getting oldest outstanding to publish.")
         c = self._connection.cursor()
-        c.execute('select * from outstanding order by ts limit ?', (self._submit_size_limit,))
-
-        results = []
-        for row in c:
-            _id = row[0]
-            timestamp = row[1]
-            source = row[2]
-            topic_id = row[3]
-            value = jsonapi.loads(row[4])
-            meta = self._meta_data[(source, topic_id)].copy()
-            results.append({'_id':_id,
-                            'timestamp': timestamp.replace(tzinfo=pytz.UTC),
-                            'source': source,
-                            'topic': self._backup_cache[topic_id],
-                            'value': value,
-                            'meta': meta})
-
+        # The UNIQUE(ts, topic_id, source) index leads with ts, so this
+        # (and the cleanup delete) reads in index order without sorting.
+        c.execute('''select id, ts, source, topic_id, value_string
+                     from outstanding order by ts limit ?''',
+                  (self._submit_size_limit,))
+        rows = c.fetchall()
         c.close()
 
-        return results
+        topics = self._backup_cache
+        meta_data = self._meta_data
+        loads = jsonapi.loads
+        utc = pytz.UTC
+        # Historians index and modify the records they are handed, so
+        # the rows are only expanded into dicts at this point.
+        return [{'_id': _id,
+                 'timestamp': timestamp.replace(tzinfo=utc),
+                 'source': source,
+                 'topic': topics[topic_id],
+                 'value': loads(value_string),
+                 'meta': meta_data[(source, topic_id)].copy()}
+                for _id, timestamp, source, topic_id, value_string in rows]
 
     def _cleanup_successful_publishes(self):
         _log.debug("Cleaning up successfully published values.")
@@ -520,6 +561,10 @@ class BaseHistorianAgent(Agent):
     def _backup_new_to_publish(self, new_publish_list):
         _log.debug("Backing up unpublished values.")
         c = self._connection.cursor()
+        meta_rows = []
+        meta_deletes = []
+        value_rows = []
+        dumps = jsonapi.dumps
 
         for item in new_publish_list:
             source = item['source']
@@ -531,22 +576,35 @@ class BaseHistorianAgent(Agent):
 
             if topic_id is None:
                 c.execute('''INSERT INTO topics values (?,?)''', (None, topic))
-                c.execute('''SELECT last_insert_rowid()''')
-                row = c.fetchone()
-                topic_id = row[0]
+                topic_id = c.lastrowid
                 self._backup_cache[topic_id] = topic
                 self._backup_cache[topic] = topic_id
 
+            # Metadata rarely changes so only write what differs from
+            # the cached copy. The value column cannot hold None, so a
+            # None value is stored as the absence of a row.
+            cached_meta = self._meta_data[(source, topic_id)]
             for name, value in meta.iteritems():
-                c.execute('''INSERT OR REPLACE INTO metadata values(?, ?, ?, ?)''',
-                            (source,topic_id,name,value))
-                self._meta_data[(source,topic_id)][name] = value
-
-
-            
-            for timestamp, value in values:
-                c.execute('''INSERT OR REPLACE INTO outstanding values(NULL, ?, ?, ?, ?)''',
-                          (timestamp,source,topic_id,jsonapi.dumps(value)))
+                if cached_meta.get(name, _NOT_WRITTEN) != value:
+                    if value is None:
+                        meta_deletes.append((source, topic_id, name))
+                    else:
+                        meta_rows.append((source, topic_id, name, value))
+                    cached_meta[name] = value
+
+            value_rows.extend((timestamp, source, topic_id, dumps(value))
+                              for timestamp, value in values)
+
+        if meta_rows:
+            c.executemany('''INSERT OR REPLACE INTO metadata values(?, ?, ?, ?)''',
+                          meta_rows)
+        if meta_deletes:
+            c.executemany('''DELETE FROM metadata
+                             WHERE source = ? AND topic_id = ? AND name = ?''',
+                          meta_deletes)
+        c.executemany('''INSERT OR REPLACE INTO outstanding values(NULL, ?, ?, ?, ?)''',
+                      value_rows)
+        c.close()
 
         self._connection.commit()
 
@@ -578,10 +636,35 @@ class BaseQueryHistorianAgent(Agent):
     to allow blocking while processing events.
     '''
 
+    # Seconds an unused paged query cursor is kept before it is dropped.
+    cursor_timeout = 300
+    max_cursors = 1000
+
+    def __init__(self, **kwargs):
+        super(BaseQueryHistorianAgent, self).__init__(**kwargs)
+        self._cursors = {}
+
     @RPC.export
     def query(self, topic=None, start=None, end=None, skip=0,
-              count=None, order="FIRST_TO_LAST"):
-        """Actual RPC handler"""
+              count=None, order="FIRST_TO_LAST", agg_type=None,
+              agg_period=None, page_size=None):
+        """Actual RPC handler
+
+        topic may be a single topic or a list of topics. When a list is
+        given, "values" and "metadata" in the result are dictionaries
+        keyed by topic.
+
+        If agg_type (one of AGGREGATION_TYPES) is given, values are
+        aggregated over buckets of agg_period, which is either seconds
+        or a string like '15m', and each value is timestamped with the
+        start of its bucket. skip and count then apply to buckets.
+
+        If page_size is given, at most page_size values are returned
+        and, when more may follow, the result includes a "cursor" to
+        pass to query_next for the next page. count then limits the
+        total over all pages. Paging is only available for a single
+        topic.
+        """
 
         if topic is None:
             raise TypeError('"Topic" required')
@@ -598,17 +681,122 @@ class BaseQueryHistorianAgent(Agent):
             except TypeError:
                 end = time_parser.parse(end)
 
+        agg_kwargs = {}
+        if agg_type is not None:
+            agg_type = agg_type.lower()
+            if agg_type not in AGGREGATION_TYPES:
+                raise ValueError('invalid aggregation type: {!r}'.format(agg_type))
+            if agg_period is None:
+                raise TypeError('"agg_period" required for aggregation')
+            agg_kwargs = {'agg_type': agg_type,
+                          'agg_period': parse_period(agg_period)}
+
         _log.debug("In base query")
 
         if start:
             _log.debug("start={}".format(start))
 
-        results = self.query_historian(topic, start, end, skip, count, order)
+        if page_size is not None:
+            if isinstance(topic, list):
+                raise TypeError('paging requires a single topic')
+            page_size = int(page_size)
+            if page_size <= 0:
+                raise ValueError('page_size must be positive')
+            state = {'topic': topic, 'start': start, 'end': end,
+                     'skip': skip, 'count': count, 'order': order,
+                     'agg_kwargs': agg_kwargs, 'page_size': page_size}
+            return self._query_page(state)
+
+        if isinstance(topic, list):
+            values = {}
+            metadata = {}
+            for name in topic:
+                results = self.query_historian(name, start, end, skip, count,
+                                               order, **agg_kwargs)
+                values[name] = results.get("values", [])
+                metadata[name] = results.get("metadata") or {}
+            return {'values': values, 'metadata': metadata}
+
+        results = self.query_historian(topic, start, end, skip, count, order,
+                                       **agg_kwargs)
         metadata = results.get("metadata")
         if metadata is None:
             results['metadata'] = {}
         return results
 
+    @RPC.export
+    def query_next(self, cursor):
+        """Return the next page of a paged query.
+
+        cursor is the value returned with the previous page. The result
+        has the same form as the query result; it includes a new cursor
+        while more values may follow.
+        """
+        self._expire_cursors()
+        try:
+            state = self._cursors.pop(cursor)
+        except KeyError:
+            raise ValueError('unknown or expired cursor: {!r}'.format(cursor))
+        return self._query_page(state)
+
+    def _query_page(self, state):
+        '''Fetch one page of the query described by state.
+
+        Raw values are paged by timestamp (keyset pagination): the next
+        page starts after the last timestamp returned, so each page is
+        an indexed range read regardless of how far into the results it
+        is. Aggregated values are few enough to page with skip.
+        '''
+        limit = state['page_size']
+        if state['count'] is not None:
+            limit = min(limit, state['count'])
+        results = self.query_historian(state['topic'], state['start'],
+                                       state['end'], state['skip'], limit,
+                                       state['order'], **state['agg_kwargs'])
+        if results.get('metadata') is None:
+            results['metadata'] = {}
+        values = results.get('values', [])
+
+        if state['count'] is not None:
+            state['count'] -= len(values)
+        if len(values) < limit or state['count'] == 0:
+            return results
+
+        if state['agg_kwargs']:
+            state['skip'] += len(values)
+        else:
+            # Historians store timestamps in UTC. Bind the cursor as UTC
+            # too so it compares equal to the stored value of the last
+            # row, which a naive datetime does not.
+            last = parse(values[-1][0])
+            if last.tzinfo is None:
+                last = last.replace(tzinfo=pytz.UTC)
+            else:
+                last = last.astimezone(pytz.UTC)
+            if state['order'] == 'LAST_TO_FIRST':
+                state['end'] = last
+            else:
+                state['start'] = last
+            state['skip'] = 0
+
+        self._expire_cursors()
+        if len(self._cursors) >= self.max_cursors:
+            # Drop the least recently used cursor.
+            oldest = min(self._cursors,
+                         key=lambda c: self._cursors[c]['accessed'])
+            del self._cursors[oldest]
+        cursor = uuid.uuid4().hex
+        state['accessed'] = time.time()
+        self._cursors[cursor] = state
+        results['cursor'] = cursor
+        return results
+
+    def _expire_cursors(self):
+        expired = time.time() - self.cursor_timeout
+        for cursor, state in self._cursors.items():
+            if state['accessed'] < expired:
+                del self._cursors[cursor]
+
     @RPC.export
     def get_topic_list(self):
         return self.query_topic_list()
@@ -624,6 +812,10 @@ class BaseQueryHistorianAgent(Agent):
          "metadata": {"key1": value1, "key2": value2, ...}}
 
          metadata is not required (The caller will normalize this to {} for you)
+
+         Historians supporting aggregation also accept agg_type and
+         agg_period (in seconds) keyword arguments. They are only passed
+         when the caller requested an aggregation.
         """
 
 class BaseHistorian(BaseHistorianAgent, BaseQueryHistorianAgent):
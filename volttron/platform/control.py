@@ -72,9 +72,11 @@ import traceback
 import gevent
 import gevent.event
 from zmq import curve_keypair
+from zmq.utils import jsonapi
 
 from .agent import utils
 from .vip.agent import Agent as BaseAgent, RPC
+from .vip.agent.subsystems.query import Query
 from .vip.socket import encode_key
 from . import aip as aipmod
 from . import config
@@ -433,6 +435,111 @@ def shutdown_agents(opts):
     if opts.platform:
         opts.connection.notify('stop_platform')
 
+def _format_size(size):
+    for unit in ['B', 'K', 'M', 'G']:
+        if size < 1024 or unit == 'G':
+            break
+        size /= 1024.0
+    return '{:.0f}{}'.format(size, unit) if unit == 'B' else \
+        '{:.1f}{}'.format(size, unit)
+
+def _format_seconds(value):
+    return '-' if value is None else '{:.1f}ms'.format(value * 1000)
+
+def show_stats(opts):
+    stats = {'router': opts.connection.query('stats')}
+    for peer in ['pubsub'] + opts.peer:
+        stats[peer] = opts.connection.call_peer(peer, 'vip.stats')
+    if opts.json:
+        _stdout.write(jsonapi.dumps(stats, indent=2, sort_keys=True) + '\n')
+        return
+    router = stats['router']
+    if router is None:
+        _stderr.write('{}: router statistics are disabled; start the '
+                      'platform with --router-stats\n'.format(opts.command))
+        router = {'uptime': 0, 'peers': {}, 'subsystems': {}, 'drops': {}}
+    peers = sorted(router['peers'].iteritems(),
+                   key=lambda item: item[1]['bytes_in'], reverse=True)
+    width = max([4] + [len(peer) for peer, _ in peers])
+    fmt = '{:{}} {:>10} {:>9} {:>10} {:>9} {:>7}\n'
+    _stdout.write('Router up {:.0f}s; drops: {}\n\n'.format(
+        router['uptime'], ', '.join('{} {}'.format(name, count) for
+                                    name, count in router['drops'].iteritems())
+        or 'none'))
+    _stdout.write(fmt.format('PEER', width, 'MSGS IN', 'BYTES IN',
+                             'MSGS OUT', 'BYTES OUT', 'DROPS'))
+    for peer, counts in peers[:opts.limit] if opts.limit else peers:
+        _stdout.write(fmt.format(
+            peer, width, counts['messages_in'],
+            _format_size(counts['bytes_in']), counts['messages_out'],
+            _format_size(counts['bytes_out']), sum(counts['drops'].values())))
+    _stdout.write('\n{:12} {:>10} {:>9}\n'.format('SUBSYSTEM', 'MSGS', 'BYTES'))
+    for name, counts in sorted(router['subsystems'].iteritems()):
+        _stdout.write('{:12} {:>10} {:>9}\n'.format(
+            name, counts['messages'], _format_size(counts['bytes'])))
+    fanout = stats['pubsub']['pubsub']['fanout']
+    _stdout.write('\nPubsub messages {}; subscribers per message '
+                  'p50 {} p99 {} max {}\n'.format(
+                      fanout['count'], fanout['p50'], fanout['p99'],
+                      fanout['max']))
+    for peer in opts.peer:
+        rpc = stats[peer]['rpc']
+        _stdout.write('\nRPC calls made by {} (pool: {} active, {} queued, '
+                      '{} rejected)\n'.format(peer, rpc['pool']['active'],
+                                              rpc['pool']['queued'],
+                                              rpc['pool']['rejected']))
+        _stdout.write('{:30} {:>8} {:>8} {:>9} {:>9} {:>9}\n'.format(
+            'METHOD', 'CALLS', 'FAILED', 'P50', 'P99', 'MAX'))
+        for method, latency in sorted(rpc['latency'].iteritems()):
+            _stdout.write('{:30} {:>8} {:>8} {:>9} {:>9} {:>9}\n'.format(
+                method, latency['count'], rpc['failures'].get(method, 0),
+                _format_seconds(latency['p50']),
+                _format_seconds(latency['p99']),
+                _format_seconds(latency['max'])))
+        trace = stats[peer]['pubsub']['trace']
+        if not trace:
+            continue
+        _stdout.write('\nTraced pubsub messages received by {}\n'.format(peer))
+        _stdout.write('{:30} {:>8} {:>9} {:>9} {:>9} {:>9}\n'.format(
+            'TOPIC PREFIX', 'MSGS', 'P50', 'P99', 'QUEUE P50', 'QUEUE P99'))
+        for prefix, delays in sorted(trace.iteritems()):
+            latency, queueing = delays['latency'], delays['queueing']
+            _stdout.write('{:30} {:>8} {:>9} {:>9} {:>9} {:>9}\n'.format(
+                prefix, latency['count'], _format_seconds(latency['p50']),
+                _format_seconds(latency['p99']),
+                _format_seconds(queueing['p50']),
+                _format_seconds(queueing['p99'])))
+
+def profile_agent(opts):
+    agents = _list_agents(opts.aip)
+    match = filter_agent(agents, opts.pattern, opts)
+    if len(match) > 1:
+        _stderr.write('{}: error: multiple agents selected: {}\n'.format(
+            opts.command, opts.pattern))
+        return 10
+    # Agents run by the platform use their UUID as their VIP identity;
+    # anything else is taken to be the identity of a running peer.
+    peer = match.pop().uuid if match else opts.pattern
+    call = opts.connection.call_peer
+    call(peer, 'profile.start', opts.rate, opts.seconds)
+    try:
+        gevent.sleep(opts.seconds)
+    finally:
+        result = call(peer, 'profile.stop')
+    if result is None:
+        _stderr.write('{}: error: profile of {} was lost\n'.format(
+            opts.command, peer))
+        return 10
+    output = open(opts.output, 'w') if opts.output else _stdout
+    try:
+        for line in result['stacks']:
+            output.write(line + '\n')
+    finally:
+        if opts.output:
+            output.close()
+    _stderr.write('Collected {} samples from {} over {:.1f}s\n'.format(
+        result['samples'], peer, result['duration']))
+
 def create_cgroups(opts):
     try:
         cgroups.setup(user=opts.user, group=opts.group)
@@ -505,6 +612,7 @@ class Connection(object):
         self.address = address
         self.peer = peer
         self._server = BaseAgent(address=self.address)
+        self._server.vip.query = Query(self._server.core)
         self._greenlet = None
 
     @property
@@ -519,6 +627,13 @@ class Connection(object):
         return self.server.vip.rpc.call(
             self.peer, method, *args, **kwargs).get()
 
+    def call_peer(self, peer, method, *args, **kwargs):
+        return self.server.vip.rpc.call(
+            peer, method, *args, **kwargs).get()
+
+    def query(self, prop):
+        return self.server.vip.query(prop).get()
+
     def notify(self, method, *args, **kwargs):
         return self.server.vip.rpc.notify(
             self.peer, method, *args, **kwargs)
@@ -711,6 +826,30 @@ def main(argv=sys.argv):
         help='generate CurveMQ keys for encrypting VIP connections')
     keypair.set_defaults(func=print_keypair)
 
+    stats = add_parser('stats',
+        help='show message bus traffic statistics')
+    stats.add_argument('--peer', action='append', metavar='IDENTITY',
+        help='also show RPC statistics of the agent with IDENTITY; '
+             'may be used multiple times')
+    stats.add_argument('-n', '--limit', type=int, metavar='N',
+        help='show only the N peers sending the most data')
+    stats.add_argument('--json', action='store_true',
+        help='print raw statistics as JSON')
+    stats.set_defaults(func=show_stats, peer=[], limit=None, json=False)
+
+    profile = add_parser('profile', parents=[filterable],
+        help='sample the call stacks of a running agent')
+    profile.add_argument('pattern', metavar='AGENT',
+        help='UUID or name of agent, or VIP identity of a peer')
+    profile.add_argument('--seconds', type=float, metavar='N',
+        help='sample for N seconds (default: %(default)s)')
+    profile.add_argument('--rate', type=float, metavar='HZ',
+        help='samples per second (default: %(default)s)')
+    profile.add_argument('-o', '--output', metavar='FILE',
+        help='write collapsed stacks to FILE instead of stdout')
+    profile.set_defaults(func=profile_agent, seconds=10, rate=100,
+                         output=None)
+
     if HAVE_RESTRICTED:
         cgroup = add_parser('create-cgroups',
             help='setup VOLTTRON control group for restricted execution')
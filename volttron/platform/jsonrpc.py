@@ -278,6 +278,14 @@ class Dispatcher(object):
         except ValueError as exc:
             return self.serialize(json_error(
                 None, PARSE_ERROR, 'invalid JSON', detail=str(exc)))
+        return self.dispatch_object(message, context)
+
+    def dispatch_object(self, message, context=None):
+        '''Dispatch a deserialized message and return a response or None.
+
+        Allows callers to inspect a message, such as to schedule it,
+        before it is dispatched without deserializing it twice.
+        '''
         if isinstance(message, list):
             dispatch = self._dispatch_one
             with self.batch(message) as batch:
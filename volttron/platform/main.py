@@ -71,6 +71,7 @@ import threading
 import uuid
 
 import gevent
+import gevent.subprocess
 from zmq import curve_keypair
 import zmq
 from zmq.utils import jsonapi
@@ -82,6 +83,7 @@ from . import vip
 from .vip.agent import Agent, Core
 from .vip.agent.compat import CompatPubSub
 from .vip.router import *
+from .vip.metrics import RouterMetrics
 from .vip.socket import encode_key, Address
 from .auth import AuthService
 from .control import ControlService
@@ -247,7 +249,7 @@ class Router(BaseRouter):
 
     def __init__(self, local_address, addresses=(),
                  context=None, secretkey=None, default_user_id=None,
-                 monitor=False):
+                 monitor=False, stats=False):
         super(Router, self).__init__(
             context=context, default_user_id=default_user_id)
         self.local_address = Address(local_address)
@@ -257,6 +259,8 @@ class Router(BaseRouter):
         if self.logger.level == logging.NOTSET:
             self.logger.setLevel(logging.WARNING)
         self._monitor = monitor
+        if stats:
+            self.metrics = RouterMetrics()
 
     def setup(self):
         sock = self.socket
@@ -286,6 +290,10 @@ class Router(BaseRouter):
             address.bind(sock)
             _log.debug('Additional VIP router bound to %s' % address)
 
+    def tracing(self):
+        # Formatting frames is only worthwhile if they will be logged.
+        return self.logger.isEnabledFor(logging.DEBUG)
+
     def issue(self, topic, frames, extra=None):
         log = self.logger.debug
         formatter = FramesFormatter(frames)
@@ -314,6 +322,8 @@ class Router(BaseRouter):
                         value = [addr.base for addr in self.addresses]
                     else:
                         value = [self.local_address.base]
+                elif name == b'stats' and self.metrics is not None:
+                    value = self.metrics.snapshot()
                 else:
                     value = None
             frames[6:] = [b'', jsonapi.dumps(value)]
@@ -327,6 +337,35 @@ class PubSubService(Agent):
         self.vip.pubsub.add_bus('')
 
 
+def start_worker(opts, services):
+    '''Start services in a worker process connected over ipc://.
+
+    The returned process must be waited on; its exit, like that of any
+    other platform service, shuts down the platform.
+    '''
+    args = [sys.executable, '-m', 'volttron.platform.worker']
+    args.extend(services)
+    args.extend(['--vip-address', opts.vip_local_address,
+                 '--publish-address', opts.publish_address,
+                 '--subscribe-address', opts.subscribe_address,
+                 '--verboseness', str(opts.verboseness)])
+    if opts.log and opts.log != '-':
+        args.extend(['--log', opts.log])
+    _log.info('starting %s in a worker process', ', '.join(services))
+    return gevent.subprocess.Popen(args)
+
+
+def wait_for_peers(agent, peers, timeout=60):
+    '''Wait until peers are connected to the router.'''
+    remaining = set(peers)
+    with gevent.Timeout(timeout):
+        while True:
+            remaining.difference_update(agent.vip.peerlist().get(timeout=5))
+            if not remaining:
+                return
+            gevent.sleep(0.1)
+
+
 def main(argv=sys.argv):
     # Refuse to run as root
     if not getattr(os, 'getuid', lambda: -1)():
@@ -367,6 +406,9 @@ def main(argv=sys.argv):
     parser.add_argument(
         '--monitor', action='store_true',
         help='monitor and log connections (implies -v)')
+    parser.add_argument(
+        '--router-stats', action='store_true',
+        help='count message bus traffic for volttron-ctl stats')
     parser.add_argument(
         '-q', '--quiet', action='add_const', const=10, dest='verboseness',
         help='decrease logger verboseness; may be used multiple times')
@@ -404,6 +446,13 @@ def main(argv=sys.argv):
     agents.add_argument(
         '--vip-local-address', metavar='ZMQADDR',
         help='ZeroMQ URL to bind for local agent VIP connections')
+    agents.add_argument(
+        '--pubsub-process', action='store_true',
+        inverse='--no-pubsub-process',
+        help='run the pubsub services in a separate worker process')
+    agents.add_argument(
+        '--no-pubsub-process', action='store_false', dest='pubsub_process',
+        help=argparse.SUPPRESS)
 
     # XXX: re-implement control options
     #on
@@ -464,6 +513,7 @@ def main(argv=sys.argv):
         log=None,
         log_config=None,
         monitor=False,
+        router_stats=False,
         verboseness=logging.WARNING,
         volttron_home=volttron_home,
         autostart=True,
@@ -471,6 +521,7 @@ def main(argv=sys.argv):
         subscribe_address=ipc + 'subscribe',
         vip_address=[],
         vip_local_address=ipc + 'vip.socket',
+        pubsub_process=False,
         #allow_root=False,
         #allow_users=None,
         #allow_groups=None,
@@ -598,13 +649,14 @@ def main(argv=sys.argv):
         try:
             Router(opts.vip_local_address, opts.vip_address,
                    secretkey=secretkey, default_user_id=b'vip.service',
-                   monitor=opts.monitor).run()
+                   monitor=opts.monitor, stats=opts.router_stats).run()
         except Exception:
             _log.exception('Unhandled exception in router loop')
         finally:
             stop()
 
     address = 'inproc://vip'
+    worker = None
     try:
         # Ensure auth service is running before router
         auth_file = os.path.join(volttron_home, 'auth.json')
@@ -623,19 +675,25 @@ def main(argv=sys.argv):
 
         # Launch additional services and wait for them to start before
         # auto-starting agents
-        services = [
-            ControlService(opts.aip, address=address, identity='control'),
-            PubSubService(address=address, identity='pubsub'),
-            CompatPubSub(address=address, identity='pubsub.compat',
-                         publish_address=opts.publish_address,
-                         subscribe_address=opts.subscribe_address),
-        ]
+        control = ControlService(opts.aip, address=address, identity='control')
+        services = [control]
+        if not opts.pubsub_process:
+            services.extend([
+                PubSubService(address=address, identity='pubsub'),
+                CompatPubSub(address=address, identity='pubsub.compat',
+                             publish_address=opts.publish_address,
+                             subscribe_address=opts.subscribe_address),
+            ])
         events = [gevent.event.Event() for service in services]
         tasks = [gevent.spawn(service.core.run, event)
                  for service, event in zip(services, events)]
         tasks.append(auth_task)
         gevent.wait(events)
         del events
+        if opts.pubsub_process:
+            worker = start_worker(opts, ['pubsub', 'pubsub.compat'])
+            tasks.append(gevent.spawn(worker.wait))
+            wait_for_peers(control, ['pubsub', 'pubsub.compat'])
 
         # Auto-start agents now that all services are up
         if opts.autostart:
@@ -651,6 +709,9 @@ def main(argv=sys.argv):
                 task.kill(block=False)
             gevent.wait(tasks)
     finally:
+        if worker is not None and worker.poll() is None:
+            worker.terminate()
+            worker.wait()
         opts.aip.finish()
 
 
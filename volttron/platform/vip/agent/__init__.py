@@ -65,18 +65,20 @@ from .subsystems import *
 
 class Agent(object):
     class Subsystems(object):
-        def __init__(self, owner, core):
+        def __init__(self, owner, core, serializer=None):
             self.peerlist = PeerList(core)
             self.ping = Ping(core)
-            self.rpc = RPC(core, owner)
+            self.rpc = RPC(core, owner, self.peerlist, serializer)
             self.hello = Hello(core)
             self.pubsub = PubSub(core, self.rpc, self.peerlist, owner)
             self.channel = Channel(core)
+            self.profiler = Profiler(core, self.rpc)
 
-    def __init__(self, identity=None, address=None, context=None):
+    def __init__(self, identity=None, address=None, context=None,
+                 serializer=None):
         self.core = Core(
             self, identity=identity, address=address, context=context)
-        self.vip = Agent.Subsystems(self, self.core)
+        self.vip = Agent.Subsystems(self, self.core, serializer)
         self.core.setup()
 
 
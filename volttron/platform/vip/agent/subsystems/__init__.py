@@ -61,8 +61,10 @@ from .channel import Channel
 from .hello import Hello
 from .peerlist import PeerList
 from .ping import Ping
+from .profiler import Profiler
 from .pubsub import PubSub
 from .rpc import RPC
 
 
-__all__ = ['PeerList', 'Ping', 'RPC', 'Hello', 'PubSub', 'Channel']
+__all__ = ['PeerList', 'Ping', 'RPC', 'Hello', 'PubSub', 'Channel',
+           'Profiler']
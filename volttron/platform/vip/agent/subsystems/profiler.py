@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+'''Sampling profiler for running agents.
+
+A sampler thread periodically records the stack of whichever greenlet
+is running in the agent's hub thread. Samples are counted as collapsed
+stacks, one line per distinct stack of semicolon separated frames
+followed by its count, which flamegraph.pl and speedscope read as is.
+Profiling is started and stopped over RPC, usually by volttron-ctl
+profile, and costs nothing while stopped.
+'''
+
+from __future__ import absolute_import
+
+from collections import defaultdict
+import logging
+import os
+import sys
+import weakref
+
+from .base import SubsystemBase
+
+try:
+    from gevent.monkey import get_original
+except ImportError:
+    def get_original(mod_name, item_name):
+        return getattr(__import__(mod_name), item_name)
+
+
+__all__ = ['Profiler']
+
+
+_log = logging.getLogger(__name__)
+
+_start_new_thread = get_original('thread', 'start_new_thread')
+_get_ident = get_original('thread', 'get_ident')
+_sleep = get_original('time', 'sleep')
+_time = get_original('time', 'time')
+
+
+class _Session(object):
+    '''Samples collected by one run of the sampler thread.'''
+
+    def __init__(self, ident, rate, seconds):
+        self.ident = ident
+        self.rate = rate
+        self.start = _time()
+        self.deadline = self.start + seconds
+        self.end = None
+        self.samples = 0
+        self.stacks = defaultdict(int)
+        self.stopped = False
+
+    def summary(self):
+        end = self.end or _time()
+        return {'rate': self.rate, 'samples': self.samples,
+                'duration': end - self.start, 'running': self.end is None}
+
+
+class Profiler(SubsystemBase):
+    '''Profile the agent on request of a peer.
+
+    The profile.start, profile.stop and profile.status methods are
+    exported over RPC. Sampling stops by itself after the requested
+    number of seconds so an abandoned profile cannot run forever.
+    '''
+
+    max_rate = 1000
+    max_seconds = 3600
+
+    def __init__(self, core, rpc_subsys):
+        self.core = weakref.ref(core)
+        self._session = None
+        self._labels = {}
+        # Frames are labeled with paths relative to sys.path.
+        self._prefixes = sorted((os.path.join(os.path.abspath(path), '')
+                                 for path in sys.path if path),
+                                key=len, reverse=True)
+
+        def setup(sender, **kwargs):
+            # pylint: disable=unused-argument
+            rpc_subsys.export(self.start, 'profile.start')
+            rpc_subsys.export(self.stop, 'profile.stop')
+            rpc_subsys.export(self.status, 'profile.status')
+        core.onsetup.connect(setup, self)
+
+    def start(self, rate=100, seconds=60):
+        '''Begin sampling rate times per second for at most seconds.
+
+        Samples from a previous, uncollected run are discarded.
+        '''
+        rate = min(max(float(rate), 1), self.max_rate)
+        seconds = min(max(float(seconds), 0), self.max_seconds)
+        if self._session is not None:
+            self._session.stopped = True
+        session = _Session(_get_ident(), rate, seconds)
+        self._session = session
+        _start_new_thread(self._sample, (session,))
+        _log.info('profiling at %g Hz for %gs', rate, seconds)
+        return session.summary()
+
+    def stop(self):
+        '''Stop sampling and return the collapsed stacks.
+
+        The result has the summary returned by status and a stacks list
+        of "frame;frame;frame count" lines, outermost frame first.
+        '''
+        session = self._session
+        if session is None:
+            return None
+        session.stopped = True
+        if session.end is None:
+            session.end = _time()
+        self._session = None
+        result = session.summary()
+        result['stacks'] = ['{} {}'.format(stack, count) for stack, count
+                            in sorted(dict(session.stacks).iteritems())]
+        return result
+
+    def status(self):
+        session = self._session
+        return None if session is None else session.summary()
+
+    def _sample(self, session):
+        # Runs in its own thread; it must not touch gevent.
+        interval = 1.0 / session.rate
+        frames = sys._current_frames   # pylint: disable=protected-access
+        label = self._label
+        stacks = session.stacks
+        while not session.stopped:
+            _sleep(interval)
+            frame = frames().get(session.ident)
+            stack = []
+            while frame is not None:
+                stack.append(label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                stacks[';'.join(stack)] += 1
+                session.samples += 1
+            if _time() >= session.deadline:
+                break
+        if session.end is None:
+            session.end = _time()
+
+    def _label(self, code):
+        try:
+            return self._labels[code]
+        except KeyError:
+            pass
+        filename = code.co_filename
+        for prefix in self._prefixes:
+            if filename.startswith(prefix):
+                filename = filename[len(prefix):]
+                break
+        # Semicolons separate frames in collapsed stacks.
+        label = '{} ({}:{})'.format(
+            code.co_name, filename, code.co_firstlineno).replace(';', ':')
+        self._labels[code] = label
+        return label
@@ -58,10 +58,15 @@
 from __future__ import absolute_import
 
 from base64 import b64encode, b64decode
+from collections import defaultdict
 import inspect
+import logging
+import os
 import random
 import weakref
 
+import gevent
+import monotonic as clock
 from zmq import green as zmq
 from zmq import SNDMORE
 from zmq.utils import jsonapi
@@ -69,10 +74,20 @@ from zmq.utils import jsonapi
 from .base import SubsystemBase
 from ..decorators import annotate, annotations, dualmethod, spawn
 from ..errors import Unreachable
+from ...metrics import COUNT_BOUNDS, Histogram
+from ...serializers import SERIALIZERS
 from .... import jsonrpc
 
 
-__all__ = ['PubSub']
+__all__ = ['PubSub', 'TopicTrie', 'TRACE_HEADER']
+
+
+# Header carrying monotonic clock timestamps of a traced message. The
+# publisher sets 'published' and the pubsub service adds 'distributed'.
+TRACE_HEADER = 'VIP-Trace'
+
+
+_log = logging.getLogger(__name__)
 
 
 def encode_peer(peer):
@@ -85,14 +100,174 @@ def decode_peer(peer):
         return peer[:1] + b64decode(peer[1:])
     return peer
 
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def _from_utf8(frame):
+    # Mirror the JSON decoder, which returns str for ASCII strings.
+    value = bytes(frame)
+    try:
+        value.decode('ascii')
+    except UnicodeDecodeError:
+        return value.decode('utf-8')
+    return value
+
+
+class _TrieNode(object):
+    __slots__ = ['children', 'fragments']
+
+    def __init__(self):
+        self.children = {}
+        self.fragments = {}
+
+
+class TopicTrie(object):
+    '''Index of subscribed topic prefixes keyed by topic segment.
+
+    Prefixes are split on '/' into complete segments, which form the
+    path through the trie, and a trailing (possibly partial) segment,
+    which is stored in the fragments of the final node. Matching a topic
+    walks its segments and only tests the fragments found along that
+    path, so the cost is proportional to the depth of the topic rather
+    than the number of subscriptions. Plain string prefix semantics are
+    preserved: 'devices/bu' still matches 'devices/building1/all'.
+
+    Results of match() are cached per topic and the cache is cleared
+    whenever a subscription changes.
+    '''
+
+    cache_limit = 10000
+
+    def __init__(self):
+        self._prefixes = {}
+        self._root = _TrieNode()
+        self._cache = {}
+
+    def __len__(self):
+        return len(self._prefixes)
+
+    def __iter__(self):
+        return iter(self._prefixes)
+
+    def __contains__(self, prefix):
+        return prefix in self._prefixes
+
+    def __getitem__(self, prefix):
+        return self._prefixes[prefix]
+
+    def keys(self):
+        return self._prefixes.keys()
+
+    def iteritems(self):
+        return self._prefixes.iteritems()
+
+    def add(self, prefix, peer):
+        '''Add peer to the subscribers of prefix.'''
+        try:
+            subscribers = self._prefixes[prefix]
+        except KeyError:
+            self._prefixes[prefix] = subscribers = set()
+            segments = prefix.split('/')
+            node = self._root
+            for segment in segments[:-1]:
+                try:
+                    node = node.children[segment]
+                except KeyError:
+                    node.children[segment] = node = _TrieNode()
+            node.fragments[segments[-1]] = subscribers
+        if peer not in subscribers:
+            subscribers.add(peer)
+            self._cache.clear()
+
+    def discard(self, prefix, peer):
+        '''Remove peer from the subscribers of prefix.
+
+        The prefix is removed from the index when it no longer has any
+        subscribers. KeyError is raised if prefix is not subscribed.
+        '''
+        subscribers = self._prefixes[prefix]
+        if peer in subscribers:
+            subscribers.discard(peer)
+            self._cache.clear()
+        if not subscribers:
+            self._remove(prefix)
+
+    def discard_peer(self, peer):
+        '''Remove peer from all subscriptions.'''
+        for prefix, subscribers in self._prefixes.items():
+            if peer in subscribers:
+                self.discard(prefix, peer)
+
+    def _remove(self, prefix):
+        del self._prefixes[prefix]
+        segments = prefix.split('/')
+        node = self._root
+        path = []
+        for segment in segments[:-1]:
+            path.append((node, segment))
+            node = node.children[segment]
+        del node.fragments[segments[-1]]
+        while path and not (node.children or node.fragments):
+            node, segment = path.pop()
+            del node.children[segment]
+        self._cache.clear()
+
+    def match(self, topic):
+        '''Return a frozenset of all peers subscribed to topic.'''
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+        subscribers = set()
+        node = self._root
+        for segment in topic.split('/'):
+            fragments = node.fragments
+            if fragments:
+                if len(fragments) <= len(segment):
+                    for fragment, peers in fragments.iteritems():
+                        if segment.startswith(fragment):
+                            subscribers |= peers
+                else:
+                    for i in xrange(len(segment) + 1):
+                        peers = fragments.get(segment[:i])
+                        if peers:
+                            subscribers |= peers
+            node = node.children.get(segment)
+            if node is None:
+                break
+        subscribers = frozenset(subscribers)
+        if len(self._cache) >= self.cache_limit:
+            self._cache.clear()
+        self._cache[topic] = subscribers
+        return subscribers
+
 
 class PubSub(SubsystemBase):
+    # Number of topic segments traced message delays are grouped by.
+    trace_depth = 2
+    # Seconds to wait for a subscriber to confirm it accepts frame pushes.
+    negotiate_timeout = 30
+
     def __init__(self, core, rpc_subsys, peerlist_subsys, owner):
         self.core = weakref.ref(core)
         self.rpc = weakref.ref(rpc_subsys)
         self.peerlist = weakref.ref(peerlist_subsys)
         self._peer_subscriptions = {}
         self._my_subscriptions = {}
+        # Whether each subscriber accepts pushes over the pubsub subsystem.
+        # Others, including peers predating it, get pubsub.push requests.
+        self._frame_peers = {}
+        # Number of subscribers each published message was pushed to.
+        self._fanout = Histogram(COUNT_BOUNDS)
+        # Publish to dispatch, publish to distribution and distribution
+        # to dispatch delays of traced messages, by topic prefix.
+        self.trace = bool(os.environ.get('VOLTTRON_PUBSUB_TRACE'))
+        self._delays = defaultdict(
+            lambda: (Histogram(), Histogram(), Histogram()))
+        core.register('pubsub', self._handle_subsystem)
+        rpc_subsys.add_stats('pubsub', self._stats)
 
         def setup(sender, **kwargs):
             # pylint: disable=unused-argument
@@ -101,7 +276,9 @@ class PubSub(SubsystemBase):
             rpc_subsys.export(self._peer_unsubscribe, 'pubsub.unsubscribe')
             rpc_subsys.export(self._peer_list, 'pubsub.list')
             rpc_subsys.export(self._peer_publish, 'pubsub.publish')
+            rpc_subsys.export(self._peer_publish_many, 'pubsub.publish_many')
             rpc_subsys.export(self._peer_push, 'pubsub.push')
+            rpc_subsys.export(self._peer_frames, 'pubsub.frames')
             core.onconnected.connect(self._connected)
             core.onviperror.connect(self._viperror)
             peerlist_subsys.onadd.connect(self._peer_add)
@@ -116,7 +293,8 @@ class PubSub(SubsystemBase):
         core.onsetup.connect(setup, self)
 
     def add_bus(self, name):
-        self._peer_subscriptions.setdefault(name, {})
+        if name not in self._peer_subscriptions:
+            self._peer_subscriptions[name] = TopicTrie()
 
     def remove_bus(self, name):
         del self._peer_subscriptions[name]
@@ -136,26 +314,21 @@ class PubSub(SubsystemBase):
         self.core().spawn_later(delay, self.synchronize, peer)
 
     def _peer_drop(self, sender, peer, **kwargs):
+        self._frame_peers.pop(peer, None)
         self._sync(peer, {})
 
     def _sync(self, peer, items):
         items = {(bus, prefix) for bus, topics in items.iteritems()
                  for prefix in topics}
-        remove = []
         for bus, subscriptions in self._peer_subscriptions.iteritems():
-            for prefix, subscribers in subscriptions.iteritems():
+            for prefix in subscriptions.keys():
                 item = bus, prefix
                 try:
                     items.remove(item)
                 except KeyError:
-                    subscribers.discard(peer)
-                    if not subscribers:
-                        remove.append(item)
+                    subscriptions.discard(prefix, peer)
                 else:
-                    subscribers.add(peer)
-        for bus, prefix in remove:
-            subscriptions = self._peer_subscriptions[bus]
-            assert not subscriptions.pop(prefix)
+                    subscriptions.add(prefix, peer)
         for bus, prefix in items:
             self._add_peer_subscription(peer, bus, prefix)
 
@@ -165,12 +338,7 @@ class PubSub(SubsystemBase):
         self._sync(peer, items)
 
     def _add_peer_subscription(self, peer, bus, prefix):
-        subscriptions = self._peer_subscriptions[bus]
-        try:
-            subscribers = subscriptions[prefix]
-        except KeyError:
-            subscriptions[prefix] = subscribers = set()
-        subscribers.add(peer)
+        self._peer_subscriptions[bus].add(prefix, peer)
 
     def _peer_subscribe(self, prefix, bus=''):
         peer = bytes(self.rpc().context.vip_message.peer)
@@ -181,19 +349,10 @@ class PubSub(SubsystemBase):
         peer = bytes(self.rpc().context.vip_message.peer)
         subscriptions = self._peer_subscriptions[bus]
         if prefix is None:
-            remove = []
-            for topic, subscribers in subscriptions.iteritems():
-                subscribers.discard(peer)
-                if not subscribers:
-                    remove.append(topic)
-            for topic in remove:
-                del subscriptions[topic]
+            subscriptions.discard_peer(peer)
         else:
             for prefix in prefix if isinstance(prefix, list) else [prefix]:
-                subscribers = subscriptions[prefix]
-                subscribers.discard(peer)
-                if not subscribers:
-                    del subscriptions[prefix]
+                subscriptions.discard(prefix, peer)
 
     def _peer_list(self, prefix='', bus='', subscribed=True, reverse=False):
         peer = bytes(self.rpc().context.vip_message.peer)
@@ -218,43 +377,228 @@ class PubSub(SubsystemBase):
         peer = bytes(self.rpc().context.vip_message.peer)
         self._distribute(peer, topic, headers, message, bus)
 
+    def _peer_publish_many(self, messages, bus=''):
+        peer = bytes(self.rpc().context.vip_message.peer)
+        for topic, headers, message in messages:
+            self._distribute(peer, topic, headers, message, bus)
+
     def _distribute(self, peer, topic, headers, message=None, bus=''):
-        subscriptions = self._peer_subscriptions[bus]
-        subscribers = set()
-        for prefix, subscription in subscriptions.iteritems():
-            if subscription and topic.startswith(prefix):
-                subscribers |= subscription
+        subscribers = self._peer_subscriptions[bus].match(topic)
+        self._fanout.add(len(subscribers))
         if subscribers:
-            sender = encode_peer(peer)
-            json_msg = jsonapi.dumps(jsonrpc.json_method(
-                None, 'pubsub.push',
-                [sender, bus, topic, headers, message], None))
-            frames = [zmq.Frame(b''), zmq.Frame(b''),
-                      zmq.Frame(b'RPC'), zmq.Frame(json_msg)]
+            # Headers may be any JSON value; only dicts carry a trace.
+            if isinstance(headers, dict):
+                trace = headers.get(TRACE_HEADER)
+                if isinstance(trace, dict):
+                    trace['distributed'] = clock.monotonic()
+            # Frames are built and serialized once per serializer in use
+            # and the same zmq.Frame objects are sent, without copying,
+            # to every subscriber. Topic and headers are kept out of the
+            # message body so subscribers can filter before decoding it.
+            #   [USER_ID, MSG_ID, SUBSYS, OP, [CONTENT_TYPE,] SENDER,
+            #    BUS, TOPIC, HEADERS, MESSAGE]
+            serializer_for = self.rpc().serializer_for
+            encoded = {}
             socket = self.core().socket
             for subscriber in subscribers:
+                if not self._pushes_frames(subscriber):
+                    try:
+                        frames = encoded[None]
+                    except KeyError:
+                        frames = encoded[None] = self._push_request(
+                            peer, bus, topic, headers, message)
+                    socket.send(subscriber, flags=SNDMORE)
+                    socket.send_multipart(frames, copy=False)
+                    continue
+                serializer = serializer_for(subscriber)
+                try:
+                    frames = encoded[serializer.name]
+                except KeyError:
+                    frames = [zmq.Frame(b''), zmq.Frame(b''),
+                              zmq.Frame(b'pubsub'), zmq.Frame(b'push'),
+                              zmq.Frame(peer), zmq.Frame(_utf8(bus)),
+                              zmq.Frame(_utf8(topic)),
+                              zmq.Frame(serializer.dumps(headers)),
+                              zmq.Frame(serializer.dumps(message))]
+                    if serializer.name != 'json':
+                        frames.insert(4, zmq.Frame(serializer.content_type))
+                    encoded[serializer.name] = frames
                 socket.send(subscriber, flags=SNDMORE)
                 socket.send_multipart(frames, copy=False)
         return len(subscribers)
 
-    def _peer_push(self, sender, bus, topic, headers, message):
-        '''Handle incoming subscription pushes from peers.'''
-        peer = bytes(self.rpc().context.vip_message.peer)
-        handled = 0
+    @staticmethod
+    def _push_request(peer, bus, topic, headers, message):
+        json_msg = jsonapi.dumps(jsonrpc.json_method(
+            None, 'pubsub.push',
+            [encode_peer(peer), bus, topic, headers, message], None))
+        return [zmq.Frame(b''), zmq.Frame(b''),
+                zmq.Frame(b'RPC'), zmq.Frame(json_msg)]
+
+    def _pushes_frames(self, peer):
+        '''Return whether pushes to peer may be sent as pubsub frames.
+
+        Pushes are sent as pubsub.push requests until the peer has
+        confirmed support, which is asked of it on first use.
+        '''
         try:
-            subscriptions = self._my_subscriptions[peer][bus]
+            return self._frame_peers[peer]
         except KeyError:
             pass
+        self._frame_peers[peer] = False
+        self.core().spawn(self._negotiate, peer)
+        return False
+
+    def _negotiate(self, peer):
+        try:
+            self.rpc().call(peer, 'pubsub.frames').get(
+                timeout=self.negotiate_timeout)
+        except (Exception, gevent.Timeout):   # pylint: disable=broad-except
+            # Peers predating frame pushes only accept pubsub.push.
+            return
+        if peer in self._frame_peers:
+            self._frame_peers[peer] = True
+
+    def _peer_frames(self):
+        return True
+
+    def _stats(self):
+        delays = {}
+        for prefix, histograms in self._delays.iteritems():
+            delays[prefix] = dict(zip(
+                ['latency', 'queueing', 'delivery'],
+                [histogram.snapshot() for histogram in histograms]))
+        return {'fanout': self._fanout.snapshot(),
+                'subscriptions': {bus: len(subscriptions) for bus, subscriptions
+                                  in self._peer_subscriptions.iteritems()},
+                'trace': delays}
+
+    def trace_headers(self, headers):
+        '''Return headers stamped for tracing, if tracing is enabled.
+
+        A copy of headers is returned with the publish time added under
+        TRACE_HEADER unless it already has one, which lets a publisher
+        stamp messages once and retry them without losing the delay.
+        '''
+        if not self.trace:
+            return headers
+        if headers is None:
+            headers = {}
+        elif not isinstance(headers, dict) or TRACE_HEADER in headers:
+            return headers
+        headers = dict(headers)
+        headers[TRACE_HEADER] = {'published': clock.monotonic()}
+        return headers
+
+    def _dispatched(self, topic, headers):
+        '''Record the delays of a traced message on receipt.
+
+        Timestamps come from the monotonic clock of each process, which
+        is shared by processes on the same host. Messages from other
+        hosts have unrelated timestamps and are recorded only if they
+        appear to be sane.
+        '''
+        if not isinstance(headers, dict):
+            return
+        trace = headers.get(TRACE_HEADER)
+        if not isinstance(trace, dict):
+            return
+        now = trace['dispatched'] = clock.monotonic()
+        published = trace.get('published')
+        distributed = trace.get('distributed')
+        if published is None or distributed is None:
+            return
+        if not published <= distributed <= now:
+            return
+        latency, queueing, delivery = self._delays[
+            '/'.join(topic.split('/', self.trace_depth)[:self.trace_depth])]
+        latency.add(now - published)
+        queueing.add(distributed - published)
+        delivery.add(now - distributed)
+
+    def _handle_subsystem(self, message):
+        try:
+            op = bytes(message.args[0])
+        except IndexError:
+            _log.error('missing pubsub subsystem operation')
+            return
+        if op == b'push':
+            self._handle_push(message)
         else:
-            sender = decode_peer(sender)
-            for prefix, callbacks in subscriptions.iteritems():
-                if topic.startswith(prefix):
-                    handled += 1
-                    for callback in callbacks:
-                        callback(peer, sender, bus, topic, headers, message)
-        if not handled:
+            _log.error('unknown pubsub subsystem operation: %r', op)
+
+    def _handle_push(self, message):
+        '''Handle incoming subscription pushes sent as VIP frames.
+
+        Topic matching is done before decoding the headers and message
+        so that unwanted pushes cost only a few frame copies.
+        '''
+        peer = bytes(message.peer)
+        args = message.args
+        serializer = SERIALIZERS['json']
+        if len(args) == 7:
+            # A content type frame precedes the payload.
+            content_type = bytes(args[1])
+            try:
+                serializer = SERIALIZERS[content_type[1:]]
+            except KeyError:
+                _log.error('unsupported pubsub content type %r from peer %r',
+                           content_type[1:], peer)
+                return
+            args = args[1:]
+        try:
+            sender, bus, topic, headers, msg = args[1:6]
+        except ValueError:
+            _log.error('malformed pubsub push from peer %r', peer)
+            return
+        bus = _from_utf8(bus)
+        topic = _from_utf8(topic)
+        callbacks = self._match_callbacks(peer, bus, topic)
+        if not callbacks:
+            # No callbacks for topic; synchronize with sender
+            self.synchronize(peer)
+            return
+        headers = serializer.loads(bytes(headers))
+        msg = serializer.loads(bytes(msg))
+        self._dispatched(topic, headers)
+        gevent.spawn(self._run_callbacks, callbacks, peer, bytes(sender),
+                     bus, topic, headers, msg)
+
+    def _match_callbacks(self, peer, bus, topic):
+        try:
+            subscriptions = self._my_subscriptions[peer][bus]
+        except KeyError:
+            return []
+        callbacks = []
+        for prefix, subscribed in subscriptions.iteritems():
+            if topic.startswith(prefix):
+                callbacks.extend(subscribed)
+        return callbacks
+
+    def _run_callbacks(self, callbacks, peer, sender, bus, topic,
+                       headers, message):
+        for callback in callbacks:
+            try:
+                callback(peer, sender, bus, topic, headers, message)
+            except Exception:   # pylint: disable=broad-except
+                _log.exception('unhandled exception in subscription '
+                               'callback for topic %r', topic)
+
+    def _peer_push(self, sender, bus, topic, headers, message):
+        '''Handle incoming subscription pushes from peers.
+
+        Retained for peers distributing pushes as JSON-RPC requests.
+        '''
+        peer = bytes(self.rpc().context.vip_message.peer)
+        callbacks = self._match_callbacks(peer, bus, topic)
+        if not callbacks:
             # No callbacks for topic; synchronize with sender
             self.synchronize(peer)
+            return
+        sender = decode_peer(sender)
+        self._dispatched(topic, headers)
+        for callback in callbacks:
+            callback(peer, sender, bus, topic, headers, message)
 
     def synchronize(self, peer):
         '''Unsubscribe from stale/forgotten/unsolicited subscriptions.'''
@@ -370,8 +714,7 @@ class PubSub(SubsystemBase):
         Publish headers and message to all subscribers of topic on bus
         at peer. If peer is None, use self.
         '''
-        if headers is None:
-            headers = {}
+        headers = self.trace_headers(headers)
         if peer is None:
             self._distribute(self.core().socket.identity,
                              topic, headers, message, bus)
@@ -379,3 +722,21 @@ class PubSub(SubsystemBase):
             return self.rpc().call(
                 peer, 'pubsub.publish', topic=topic, headers=headers,
                 message=message, bus=bus)
+
+    def publish_many(self, peer, messages, bus=''):
+        '''Publish several messages to a peer in a single request.
+
+        messages is a sequence of (topic, headers, message) tuples which
+        are distributed, in order, to the subscribers on bus at peer. If
+        peer is None, use self.
+        '''
+        trace_headers = self.trace_headers
+        messages = [(topic, trace_headers(headers), message)
+                    for topic, headers, message in messages]
+        if peer is None:
+            identity = self.core().socket.identity
+            for topic, headers, message in messages:
+                self._distribute(identity, topic, headers, message, bus)
+        else:
+            return self.rpc().call(
+                peer, 'pubsub.publish_many', messages=messages, bus=bus)
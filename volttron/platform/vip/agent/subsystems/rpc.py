@@ -57,6 +57,8 @@
 
 from __future__ import absolute_import
 
+from collections import Counter, defaultdict, deque
+import errno
 import inspect
 import logging
 import os
@@ -64,14 +66,18 @@ import sys
 import traceback
 import weakref
 
+import gevent
 import gevent.local
 from gevent.event import AsyncResult
-from zmq.utils import jsonapi
+import monotonic as clock
 
 from .base import SubsystemBase
 from ..errors import VIPError
 from ..results import counter, ResultsDictionary
-from ..decorators import annotate, annotations, dualmethod, spawn
+from ..decorators import annotate, annotations, dualmethod
+from ...metrics import Histogram
+from ...serializers import (CONTENT_TYPE_PREFIX, SERIALIZERS,
+                            default_serializer)
 from .... import jsonrpc
 
 
@@ -83,19 +89,156 @@ _ROOT_PACKAGE_PATH = os.path.dirname(
 
 _log = logging.getLogger(__name__)
 
+_AGAIN = (str(errno.EAGAIN).encode('ascii'),
+          os.strerror(errno.EAGAIN).encode('ascii'))
+
+
+def _method_names(request):
+    '''Return the names of the methods called by a JSON-RPC message.'''
+    if isinstance(request, dict):
+        request = [request]
+    elif not isinstance(request, list):
+        return []
+    return [item['method'] for item in request
+            if isinstance(item, dict) and
+            isinstance(item.get('method'), basestring)]
+
+
+class WorkerPool(object):
+    '''Run incoming RPC requests in a bounded number of greenlets.
+
+    At most max_workers requests run at once, and at most limits[name]
+    of those may be calls to the exported method name. Requests that
+    cannot run yet wait, in order, in a queue of up to max_queue
+    requests; beyond that they are rejected so the caller can retry
+    rather than pile more work on a saturated agent. Requests that
+    cannot be rejected, because the caller expects no reply, are queued
+    regardless.
+    '''
+
+    def __init__(self, max_workers=100, max_queue=1000):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.limits = {}
+        self._workers = 0
+        self._queue = deque()
+        self._active = defaultdict(int)
+        self._rejected = defaultdict(int)
+        self._completed = 0
+        # Time spent handling requests, by method
+        self._durations = defaultdict(Histogram)
+
+    def submit(self, names, func, args=(), force=False):
+        '''Run func(*args), which calls methods names, when allowed.
+
+        Returns False, without running func, if the pool is saturated,
+        unless force is True.
+        '''
+        names = Counter(names)
+        if not self._queue and self._runnable(names):
+            self._start(names, func, args)
+        elif force or len(self._queue) < self.max_queue:
+            self._queue.append((names, func, args))
+            if self._workers < self.max_workers:
+                # Workers are free but the queue is held up by methods
+                # at their limits; this request may still run now.
+                self._schedule()
+        else:
+            for name in names:
+                self._rejected[name] += 1
+            return False
+        return True
+
+    def _runnable(self, names):
+        if self._workers >= self.max_workers:
+            return False
+        limits = self.limits
+        active = self._active
+        for name, count in names.iteritems():
+            limit = limits.get(name)
+            if limit is not None and active[name] + count > limit:
+                return False
+        return True
+
+    def _start(self, names, func, args):
+        self._workers += 1
+        for name, count in names.iteritems():
+            self._active[name] += count
+        gevent.spawn(self._run, names, func, args)
+
+    def _run(self, names, func, args):
+        start = clock.monotonic()
+        try:
+            func(*args)
+        except Exception:   # pylint: disable=broad-except
+            _log.exception('unhandled exception handling RPC request')
+        finally:
+            elapsed = clock.monotonic() - start
+            self._workers -= 1
+            self._completed += 1
+            for name, count in names.iteritems():
+                self._durations[name].add(elapsed)
+                self._active[name] -= count
+                if not self._active[name]:
+                    del self._active[name]
+            self._schedule()
+
+    def _schedule(self):
+        queue = self._queue
+        if not self.limits:
+            while queue and self._workers < self.max_workers:
+                self._start(*queue.popleft())
+            return
+        # Requests for methods at their limit must not hold up those
+        # for other methods.
+        waiting = deque()
+        while queue and self._workers < self.max_workers:
+            item = queue.popleft()
+            if self._runnable(item[0]):
+                self._start(*item)
+            else:
+                waiting.append(item)
+        waiting.extend(queue)
+        self._queue = waiting
+
+    def stats(self):
+        '''Return counters of active, queued and rejected calls.'''
+        methods = {}
+        for name, count in self._active.iteritems():
+            methods.setdefault(name, {})['active'] = count
+        for name, count in self._queue_counts().iteritems():
+            methods.setdefault(name, {})['queued'] = count
+        for name, count in self._rejected.iteritems():
+            methods.setdefault(name, {})['rejected'] = count
+        for name, durations in self._durations.iteritems():
+            methods.setdefault(name, {})['duration'] = durations.snapshot()
+        return {'active': self._workers, 'queued': len(self._queue),
+                'rejected': sum(self._rejected.itervalues()),
+                'completed': self._completed,
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'methods': methods}
+
+    def _queue_counts(self):
+        counts = Counter()
+        for names, _, _ in self._queue:
+            counts.update(names)
+        return counts
+
 
 class Dispatcher(jsonrpc.Dispatcher):
-    def __init__(self, methods, local):
+    def __init__(self, methods, local, serializer=None, results=None):
         super(Dispatcher, self).__init__()
         self.methods = methods
         self.local = local
-        self._results = ResultsDictionary()
+        self.serializer = serializer or SERIALIZERS['json']
+        self._results = ResultsDictionary() if results is None else results
 
     def serialize(self, json_obj):
-        return jsonapi.dumps(json_obj)
+        return self.serializer.dumps(json_obj)
 
     def deserialize(self, json_string):
-        return jsonapi.loads(json_string)
+        return self.serializer.loads(json_string)
 
     def batch_call(self, requests):
         methods = []
@@ -152,6 +295,8 @@ class Dispatcher(jsonrpc.Dispatcher):
         except KeyError:
             if name == 'inspect':
                 return {'methods': self.methods.keys()}
+            elif name == 'vip.serializers':
+                return sorted(SERIALIZERS)
             elif name.endswith('.inspect'):
                 try:
                     method = self.methods[name[:-8]]
@@ -205,36 +350,191 @@ class Dispatcher(jsonrpc.Dispatcher):
 
 
 class RPC(SubsystemBase):
-    def __init__(self, core, owner):
+    # Seconds to wait for a peer to list its serializers.
+    negotiate_timeout = 30
+
+    def __init__(self, core, owner, peerlist=None, serializer=None):
         self.core = weakref.ref(core)
         self.context = None
         self._exports = {}
         self._dispatcher = None
+        self._dispatchers = {}
         self._counter = counter()
         self._outstanding = weakref.WeakValueDictionary()
+        # Serializer preferred for requests and the one agreed on with
+        # each peer, which stays JSON until the peer reports support.
+        self._serializer = default_serializer(serializer)
+        self._peer_serializers = {}
+        self._pool = WorkerPool()
+        # Round trip times of calls made, by method, and the number of
+        # those that failed.
+        self._latency = defaultdict(Histogram)
+        self._failures = defaultdict(int)
+        self._stats = {'rpc': self._rpc_stats}
+        self._exports['vip.stats'] = self._vip_stats
         core.register('RPC', self._handle_subsystem, self._handle_error)
+        if peerlist is not None:
+            peerlist.ondrop.connect(self._peer_dropped)
 
         def export(member):   # pylint: disable=redefined-outer-name
             for name in annotations(member, set, 'rpc.exports'):
                 self._exports[name] = member
+            self._pool.limits.update(
+                annotations(member, dict, 'rpc.concurrency'))
         inspect.getmembers(owner, export)
 
         def setup(sender, **kwargs):
             # pylint: disable=unused-argument
             self.context = gevent.local.local()
-            self._dispatcher = Dispatcher(self._exports, self.context)
+            # Dispatchers share results so a response is matched to its
+            # request whichever serializer carried it.
+            results = ResultsDictionary()
+            for name, serializer in SERIALIZERS.iteritems():
+                self._dispatchers[name] = Dispatcher(
+                    self._exports, self.context, serializer, results)
+            self._dispatcher = self._dispatchers['json']
         core.onsetup.connect(setup, self)
 
-    @spawn
     def _handle_subsystem(self, message):
-        dispatch = self._dispatcher.dispatch
+        args = message.args
+        dispatcher = self._dispatcher
+        content_type = None
+        if args and bytes(args[0])[:1] == CONTENT_TYPE_PREFIX:
+            content_type, args = args[0], args[1:]
+            try:
+                dispatcher = self._dispatchers[bytes(content_type)[1:]]
+            except KeyError:
+                _log.error('unsupported RPC content type %r from peer %r',
+                           bytes(content_type)[1:], bytes(message.peer))
+                return
+        requests = []
+        names = []
+        for msg in args:
+            msg = bytes(msg)
+            try:
+                request = dispatcher.deserialize(msg)
+            except ValueError:
+                # Dispatching again returns the parse error response.
+                requests.append((dispatcher.dispatch, msg))
+                continue
+            requests.append((dispatcher.dispatch_object, request))
+            names.extend(_method_names(request))
+        if not names:
+            # Results and errors only wake up waiting callers, so they
+            # are handled at once and never queued or rejected.
+            self._dispatch(message, content_type, requests)
+        elif not self._pool.submit(
+                names, self._dispatch, (message, content_type, requests),
+                # Notifications cannot be told to retry, so they are
+                # never rejected.
+                force=not bytes(message.id)):
+            self._reject(message, names)
+
+    def _dispatch(self, message, content_type, requests):
         responses = [response for response in (
-            dispatch(bytes(msg), message) for msg in message.args) if response]
+            dispatch(request, message) for dispatch, request in requests)
+                     if response]
         if responses:
+            # Reply using the serializer of the request.
+            if content_type is not None:
+                responses.insert(0, content_type)
             message.user = ''
             message.args = responses
             self.core().socket.send_vip_object(message, copy=False)
 
+    def _reject(self, message, names):
+        _log.debug('RPC pool saturated; rejecting call to %s from %r',
+                     ', '.join(names), bytes(message.peer))
+        # Reply as the router does for undeliverable messages so the
+        # caller's result raises Again.
+        message.user = b''
+        message.subsystem = b'error'
+        message.args = list(_AGAIN) + [self.core().identity or b'', b'RPC']
+        self.core().socket.send_vip_object(message, copy=False)
+
+    def configure_pool(self, max_workers=None, max_queue=None):
+        '''Set the number of requests run at once and allowed to wait.'''
+        if max_workers is not None:
+            self._pool.max_workers = max_workers
+        if max_queue is not None:
+            self._pool.max_queue = max_queue
+        self._pool._schedule()   # pylint: disable=protected-access
+
+    def set_concurrency(self, name, limit):
+        '''Limit concurrent calls to exported method name.
+
+        A limit of None removes the limit.
+        '''
+        if limit is None:
+            self._pool.limits.pop(name, None)
+        else:
+            self._pool.limits[name] = limit
+        self._pool._schedule()   # pylint: disable=protected-access
+
+    def pool_stats(self):
+        '''Return counters for requests run by the RPC worker pool.'''
+        return self._pool.stats()
+
+    def add_stats(self, name, snapshot):
+        '''Report the result of snapshot() as name from vip.stats.'''
+        self._stats[name] = snapshot
+
+    def _vip_stats(self):
+        return {name: snapshot() for name, snapshot in self._stats.iteritems()}
+
+    def _rpc_stats(self):
+        return {'pool': self._pool.stats(),
+                'latency': {name: latency.snapshot()
+                            for name, latency in self._latency.iteritems()},
+                'failures': dict(self._failures)}
+
+    def _timed(self, method, result):
+        start = clock.monotonic()
+        latency = self._latency[method]
+        def done(result):
+            latency.add(clock.monotonic() - start)
+            if not result.successful():
+                self._failures[method] += 1
+        result.rawlink(done)
+
+    def serializer_for(self, peer):
+        '''Return the serializer to use for payloads sent to peer.
+
+        JSON is returned until the peer has confirmed that it supports
+        the preferred serializer, which is asked of it on first use.
+        '''
+        return self._peer_dispatcher(peer).serializer
+
+    def _peer_dispatcher(self, peer):
+        if self._serializer is self._dispatcher.serializer:
+            return self._dispatcher
+        try:
+            return self._dispatchers[self._peer_serializers[peer]]
+        except KeyError:
+            pass
+        self._peer_serializers[peer] = 'json'
+        self.core().spawn(self._negotiate, peer)
+        return self._dispatcher
+
+    def _negotiate(self, peer):
+        try:
+            supported = self.call(peer, 'vip.serializers').get(
+                timeout=self.negotiate_timeout)
+        except Exception:   # pylint: disable=broad-except
+            # Peers predating serializer negotiation only speak JSON.
+            return
+        name = self._serializer.name
+        if name in supported and peer in self._peer_serializers:
+            self._peer_serializers[peer] = name
+
+    def _peer_dropped(self, sender, peer, **kwargs):
+        self._peer_serializers.pop(peer, None)
+
+    def _request_frames(self, dispatcher, request):
+        if dispatcher is self._dispatcher:
+            return [request]
+        return [dispatcher.serializer.content_type, request]
+
     def _handle_error(self, sender, message, error, **kwargs):
         result = self._outstanding.pop(bytes(message.id), None)
         if isinstance(result, AsyncResult):
@@ -249,18 +549,28 @@ class RPC(SubsystemBase):
         return method
 
     @export.classmethod
-    def export(cls, name=None):   # pylint: disable=no-self-argument
-        if not isinstance(name, basestring):
+    def export(cls, name=None, concurrency=None):   # pylint: disable=no-self-argument
+        '''Decorator to export a method over RPC.
+
+        May be used bare or given the exported name and the most calls
+        to the method to run at once (concurrency).
+        '''
+        if name is not None and not isinstance(name, basestring):
             method, name = name, name.__name__
             annotate(method, set, 'rpc.exports', name)
             return method
         def decorate(method):
-            annotate(method, set, 'rpc.exports', name)
+            exported = name or method.__name__
+            annotate(method, set, 'rpc.exports', exported)
+            if concurrency is not None:
+                annotate(method, dict, 'rpc.concurrency',
+                         {exported: concurrency})
             return method
         return decorate
 
     def batch(self, peer, requests):
-        request, results = self._dispatcher.batch_call(requests)
+        dispatcher = self._peer_dispatcher(peer)
+        request, results = dispatcher.batch_call(requests)
         if results:
             items = weakref.WeakSet(results)
             ident = '%s.%s' % (next(self._counter), id(items))
@@ -270,18 +580,26 @@ class RPC(SubsystemBase):
         else:
             ident = b''
         if request:
-            self.core().socket.send_vip(peer, 'RPC', [request], msg_id=ident)
+            self.core().socket.send_vip(
+                peer, 'RPC', self._request_frames(dispatcher, request),
+                msg_id=ident)
         return results or None
 
     def call(self, peer, method, *args, **kwargs):
-        request, result = self._dispatcher.call(method, args, kwargs)
+        dispatcher = self._peer_dispatcher(peer)
+        request, result = dispatcher.call(method, args, kwargs)
+        self._timed(method, result)
         ident = '%s.%s' % (next(self._counter), hash(result))
         self._outstanding[ident] = result
-        self.core().socket.send_vip(peer, 'RPC', [request], msg_id=ident)
+        self.core().socket.send_vip(
+            peer, 'RPC', self._request_frames(dispatcher, request),
+            msg_id=ident)
         return result
 
     __call__ = call
 
     def notify(self, peer, method, *args, **kwargs):
-        request = self._dispatcher.notify(method, args, kwargs)
-        self.core().socket.send_vip(peer, 'RPC', [request])
+        dispatcher = self._peer_dispatcher(peer)
+        request = dispatcher.notify(method, args, kwargs)
+        self.core().socket.send_vip(
+            peer, 'RPC', self._request_frames(dispatcher, request))
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+from __future__ import absolute_import
+
+import unittest
+
+from gevent.event import AsyncResult
+from zmq.utils import jsonapi
+
+from .pubsub import PubSub, TopicTrie, TRACE_HEADER, decode_peer
+from ...serializers import SERIALIZERS
+
+
+class TopicTrieTests(unittest.TestCase):
+    def setUp(self):
+        self.trie = TopicTrie()
+
+    def test_prefix_matching(self):
+        self.trie.add('devices/building1', 'a')
+        self.trie.add('devices/bu', 'b')
+        self.trie.add('devices/building1/all', 'c')
+        self.trie.add('analysis', 'd')
+        self.assertEqual(self.trie.match('devices/building1/all'),
+                         frozenset('abc'))
+        self.assertEqual(self.trie.match('devices/building1/ahu/all'),
+                         frozenset('ab'))
+        self.assertEqual(self.trie.match('devices/building2'), frozenset('b'))
+        self.assertEqual(self.trie.match('devices/b'), frozenset())
+        self.assertEqual(self.trie.match('devicesX/building1'), frozenset())
+        self.assertEqual(self.trie.match('analysis/x'), frozenset('d'))
+
+    def test_trailing_slash(self):
+        self.trie.add('devices/', 'a')
+        self.assertEqual(self.trie.match('devices/x'), frozenset('a'))
+        self.assertEqual(self.trie.match('devices/'), frozenset('a'))
+        self.assertEqual(self.trie.match('devices'), frozenset())
+
+    def test_empty_prefix(self):
+        self.trie.add('', 'a')
+        self.trie.add('devices', 'b')
+        self.assertEqual(self.trie.match('devices/all'), frozenset('ab'))
+        self.assertEqual(self.trie.match('other'), frozenset('a'))
+        self.assertEqual(self.trie.match(''), frozenset('a'))
+
+    def test_unsubscribe_prunes(self):
+        self.trie.add('devices/building1/ahu', 'a')
+        self.trie.add('devices/building1/ahu', 'b')
+        self.trie.add('devices/campus', 'c')
+        self.trie.discard('devices/building1/ahu', 'a')
+        self.assertIn('devices/building1/ahu', self.trie)
+        self.trie.discard('devices/building1/ahu', 'b')
+        self.assertNotIn('devices/building1/ahu', self.trie)
+        # Nodes left without prefixes below them are removed.
+        devices = self.trie._root.children['devices']
+        self.assertNotIn('building1', devices.children)
+        self.assertEqual(devices.fragments.keys(), ['campus'])
+        self.trie.discard_peer('c')
+        self.assertEqual(len(self.trie), 0)
+        self.assertEqual(self.trie._root.children, {})
+        self.assertEqual(self.trie._root.fragments, {})
+        self.assertRaises(KeyError, self.trie.discard, 'devices/campus', 'c')
+
+    def test_cache_invalidation(self):
+        self.trie.add('devices', 'a')
+        self.assertEqual(self.trie.match('devices/all'), frozenset('a'))
+        self.trie.add('devices/all', 'b')
+        self.assertEqual(self.trie.match('devices/all'), frozenset('ab'))
+        self.trie.add('', 'c')
+        self.assertEqual(self.trie.match('devices/all'), frozenset('abc'))
+        self.trie.discard('devices', 'a')
+        self.assertEqual(self.trie.match('devices/all'), frozenset('bc'))
+        self.trie.discard_peer('c')
+        self.assertEqual(self.trie.match('devices/all'), frozenset('b'))
+
+    def test_cache_limit(self):
+        self.trie.cache_limit = 2
+        self.trie.add('t', 'a')
+        for topic in ('t1', 't2', 't3'):
+            self.trie.match(topic)
+        self.assertLessEqual(len(self.trie._cache), 2)
+        self.assertEqual(self.trie.match('t1'), frozenset('a'))
+
+
+class FakeSignal(object):
+    def connect(self, *args, **kwargs):
+        pass
+
+
+class FakeSocket(object):
+    identity = b'platform.test'
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, frame, flags=0):
+        self.sent.append(frame)
+
+    def send_multipart(self, frames, copy=True):
+        self.sent.extend(bytes(frame) for frame in frames)
+
+
+class FakeCore(object):
+    def __init__(self):
+        self.socket = FakeSocket()
+        self.onsetup = FakeSignal()
+        self.spawned = []
+
+    def register(self, name, handler):
+        pass
+
+    def spawn(self, func, *args, **kwargs):
+        self.spawned.append((func, args))
+
+
+class FakeRPC(object):
+    def __init__(self):
+        self.exports = set()
+
+    def add_stats(self, name, func):
+        pass
+
+    def call(self, peer, method, *args, **kwargs):
+        result = AsyncResult()
+        if method in self.exports:
+            result.set(True)
+        else:
+            result.set_exception(NotImplementedError(method))
+        return result
+
+    def serializer_for(self, peer):
+        return SERIALIZERS['json']
+
+
+class FakePeerList(object):
+    pass
+
+
+class TraceTests(unittest.TestCase):
+    def setUp(self):
+        self.core = FakeCore()
+        self.rpc = FakeRPC()
+        self.pubsub = PubSub(self.core, self.rpc, FakePeerList(), None)
+        self.pubsub.add_bus('')
+        self.pubsub._add_peer_subscription('agent', '', 'devices')
+        self.pubsub._frame_peers['agent'] = True
+
+    def distribute(self, headers):
+        return self.pubsub._distribute(
+            b'publisher', 'devices/campus/all', headers, 'message')
+
+    def test_trace_headers_disabled(self):
+        headers = {'Date': 'today'}
+        self.pubsub.trace = False
+        self.assertIs(self.pubsub.trace_headers(headers), headers)
+        self.assertIsNone(self.pubsub.trace_headers(None))
+
+    def test_trace_headers_stamped(self):
+        self.pubsub.trace = True
+        headers = {'Date': 'today'}
+        traced = self.pubsub.trace_headers(headers)
+        self.assertEqual(headers, {'Date': 'today'})
+        self.assertEqual(traced['Date'], 'today')
+        self.assertEqual(traced[TRACE_HEADER].keys(), ['published'])
+        # Messages already stamped keep their original publish time.
+        self.assertIs(self.pubsub.trace_headers(traced), traced)
+        self.assertIn(TRACE_HEADER, self.pubsub.trace_headers(None))
+        self.assertEqual(self.pubsub.trace_headers(['a']), ['a'])
+
+    def test_distributed_and_dispatched(self):
+        self.pubsub.trace = True
+        headers = self.pubsub.trace_headers({})
+        self.assertEqual(self.distribute(headers), 1)
+        trace = headers[TRACE_HEADER]
+        self.assertLessEqual(trace['published'], trace['distributed'])
+        received = jsonapi.loads(self.core.socket.sent[-2])
+        self.assertEqual(received[TRACE_HEADER], trace)
+        self.pubsub._dispatched('devices/campus/all', received)
+        trace = received[TRACE_HEADER]
+        self.assertLessEqual(trace['distributed'], trace['dispatched'])
+        delays = self.pubsub._stats()['trace']
+        self.assertEqual(delays.keys(), ['devices/campus'])
+        self.assertEqual(delays['devices/campus']['latency']['count'], 1)
+
+    def test_untraced_headers(self):
+        for headers in (None, [1, 2], 'text', {}):
+            del self.core.socket.sent[:]
+            self.assertEqual(self.distribute(headers), 1)
+            sent = self.core.socket.sent
+            self.assertEqual(sent[0], 'agent')
+            self.assertEqual(jsonapi.loads(sent[-2]), headers)
+            self.pubsub._dispatched('devices/campus/all', headers)
+        self.assertEqual(self.pubsub._stats()['trace'], {})
+
+
+class PushNegotiationTests(unittest.TestCase):
+    def setUp(self):
+        self.core = FakeCore()
+        self.rpc = FakeRPC()
+        self.pubsub = PubSub(self.core, self.rpc, FakePeerList(), None)
+        self.pubsub.add_bus('')
+        self.pubsub._add_peer_subscription('agent', '', 'devices')
+
+    def distribute(self):
+        del self.core.socket.sent[:]
+        self.pubsub._distribute(
+            b'publisher', 'devices/campus/all', {'a': 1}, [1, 2])
+        return self.core.socket.sent
+
+    def negotiate(self):
+        for func, args in self.core.spawned:
+            func(*args)
+        del self.core.spawned[:]
+
+    def assert_rpc_push(self, sent):
+        self.assertEqual(sent[:4], ['agent', '', '', 'RPC'])
+        request = jsonapi.loads(sent[4])
+        self.assertEqual(request['method'], 'pubsub.push')
+        sender, bus, topic, headers, message = request['params']
+        self.assertEqual(decode_peer(sender), b'publisher')
+        self.assertEqual((bus, topic, headers, message),
+                         ('', 'devices/campus/all', {'a': 1}, [1, 2]))
+
+    def test_frames_after_confirmation(self):
+        self.rpc.exports.add('pubsub.frames')
+        # Pushes go out as requests until the subscriber confirms.
+        self.assert_rpc_push(self.distribute())
+        self.assertEqual(len(self.core.spawned), 1)
+        self.negotiate()
+        sent = self.distribute()
+        self.assertEqual(sent[:5], ['agent', '', '', 'pubsub', 'push'])
+        self.assertEqual(sent[5:8], ['publisher', '', 'devices/campus/all'])
+        self.assertEqual([jsonapi.loads(frame) for frame in sent[8:]],
+                         [{'a': 1}, [1, 2]])
+
+    def test_legacy_subscriber(self):
+        self.distribute()
+        self.negotiate()
+        self.assert_rpc_push(self.distribute())
+        # Negotiation is attempted once per peer connection.
+        self.assertEqual(self.core.spawned, [])
+        self.pubsub._peer_drop(None, 'agent')
+        self.assertNotIn('agent', self.pubsub._frame_peers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+from __future__ import absolute_import
+
+import unittest
+
+import gevent
+from gevent.event import Event
+from zmq.utils import jsonapi
+
+from .rpc import RPC, WorkerPool, _AGAIN
+from ...socket import Message
+
+
+class Recorder(object):
+    '''Calls that wait for release() before returning.'''
+
+    def __init__(self):
+        self.started = []
+        self.finished = []
+        self._release = Event()
+
+    def __call__(self, name):
+        self.started.append(name)
+        self._release.wait()
+        self.finished.append(name)
+        return name
+
+    def release(self):
+        self._release.set()
+
+
+class WorkerPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.calls = Recorder()
+
+    def tearDown(self):
+        self.calls.release()
+        gevent.sleep(0)
+
+    def submit(self, pool, name, **kwargs):
+        return pool.submit([name], self.calls, (name,), **kwargs)
+
+    def test_max_workers_queues(self):
+        pool = WorkerPool(max_workers=2, max_queue=10)
+        for name in 'abcd':
+            self.assertTrue(self.submit(pool, name))
+        gevent.sleep(0)
+        self.assertEqual(self.calls.started, ['a', 'b'])
+        stats = pool.stats()
+        self.assertEqual((stats['active'], stats['queued']), (2, 2))
+        self.calls.release()
+        gevent.sleep(0.01)
+        # Waiters on an event are not woken in a guaranteed order.
+        self.assertEqual(sorted(self.calls.started), ['a', 'b', 'c', 'd'])
+        self.assertEqual(sorted(self.calls.finished), ['a', 'b', 'c', 'd'])
+        stats = pool.stats()
+        self.assertEqual((stats['active'], stats['queued'],
+                          stats['completed']), (0, 0, 4))
+
+    def test_method_limit(self):
+        pool = WorkerPool(max_workers=10, max_queue=10)
+        pool.limits['slow'] = 1
+        self.submit(pool, 'slow')
+        self.submit(pool, 'slow')
+        self.submit(pool, 'fast')
+        gevent.sleep(0)
+        # The second call to slow waits without holding up fast.
+        self.assertEqual(self.calls.started, ['slow', 'fast'])
+        self.assertEqual(pool.stats()['methods']['slow'],
+                         {'active': 1, 'queued': 1})
+        self.calls.release()
+        gevent.sleep(0.01)
+        self.assertEqual(sorted(self.calls.finished),
+                         ['fast', 'slow', 'slow'])
+
+    def test_batch_counts_against_limit(self):
+        pool = WorkerPool(max_workers=10, max_queue=10)
+        pool.limits['slow'] = 1
+        pool.submit(['slow', 'slow'], self.calls, ('batch',))
+        gevent.sleep(0)
+        self.assertEqual(self.calls.started, [])
+        self.assertEqual(pool.stats()['queued'], 1)
+
+    def test_reject_when_full(self):
+        pool = WorkerPool(max_workers=1, max_queue=1)
+        self.assertTrue(self.submit(pool, 'a'))
+        self.assertTrue(self.submit(pool, 'b'))
+        self.assertFalse(self.submit(pool, 'c'))
+        self.assertTrue(self.submit(pool, 'd', force=True))
+        stats = pool.stats()
+        self.assertEqual((stats['queued'], stats['rejected']), (2, 1))
+        self.assertEqual(stats['methods']['c'], {'rejected': 1})
+        self.calls.release()
+        gevent.sleep(0.01)
+        self.assertEqual(self.calls.finished, ['a', 'b', 'd'])
+
+
+class FakeSignal(object):
+    def __init__(self):
+        self.receivers = []
+
+    def connect(self, receiver, owner=None):
+        self.receivers.append(receiver)
+
+    def send(self, sender):
+        for receiver in self.receivers:
+            receiver(sender)
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_vip_object(self, message, copy=True):
+        self.sent.append(message)
+
+
+class FakeCore(object):
+    identity = b'agent'
+
+    def __init__(self):
+        self.socket = FakeSocket()
+        self.onsetup = FakeSignal()
+
+    def register(self, name, handler, error_handler):
+        pass
+
+
+class RPCRejectTests(unittest.TestCase):
+    def setUp(self):
+        self.core = FakeCore()
+        self.rpc = RPC(self.core, object())
+        self.core.onsetup.send(self.core)
+        self.calls = Recorder()
+        self.rpc.export(self.calls, 'wait')
+        self.rpc.configure_pool(max_workers=1, max_queue=1)
+
+    def tearDown(self):
+        self.calls.release()
+        gevent.sleep(0)
+
+    def request(self, ident, name):
+        request = {'jsonrpc': '2.0', 'method': 'wait', 'params': [name]}
+        if ident:
+            request['id'] = ident
+        message = Message(peer=b'caller', subsystem=b'RPC', id=ident,
+                          user=b'', args=[jsonapi.dumps(request)])
+        self.rpc._handle_subsystem(message)
+        return message
+
+    def test_eagain_rejection(self):
+        self.request(b'1', 'a')
+        self.request(b'2', 'b')
+        rejected = self.request(b'3', 'c')
+        self.assertEqual(self.core.socket.sent, [rejected])
+        self.assertEqual(rejected.subsystem, b'error')
+        self.assertEqual(rejected.args[:2], list(_AGAIN))
+        self.calls.release()
+        gevent.sleep(0.01)
+        self.assertEqual(self.calls.finished, ['a', 'b'])
+        replies = [jsonapi.loads(bytes(message.args[0]))
+                   for message in self.core.socket.sent[1:]]
+        self.assertEqual([reply['result'] for reply in replies], ['a', 'b'])
+
+    def test_notifications_not_dropped(self):
+        self.request(b'1', 'a')
+        self.request(b'2', 'b')
+        self.request(b'', 'notify')
+        self.calls.release()
+        gevent.sleep(0.01)
+        self.assertEqual(self.calls.finished, ['a', 'b', 'notify'])
+        self.assertEqual(
+            self.rpc._rpc_stats()['pool']['rejected'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
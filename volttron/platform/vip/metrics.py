@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+'''Lightweight counters and histograms describing message bus traffic.
+
+RouterMetrics is updated by the router for every message it routes and
+is reported by the router's stats query. Histogram is also used by the
+RPC and pubsub subsystems for call latencies and fan-out sizes, which
+agents report through their vip.stats RPC method.
+'''
+
+from __future__ import absolute_import
+
+from bisect import bisect_left
+from collections import defaultdict
+import errno
+import time
+
+
+__all__ = ['Histogram', 'RouterMetrics', 'LATENCY_BOUNDS', 'COUNT_BOUNDS']
+
+
+# Upper bounds of histogram buckets, in seconds for latencies.
+LATENCY_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                  0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BOUNDS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram(object):
+    '''Count values in fixed buckets.
+
+    Adding a value is a binary search and an increment, so histograms
+    may be updated on every message. Percentiles are estimated as the
+    upper bound of the bucket they fall in.
+    '''
+
+    __slots__ = ['bounds', 'counts', 'count', 'total', 'max']
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        '''Return the bucket bound below which percent of values fall.
+
+        The bound is capped at the largest value seen, which is also
+        the estimate for values beyond the last bucket.
+        '''
+        if not self.count:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.total, 'max': self.max,
+                'p50': self.percentile(50), 'p99': self.percentile(99),
+                'buckets': [[bound, count] for bound, count in
+                            zip(self.bounds + (None,), self.counts) if count]}
+
+
+def _printable(peer):
+    # Identities assigned by ZeroMQ are binary.
+    if peer.startswith(b'\x00'):
+        return peer.encode('string_escape')
+    try:
+        return peer.decode('utf-8')
+    except UnicodeDecodeError:
+        return peer.encode('string_escape')
+
+
+_ERROR_NAMES = {errno.EAGAIN: 'EAGAIN', errno.EHOSTUNREACH: 'EHOSTUNREACH'}
+
+
+class RouterMetrics(object):
+    '''Message and byte counts per peer and subsystem and send errors.'''
+
+    def __init__(self):
+        self.started = time.time()
+        # peer -> [messages in, bytes in, messages out, bytes out]
+        self.peers = defaultdict(lambda: [0, 0, 0, 0])
+        # subsystem -> [messages, bytes]
+        self.subsystems = defaultdict(lambda: [0, 0])
+        # peer -> {error name: count} for messages that could not be
+        # delivered to peer, and the totals over all peers
+        self.drops = defaultdict(lambda: defaultdict(int))
+        self.total_drops = defaultdict(int)
+
+    def incoming(self, peer, subsystem, frames):
+        size = sum(len(frame) for frame in frames)
+        counts = self.peers[peer]
+        counts[0] += 1
+        counts[1] += size
+        counts = self.subsystems[subsystem]
+        counts[0] += 1
+        counts[1] += size
+
+    def outgoing(self, peer, frames):
+        counts = self.peers[peer]
+        counts[2] += 1
+        counts[3] += sum(len(frame) for frame in frames)
+
+    def dropped(self, peer, errnum):
+        name = _ERROR_NAMES.get(errnum, str(errnum))
+        self.drops[peer][name] += 1
+        self.total_drops[name] += 1
+
+    def forget(self, peer):
+        '''Discard counters of a peer that has disconnected.'''
+        self.peers.pop(peer, None)
+        self.drops.pop(peer, None)
+
+    def snapshot(self):
+        peers = {}
+        for peer, (msgs_in, bytes_in, msgs_out, bytes_out) in \
+                self.peers.iteritems():
+            peers[_printable(peer)] = {'messages_in': msgs_in, 'bytes_in': bytes_in,
+                           'messages_out': msgs_out, 'bytes_out': bytes_out,
+                           'drops': dict(self.drops.get(peer, {}))}
+        subsystems = {name: {'messages': msgs, 'bytes': size}
+                      for name, (msgs, size) in self.subsystems.iteritems()}
+        return {'uptime': time.time() - self.started, 'peers': peers,
+                'subsystems': subsystems, 'drops': dict(self.total_drops)}
@@ -61,7 +61,7 @@ from __future__ import absolute_import
 import os
 
 import zmq
-from zmq import Frame, NOBLOCK, ZMQError, EINVAL, EHOSTUNREACH
+from zmq import Frame, NOBLOCK, ZMQError, EAGAIN, EINVAL, EHOSTUNREACH
 
 
 __all__ = ['BaseRouter', 'OUTGOING', 'INCOMING', 'UNROUTABLE', 'ERROR']
@@ -93,9 +93,10 @@ class BaseRouter(object):
     setup authentication, etc, etc. The socket will be created by the
     start() method, which will then call the setup() method.  Once
     started, the socket may be polled for incoming messages and those
-    messages are handled/routed by calling the route() method.  During
-    routing, the issue() method, which may be implemented, will be
-    called to allow for debugging and logging. Custom subsystems may be
+    messages are handled/routed by calling the route() or route_batch()
+    methods.  During routing, the issue() method, which may be
+    implemented, will be called to allow for debugging and logging,
+    provided tracing() returns True. Custom subsystems may be
     implemented in the handle_subsystem() method. The socket will be
     closed when the stop() method is called.
     '''
@@ -103,6 +104,10 @@ class BaseRouter(object):
     _context_class = zmq.Context
     _socket_class = zmq.Socket
 
+    # Most messages routed per call to route_batch(), so that a busy
+    # socket cannot starve the caller's loop.
+    batch_size = 1000
+
     def __init__(self, context=None, default_user_id=None):
         '''Initialize the object instance.
 
@@ -113,13 +118,16 @@ class BaseRouter(object):
         self.default_user_id = default_user_id
         self.socket = None
         self._peers = set()
+        self._issue = None
+        # Set to a metrics.RouterMetrics instance to count traffic.
+        self.metrics = None
 
     def run(self):
         '''Main router loop.'''
         self.start()
         try:
             while self.poll():
-                self.route()
+                self.route_batch()
         finally:
             self.stop()
 
@@ -179,6 +187,15 @@ class BaseRouter(object):
     def issue(self, topic, frames, extra=None):
         pass
 
+    def tracing(self):
+        '''Return True if issue() should be called while routing.
+
+        Routing skips calling issue() altogether when this is False. The
+        default is True only if issue() has been overridden; subclasses
+        may override this to switch tracing on and off at runtime.
+        '''
+        return type(self).issue.__func__ is not BaseRouter.issue.__func__
+
     if zmq.zmq_version_info() >= (4, 1, 0):
         def lookup_user_id(self, sender, recipient, auth_token):
             '''Find and return a user identifier.
@@ -227,6 +244,8 @@ class BaseRouter(object):
             self._peers.remove(peer)
         except KeyError:
             return
+        if self.metrics is not None:
+            self.metrics.forget(peer)
         self._distribute(b'peerlist', b'drop', peer)
 
     def route(self):
@@ -238,32 +257,64 @@ class BaseRouter(object):
         handle_subsystem() for processing. Messages destined for other
         entities are routed appropriately.
         '''
-        socket = self.socket
-        issue = self.issue
+        self._issue = self.issue if self.tracing() else None
         # Expecting incoming frames:
         #   [SENDER, RECIPIENT, PROTO, USER_ID, MSG_ID, SUBSYS, ...]
-        frames = socket.recv_multipart(copy=False)
-        issue(INCOMING, frames)
+        self._route(self.socket.recv_multipart(copy=False))
+
+    def route_batch(self):
+        '''Route all waiting messages and return the number routed.
+
+        Messages are read without blocking until none are left or
+        batch_size messages have been routed, saving a poll per message
+        when the socket is busy. Each message is handled as in route().
+        '''
+        self._issue = self.issue if self.tracing() else None
+        recv_multipart = self.socket.recv_multipart
+        route = self._route
+        count = 0
+        while count < self.batch_size:
+            try:
+                frames = recv_multipart(flags=NOBLOCK, copy=False)
+            except ZMQError as exc:
+                if exc.errno == EAGAIN:
+                    break
+                raise
+            count += 1
+            route(frames)
+        return count
+
+    def _route(self, frames):
+        socket = self.socket
+        issue = self._issue
+        if issue:
+            issue(INCOMING, frames)
         if len(frames) < 6:
             # Cannot route if there are insufficient frames, such as
             # might happen with a router probe.
             if len(frames) == 2 and frames[0] and not frames[1]:
-                issue(UNROUTABLE, frames, 'router probe')
+                if issue:
+                    issue(UNROUTABLE, frames, 'router probe')
                 self._add_peer(frames[0].bytes)
-            else:
+            elif issue:
                 issue(UNROUTABLE, frames, 'too few frames')
             return
         sender, recipient, proto, auth_token, msg_id = frames[:5]
         if proto.bytes != b'VIP1':
             # Peer is not talking a protocol we understand
-            issue(UNROUTABLE, frames, 'bad VIP signature')
+            if issue:
+                issue(UNROUTABLE, frames, 'bad VIP signature')
             return
         user_id = self.lookup_user_id(sender, recipient, auth_token)
         if user_id is None:
             user_id = b''
 
-        self._add_peer(sender.bytes)
+        peer = sender.bytes
+        if peer not in self._peers:
+            self._add_peer(peer)
         subsystem = frames[5]
+        if self.metrics is not None:
+            self.metrics.incoming(peer, subsystem.bytes, frames)
         if not recipient.bytes:
             # Handle requests directed at the router
             name = subsystem.bytes
@@ -292,7 +343,8 @@ class BaseRouter(object):
                 if response is None:
                     # Handler does not know of the subsystem
                     errnum, errmsg = error = _INVALID_SUBSYSTEM
-                    issue(ERROR, frames, error)
+                    if issue:
+                        issue(ERROR, frames, error)
                     frames = [sender, recipient, proto, b'', msg_id,
                               b'error', errnum, errmsg, b'', subsystem]
                 elif not response:
@@ -307,7 +359,8 @@ class BaseRouter(object):
             self._drop_peer(peer)
 
     def _send(self, frames):
-        issue = self.issue
+        issue = self._issue
+        metrics = self.metrics
         socket = self.socket
         drop = []
         recipient, sender = frames[:2]
@@ -316,7 +369,10 @@ class BaseRouter(object):
         try:
             # Try sending the message to its recipient
             socket.send_multipart(frames, flags=NOBLOCK, copy=False)
-            issue(OUTGOING, frames)
+            if issue:
+                issue(OUTGOING, frames)
+            if metrics is not None:
+                metrics.outgoing(bytes(recipient), frames)
         except ZMQError as exc:
             try:
                 errnum, errmsg = error = _ROUTE_ERRORS[exc.errno]
@@ -324,7 +380,10 @@ class BaseRouter(object):
                 error = None
             if error is None:
                 raise
-            issue(ERROR, frames, error)
+            if issue:
+                issue(ERROR, frames, error)
+            if metrics is not None:
+                metrics.dropped(bytes(recipient), exc.errno)
             if exc.errno == EHOSTUNREACH:
                 drop.append(bytes(recipient))
             if exc.errno != EHOSTUNREACH or sender is not frames[0]:
@@ -334,7 +393,8 @@ class BaseRouter(object):
                           b'error', errnum, errmsg, recipient, subsystem]
                 try:
                     socket.send_multipart(frames, flags=NOBLOCK, copy=False)
-                    issue(OUTGOING, frames)
+                    if issue:
+                        issue(OUTGOING, frames)
                 except ZMQError as exc:
                     try:
                         errnum, errmsg = error = _ROUTE_ERRORS[exc.errno]
@@ -342,7 +402,8 @@ class BaseRouter(object):
                         error = None
                     if error is None:
                         raise
-                    issue(ERROR, frames, error)
+                    if issue:
+                        issue(ERROR, frames, error)
                     if exc.errno == EHOSTUNREACH:
                         drop.append(bytes(sender))
         return drop
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+'''Payload serializers for the RPC and pubsub subsystems.
+
+JSON is always available and is the default. msgpack is used, if it is
+installed, by agents that opt in with the serializer argument to Agent
+or the VOLTTRON_SERIALIZER environment variable, and only when sending
+to peers that report supporting it. Payloads in anything other than
+JSON are preceded by a content type frame: a NUL byte followed by the
+serializer name, which can never begin a JSON document.
+'''
+
+from __future__ import absolute_import
+
+import os
+
+from zmq.utils import jsonapi
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+__all__ = ['JSONSerializer', 'MsgpackSerializer', 'SERIALIZERS',
+           'CONTENT_TYPE_PREFIX', 'get_serializer', 'default_serializer']
+
+
+CONTENT_TYPE_PREFIX = b'\x00'
+
+
+class JSONSerializer(object):
+    name = 'json'
+    content_type = CONTENT_TYPE_PREFIX + name
+
+    def dumps(self, obj):
+        return jsonapi.dumps(obj)
+
+    def loads(self, data):
+        return jsonapi.loads(data)
+
+
+class MsgpackSerializer(object):
+    '''msgpack serializer decoding to the same values as JSON.
+
+    Strings are packed without the bin type and unpacked as unicode, and
+    arrays are unpacked as lists, so handlers see equal values no matter
+    which serializer a peer used.
+    '''
+
+    name = 'msgpack'
+    content_type = CONTENT_TYPE_PREFIX + name
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('msgpack is not installed')
+        if msgpack.version >= (0, 5, 2):
+            self._unpack_kwargs = {'raw': False}
+        else:
+            self._unpack_kwargs = {'encoding': 'utf-8'}
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=False)
+
+    def loads(self, data):
+        try:
+            return msgpack.unpackb(data, **self._unpack_kwargs)
+        except Exception as exc:
+            # Callers, like jsonrpc.Dispatcher, expect decode errors to
+            # be ValueErrors, as they are from the JSON decoder.
+            raise ValueError('invalid msgpack data: {}'.format(exc))
+
+
+SERIALIZERS = {JSONSerializer.name: JSONSerializer()}
+if msgpack is not None:
+    SERIALIZERS[MsgpackSerializer.name] = MsgpackSerializer()
+
+
+def get_serializer(name):
+    '''Return the serializer registered as name.
+
+    ValueError is raised if it is unknown or its library is missing.
+    '''
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError('unavailable serializer: {!r}'.format(name))
+
+
+def default_serializer(name=None):
+    '''Return the serializer an agent prefers to send with.
+
+    name, if given, takes precedence over the VOLTTRON_SERIALIZER
+    environment variable, which defaults to json.
+    '''
+    return get_serializer(
+        name or os.environ.get('VOLTTRON_SERIALIZER') or JSONSerializer.name)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+'''Run platform services in a process separate from the router.
+
+The platform starts this module, given the --pubsub-process option, to
+move message distribution off of the process running the router so
+that pubsub fan-out and routing use separate cores. Services connect to
+the router over its local (ipc://) VIP address like any other agent.
+
+The authentication and control services always run in the platform
+process: the router's ZAP requests are answered on an inproc socket
+and the control service manages the agent processes the platform owns.
+'''
+
+from __future__ import print_function, absolute_import
+
+import argparse
+import logging
+from logging import handlers
+import os
+import signal
+import sys
+
+import gevent
+import gevent.event
+
+from .main import PubSubService, log_to_file
+from .vip.agent.compat import CompatPubSub
+
+
+_log = logging.getLogger(__name__)
+
+
+def _pubsub(opts):
+    return PubSubService(address=opts.vip_address, identity='pubsub')
+
+
+def _compat(opts):
+    return CompatPubSub(address=opts.vip_address, identity='pubsub.compat',
+                        publish_address=opts.publish_address,
+                        subscribe_address=opts.subscribe_address)
+
+
+SERVICES = {
+    'pubsub': _pubsub,
+    'pubsub.compat': _compat,
+}
+
+
+def _watch_parent(stop, interval=5):
+    # Exit with the platform even if it could not signal us.
+    parent = os.getppid()
+    while os.getppid() == parent:
+        gevent.sleep(interval)
+    _log.warning('platform process exited; stopping services')
+    stop()
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='run VOLTTRON platform services in a worker process')
+    parser.add_argument('services', nargs='+', choices=sorted(SERVICES),
+                        help='services to run')
+    parser.add_argument('--vip-address', required=True, metavar='ZMQADDR',
+                        help='ZeroMQ URL of the local VIP router')
+    parser.add_argument('--publish-address', metavar='ZMQADDR')
+    parser.add_argument('--subscribe-address', metavar='ZMQADDR')
+    parser.add_argument('--verboseness', type=int, default=logging.WARNING,
+                        metavar='LEVEL', help='set logger verboseness')
+    parser.add_argument('-l', '--log', metavar='FILE',
+                        help='send log output to FILE instead of stderr')
+    opts = parser.parse_args(argv[1:])
+
+    logging.getLogger().setLevel(logging.NOTSET)
+    level = max(1, opts.verboseness)
+    if opts.log:
+        log_to_file(opts.log, level, handler_class=handlers.WatchedFileHandler)
+    else:
+        log_to_file(sys.stderr, level)
+
+    services = [SERVICES[name](opts) for name in opts.services]
+    tasks = [gevent.spawn(service.core.run) for service in services]
+    done = gevent.event.Event()
+    gevent.signal(signal.SIGTERM, done.set)
+    gevent.spawn(_watch_parent, done.set)
+    for task in tasks:
+        task.link(lambda task: done.set())
+    try:
+        done.wait()
+    except KeyboardInterrupt:
+        pass
+    for task in tasks:
+        task.kill(block=False)
+    gevent.wait(tasks, timeout=5)
+    # A service stopping on its own is an error the platform acts on.
+    return 0 if all(task.successful() for task in tasks) else 1
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass